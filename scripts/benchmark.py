@@ -0,0 +1,397 @@
+"""Script to measure the training and inference throughput of backbones, input sizes and batch sizes.
+
+Usage:
+    python scripts/benchmark.py --backbones msavit fpn --data_sizes 64,64,64 160,224,224 --batch_sizes 1 2
+    python scripts/benchmark.py --configs CL_methods/ABDOMENCT-1K_WORD/msa_def_detr_WORD --amp off on
+    python scripts/benchmark.py --backbones msavit --variants attention_impl=naive attention_impl=sdpa --profile_memory
+    python scripts/benchmark.py --backbones msavit resnet --variants channels_last=false channels_last=true --device cpu
+    python scripts/benchmark.py --backbones msavit --variants activation_checkpointing=[encoder,msa],neck.activation_checkpointing=[encoder] --checkpointing_report
+"""
+
+import os, sys
+import argparse
+import contextlib
+import copy
+import itertools
+import json
+import math
+import re
+import traceback
+from pathlib import Path
+
+import torch
+import yaml
+import warnings
+warnings.filterwarnings("ignore", message="TypedStorage")
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+
+from transoar.utils.io import get_config, write_json, temporary_data_dir
+from transoar.utils.benchmark import measure, get_environment, format_table
+from transoar.utils.memory import MemoryProfiler
+from transoar.models.transoarnet import TransoarNet
+from transoar.models.organdetr_net import OrganDetrNet
+from transoar.models.build import build_criterion
+from transoar.models.activation_checkpointing import get_checkpoint_groups, measure_checkpointing_savings
+
+# Real configs the synthetic configs are derived from
+MSAVIT_CONFIG = 'CL_methods/ABDOMENCT-1K_WORD/msa_def_detr_WORD'
+FPN_CONFIG = 'CL_methods/ABDOMEN_ATLAS/msa_def_detr_ABDOMEN_ATLAS'
+
+# Entries of the backbone config that do not depend on the backbone
+SHARED_BACKBONE_ENTRIES = ['in_channels', 'data_size', 'num_organs', 'fg_bg']
+
+# Config of each backbone. msavit and fpn are benchmarked with the backbone and neck of their config. The other
+# backbones have no config in ./config, their backbone section replaces the one of the msavit config, whose
+# TransoarNet passes the backbone fmaps to the neck directly.
+BACKBONE_CONFIGS = {
+    'msavit': {'config': MSAVIT_CONFIG},
+    'fpn': {'config': FPN_CONFIG},
+    'resnet': {
+        'config': MSAVIT_CONFIG,
+        'backbone': {
+            'name': 'resnet',
+            'layers': [3, 4, 6, 3],
+            'out_channels': 384,        # hidden_dim of the neck
+            'use_seg_proxy_loss': False,
+            'use_msa_seg_loss': False
+        },
+        'neck': {'input_level': 'P3'}   # res3 to res5, res2 is not projected to hidden_dim
+    },
+    'attn_fpn': {
+        'config': MSAVIT_CONFIG,
+        'backbone': {
+            'name': 'attn_fpn',
+            'start_channels': 32,
+            'fpn_channels': 384,
+            'out_fmaps': ['P2', 'P3', 'P4'],
+            'conv_kernels': [[3, 3, 3]] * 5,
+            'strides': [[1, 1, 1]] + [[2, 2, 2]] * 4,
+            'use_encoder_attn': True,
+            'use_decoder_attn': True,
+            'feature_levels': ['P2', 'P3', 'P4'],
+            'depths': [2, 2, 2],
+            'num_heads': [4, 8, 16],
+            'window_size': [4, 4, 4],
+            'mlp_ratio': 2,
+            'qkv_bias': True,
+            'qk_scale': None,
+            'drop_rate': 0.0,
+            'attn_drop_rate': 0.0,
+            'drop_path_rate': 0.0,
+            'pos_encoding': 'sine',
+            'nheads': 6,
+            'layers': 1,
+            'n_points': 4,
+            'dim_feedforward': 1024,
+            'dropout': 0.1,
+            'use_cuda': False,
+            'hidden_dim': 384,
+            'use_seg_proxy_loss': False,
+            'use_msa_seg_loss': False
+        }
+    },
+    'swin_unetr': {
+        'config': MSAVIT_CONFIG,
+        'backbone': {
+            'name': 'swin_unetr',
+            'out_channels': 14,
+            'feature_size': 48,
+            'use_checkpoint': False,
+            'out_fmaps': ['P2', 'P3', 'P4'],
+            'use_seg_proxy_loss': False,
+            'use_msa_seg_loss': False
+        }
+    }
+}
+MODELS = {'TransoarNet': TransoarNet, 'OrganDetrNet': OrganDetrNet}
+
+
+def synthetic_config(backbone, data_size, num_classes, path_to_data):
+    """Returns the config of the backbone, see BACKBONE_CONFIGS, with the given data size and a synthetic dataset.
+
+    The dataset info is written to path_to_data, which has to be $TRANSOAR_DATA, since the models read it.
+    """
+    backbone_config = BACKBONE_CONFIGS[backbone]
+    with open(Path('config') / (backbone_config['config'] + '.yaml'), 'r') as stream:
+        config = yaml.safe_load(stream)
+
+    labels = {str(class_): f'organ{class_}' for class_ in range(1, num_classes + 1)}
+    data_info = {
+        'labels': labels,
+        'labels_small': dict(list(labels.items())[:num_classes // 3]),
+        'labels_mid': dict(list(labels.items())[num_classes // 3:2 * num_classes // 3]),
+        'labels_large': dict(list(labels.items())[2 * num_classes // 3:])
+    }
+    (path_to_data / 'synthetic').mkdir(exist_ok=True)
+    write_json(data_info, path_to_data / 'synthetic' / 'data_info.json')
+
+    config.update(data_info)
+    config['dataset'] = 'synthetic'
+    if 'backbone' in backbone_config:
+        config['backbone'] = {
+            **{key: config['backbone'][key] for key in SHARED_BACKBONE_ENTRIES}, **copy.deepcopy(backbone_config['backbone'])
+        }
+    config['neck'].update(copy.deepcopy(backbone_config.get('neck', {})))
+    config['backbone']['num_organs'] = num_classes
+    if 'msa' in config['neck']:
+        config['neck']['msa']['num_organs'] = num_classes
+    if data_size is not None:
+        config['backbone']['data_size'] = list(data_size)
+
+    # Class matching requires one query group per class
+    if config.get('class_matching', False):
+        num_queries = config['neck']['num_queries']
+        config['class_matching_query_split'] = [num_queries // num_classes] * num_classes
+        config['class_matching_query_split'][-1] += num_queries % num_classes
+    return config
+
+def data_size_error(config):
+    """Returns which constraint of the backbone the data size of config violates, None if it has none.
+
+    msavit and fpn have one stage less than log2 of the smallest size, see FPN, all other backbones
+    downsample by their fixed strides. The sizes have to be divisible by the total downsampling, so that
+    the upsampled feature maps match the skip connections and the levels of the neck.
+    """
+    name = config['backbone']['name'].lower()
+    data_size = config['backbone']['data_size']
+    if name in ['msavit', 'fpn']:
+        num_stages = int(math.log2(min(data_size))) - 1
+        deepest_level = max(int(fmap[1:]) for fmap in config['backbone']['out_fmaps'])
+        if deepest_level > num_stages - 1:
+            return f'{name} has {num_stages} stages for the smallest size {min(data_size)}, ' \
+                   f'out_fmaps P{deepest_level} needs a smallest size of at least {2 ** (deepest_level + 2)}'
+        factors = [2 ** (num_stages - 1)] * len(data_size)
+    elif name == 'attn_fpn':
+        factors = [math.prod(stride[axis] for stride in config['backbone']['strides']) for axis in range(len(data_size))]
+    elif name == 'swin_unetr':
+        if min(data_size) < 64:   # the deepest stage would have a single voxel
+            return f'swin_unetr needs sizes of at least 64, the smallest size is {min(data_size)}'
+        factors = [32] * len(data_size)
+    else:
+        return None
+
+    if any(size % factor for size, factor in zip(data_size, factors)):
+        return f'{name} downsamples by {"x".join(map(str, factors))}, which does not divide {"x".join(map(str, data_size))}'
+    return None
+
+def synthetic_batch(config, batch_size, device, generator):
+    """Returns random volumes, one box per class as detection targets and label maps."""
+    data_size = config['backbone']['data_size']
+    num_classes = len(config['labels'])
+
+    data = torch.randn(batch_size, 1, *data_size, generator=generator).to(device)
+    seg_targets = torch.randint(0, num_classes + 1, (batch_size, 1, *data_size), generator=generator).to(device)
+    det_targets = []
+    for _ in range(batch_size):
+        centers = torch.rand(num_classes, 3, generator=generator) * 0.6 + 0.2
+        sizes = torch.rand(num_classes, 3, generator=generator) * 0.3 + 0.05
+        det_targets.append({
+            'boxes': torch.cat([centers, sizes], dim=1).to(device),
+            'labels': torch.arange(1, num_classes + 1, device=device)
+        })
+    return data, seg_targets, det_targets
+
+def peak_memory_mb(device):
+    """Returns the peak of allocated CUDA memory since the last reset.
+
+    There is no per-run peak on CPU, where the resident memory of the process only grows, so None is
+    returned. --profile_memory reports the saved activations of a training step on every device.
+    """
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return None
+
+def benchmark_model(config, batch_size, amp, device, args):
+    """Times training steps and inference of the model built from config.
+
+    Returns:
+        A dict containing the ms per step, samples per second and, on CUDA, the peak memory of both modes.
+    """
+    config = copy.deepcopy(config)
+    config['device'] = str(device)
+    model = MODELS[args.model or config['model']](config).to(device=device)
+    criterion = build_criterion(config).to(device=device)
+    optimizer = torch.optim.AdamW(
+        [param for param in model.parameters() if param.requires_grad], lr=float(config['lr'])
+    )
+    scaler = torch.amp.GradScaler(device.type, enabled=amp and device.type == 'cuda')
+    amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+    generator = torch.Generator().manual_seed(0)
+    data, seg_targets, det_targets = synthetic_batch(config, batch_size, device, generator)
+
+    def train_step():
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp):
+            out, contrast_losses, dn_meta = model(data, det_targets)
+            loss_dict, _ = criterion(out, det_targets, seg_targets, dn_meta)
+            del loss_dict['hd95']
+
+            loss_abs = sum(loss_val * config['loss_coefs'][loss_key.split('_')[0]] for loss_key, loss_val in loss_dict.items())
+            loss_abs = loss_abs + sum(contrast_losses.values())
+
+        optimizer.zero_grad()
+        scaler.scale(loss_abs).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    @torch.no_grad()
+    def inference_step():
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp):
+            model(data)
+
+    results = {}
+    modes = {'train': (model.train, train_step), 'inference': (model.eval, inference_step)}
+    for mode in args.modes:
+        set_mode, step = modes[mode]
+        set_mode()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+
+        times = measure(step, repeats=args.steps, warmup=args.warmup)
+        results[f'{mode}_ms'] = times['median_ms']
+        results[f'{mode}_samples_per_s'] = batch_size * 1000 / times['median_ms']
+        peak_mb = peak_memory_mb(device)
+        if peak_mb is not None:
+            results[f'{mode}_peak_mb'] = peak_mb
+
+    # Attribute the activation memory of a training step to the modules
+    if args.profile_memory:
+        model.train()
+        memory_profiler = MemoryProfiler(device)
+        memory_profiler.attach_model(model, criterion)
+        with memory_profiler.profile():
+            train_step()
+        print(memory_profiler.report())
+        memory = memory_profiler.summary()
+        results['train_saved_mb'] = memory.get('total_saved', 0)
+        results['backbone_saved_mb'] = memory.get('backbone_saved', 0)
+
+    # Memory saved by each group of checkpointed modules
+    if args.checkpointing_report and get_checkpoint_groups(model):
+        model.train()
+        savings = measure_checkpointing_savings(model, train_step, device)
+        print(format_table(
+            ['checkpointed', 'saved [MB]', 'peak [MB]', 'saving [MB]'],
+            [[group, memory['saved_mb'], memory['peak_mb'], memory.get('saving_mb', '-')] for group, memory in savings.items()]
+        ))
+        results['checkpointing'] = savings
+    return results
+
+def parse_variant(variant):
+    """Parses config overrides like 'attention_impl=sdpa,activation_checkpointing=[encoder,msa]'.
+
+    Keys are backbone config entries, keys prefixed with 'neck.' neck config entries.
+    """
+    overrides = yaml.safe_load('{' + re.sub(r'([\w.]+)=', r'\1: ', variant) + '}') or {}
+    backbone = {key: value for key, value in overrides.items() if not key.startswith('neck.')}
+    neck = {key[len('neck.'):]: value for key, value in overrides.items() if key.startswith('neck.')}
+    return backbone, neck
+
+def get_runs(args, path_to_data):
+    """Yields a name and config for every config or backbone and data size of the sweep."""
+    if args.configs:
+        for config_name in args.configs:
+            config = get_config(config_name)
+            for data_size in args.data_sizes or [None]:
+                config_ = copy.deepcopy(config)
+                if data_size is not None:
+                    config_['backbone']['data_size'] = list(data_size)
+                yield config_name, config_
+    else:
+        for backbone, data_size in itertools.product(args.backbones, args.data_sizes or [None]):
+            yield backbone, synthetic_config(backbone, data_size, args.num_classes, path_to_data)
+
+def run(args):
+    device = torch.device(args.device)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    # Peak memory is only measured per run on CUDA devices, see peak_memory_mb()
+    metrics = {'ms': '[ms]', 'samples_per_s': '[samples/s]'}
+    if device.type == 'cuda':
+        metrics['peak_mb'] = 'peak [MB]'
+    memory_columns = ['train_saved_mb', 'backbone_saved_mb'] if args.profile_memory else []
+    rows, results = [], []
+    # The models read the dataset info of the synthetic configs from $TRANSOAR_DATA
+    with temporary_data_dir() if not args.configs else contextlib.nullcontext() as path_to_data:
+        runs = list(get_runs(args, path_to_data))
+
+        # Data sizes the backbones can not process would fail every run with a shape mismatch in the neck
+        errors = [(name, data_size_error(config)) for name, config in runs]
+        errors = [f'{name}: {error}' for name, error in errors if error is not None]
+        if errors:
+            print('Unsupported data sizes:\n' + '\n'.join(errors))
+            sys.exit(1)
+
+        for name, config in runs:
+            for variant, batch_size, amp in itertools.product(args.variants, args.batch_sizes, args.amp):
+                amp = amp == 'on'
+                config_ = copy.deepcopy(config)
+                backbone_overrides, neck_overrides = parse_variant(variant)
+                config_['backbone'].update(backbone_overrides)
+                config_['neck'].update(neck_overrides)
+                data_size = 'x'.join(str(size) for size in config['backbone']['data_size'])
+                result = {'run': name, 'variant': variant, 'model': args.model or config['model'], 'backbone': config['backbone']['name'],
+                          'data_size': data_size, 'batch_size': batch_size, 'amp': amp}
+                try:
+                    result.update(benchmark_model(config_, batch_size, amp, device, args))
+                except Exception as error:     # e.g., out of memory or a backbone not supported by the neck
+                    result['error'] = f'{type(error).__name__}: {str(error).splitlines()[0] if str(error) else ""}'
+                    if args.verbose:
+                        traceback.print_exc()
+
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                print(json.dumps(result))
+                results.append(result)
+
+                rows.append([result[key] for key in ['run', 'variant', 'data_size', 'batch_size', 'amp']] + [
+                    result.get(f'{mode}_{metric}', '-') for mode in args.modes for metric in metrics
+                ] + [result.get(column, '-') for column in memory_columns] + [result.get('error', '')])
+
+    header = ['run', 'variant', 'data_size', 'batch', 'amp'] + [
+        f'{mode} {metric}' for mode in args.modes for metric in metrics.values()
+    ] + [f'{column[:-3]} [MB]' for column in memory_columns] + ['error']
+    print(format_table(header, rows))
+
+    if args.out is not None:
+        write_json({'environment': get_environment(), 'results': results}, args.out)
+        print(f'Saved results to {args.out}.')
+
+    # A run without any result is a broken config rather than a slow one
+    failed = sorted(set(result['run'] for result in results) - set(result['run'] for result in results if 'error' not in result))
+    if failed:
+        print(f'All benchmarks of {", ".join(failed)} failed, rerun with --verbose for the tracebacks.')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Add necessary args
+    parser.add_argument('--configs', nargs='+', default=None, help='Names of configs in ./config, replaces the synthetic configs.')
+    parser.add_argument('--backbones', nargs='+', default=list(BACKBONE_CONFIGS), choices=list(BACKBONE_CONFIGS), help='Backbones of the synthetic configs.')
+    parser.add_argument('--data_sizes', nargs='+', default=None, type=lambda size: tuple(int(item) for item in size.split(',')),
+                        help='Input sizes, e.g., 160,224,224. Defaults to the data size of the config.')
+    parser.add_argument('--variants', nargs='+', default=[''],
+                        help='Config overrides compared on every run, e.g., attention_impl=naive attention_impl=sdpa. Prefix neck entries with neck.')
+    parser.add_argument('--batch_sizes', nargs='+', default=[1], type=int, help='Batch sizes.')
+    parser.add_argument('--amp', nargs='+', default=['off'], choices=['off', 'on'], help='Run with and/or without autocast.')
+    parser.add_argument('--modes', nargs='+', default=['train', 'inference'], choices=['train', 'inference'], help='What to time.')
+    parser.add_argument('--model', type=str, default=None, choices=list(MODELS), help='Model to build, defaults to the model of the config.')
+    parser.add_argument('--num_classes', type=int, default=10, help='Number of classes of the synthetic configs.')
+    parser.add_argument('--steps', type=int, default=5, help='Number of timed steps.')
+    parser.add_argument('--warmup', type=int, default=2, help='Number of steps before timing.')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device to run on.')
+    parser.add_argument('--threads', type=int, default=None, help='Number of torch CPU threads.')
+    parser.add_argument('--out', type=str, default=None, help='Path to save the results as JSON.')
+    parser.add_argument('--profile_memory', action='store_true', help='Print the activation memory of the modules of a training step and report the saved activations.')
+    parser.add_argument('--checkpointing_report', action='store_true', help='Print the memory saved by each group of checkpointed modules.')
+    parser.add_argument('--verbose', action='store_true', help='Print the traceback of failed runs.')
+    args = parser.parse_args()
+
+    run(args)
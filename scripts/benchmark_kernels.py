@@ -0,0 +1,296 @@
+"""Script to time the hot kernels on synthetic inputs and compare the results against a baseline.
+
+Usage:
+    python scripts/benchmark_kernels.py run --out kernels.json [--filter matcher]
+    python scripts/benchmark_kernels.py compare baseline.json kernels.json [--threshold 0.1]
+"""
+
+import os, sys
+import argparse
+import itertools
+import math
+
+import numpy as np
+import torch
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+
+from transoar.utils.bboxes import (
+    segmentation2bbox, iou_3d, iou_3d_np, generalized_bbox_iou_3d, box_cxcyczwhd_to_xyzxyz, merge_patches
+)
+from transoar.utils.benchmark import measure, save_results, compare_results, format_table
+from transoar.models.matcher import HungarianMatcher
+from transoar.models.ops.functions.ms_deform_attn_func import ms_deform_attn_core_pytorch
+from transoar.models.position_encoding import PositionEmbeddingSine3D
+from transoar.models.backbones.MSAViT import Attention, ATTENTION_IMPLS, EncoderCnnBlock
+from transoar.models.build import to_channels_last_3d
+from transoar.inference import inference
+from transoar.evaluator import DetectionEvaluator
+from transoar.data.dataloader import TransoarCollator
+
+# Sizes of the msa_def_detr configs with data_size [160, 224, 224]
+DATA_SIZE = (160, 224, 224)
+LEVEL_SHAPES = [(20, 28, 28), (10, 14, 14), (5, 7, 7)]
+HIDDEN_DIM = 384
+NUM_HEADS = 6
+NUM_POINTS = 4
+NUM_QUERIES = 100
+NUM_CLASSES = 5
+MSA_NUM_HEADS = 32
+MSA_PATCH_SIZE = 2
+QUERY_SPLIT = [10, 20, 20, 30, 20]
+
+BENCHMARKS = {}
+
+
+def benchmark(name, repeats=10):
+    """Registers a setup function, which creates the inputs and returns the function to time."""
+    def register(setup):
+        BENCHMARKS[name] = (setup, repeats)
+        return setup
+    return register
+
+def random_boxes(num_boxes, generator):
+    """Returns random boxes in the normalized cxcyczwhd format."""
+    centers = torch.rand(num_boxes, 3, generator=generator) * 0.6 + 0.2
+    sizes = torch.rand(num_boxes, 3, generator=generator) * 0.3 + 0.05
+    return torch.cat([centers, sizes], dim=1)
+
+def synthetic_labels(batch_size, num_classes, generator):
+    """Returns label maps of shape [batch_size, 1, *DATA_SIZE] with one cuboid per organ."""
+    labels = torch.zeros(batch_size, 1, *DATA_SIZE, dtype=torch.uint8)
+    for labels_ in labels:
+        for class_ in range(1, num_classes + 1):
+            size = [int(s * (0.05 + 0.25 * torch.rand(1, generator=generator).item())) for s in DATA_SIZE]
+            start = [int((s - l) * torch.rand(1, generator=generator).item()) for s, l in zip(DATA_SIZE, size)]
+            labels_[0, start[0]:start[0] + size[0], start[1]:start[1] + size[1], start[2]:start[2] + size[2]] = class_
+    return labels
+
+def synthetic_outputs(batch_size, generator):
+    return {
+        'pred_logits': torch.randn(batch_size, NUM_QUERIES, NUM_CLASSES + 1, generator=generator),
+        'pred_boxes': random_boxes(batch_size * NUM_QUERIES, generator).view(batch_size, NUM_QUERIES, 6)
+    }
+
+def synthetic_targets(batch_size, generator):
+    return [
+        {'labels': torch.arange(1, NUM_CLASSES + 1), 'boxes': random_boxes(NUM_CLASSES, generator)}
+        for _ in range(batch_size)
+    ]
+
+
+@benchmark('segmentation2bbox')
+def bench_segmentation2bbox(generator):
+    labels = synthetic_labels(2, 10, generator)
+    return lambda: segmentation2bbox(labels, padding=1)
+
+@benchmark('collator')
+def bench_collator(generator):
+    collator = TransoarCollator({'bbox_padding': 1}, 'train')
+    labels = synthetic_labels(2, 10, generator)
+    batch = [(torch.randn(1, *DATA_SIZE, generator=generator), label) for label in labels]
+    return lambda: collator(batch)
+
+@benchmark('iou_3d', repeats=50)
+def bench_iou_3d(generator):
+    boxes1 = box_cxcyczwhd_to_xyzxyz(random_boxes(2 * NUM_QUERIES, generator))
+    boxes2 = box_cxcyczwhd_to_xyzxyz(random_boxes(2 * NUM_CLASSES, generator))
+    return lambda: iou_3d(boxes1, boxes2)
+
+@benchmark('iou_3d_np', repeats=50)
+def bench_iou_3d_np(generator):
+    boxes1 = random_boxes(2 * NUM_QUERIES, generator).numpy()
+    boxes2 = random_boxes(2 * NUM_CLASSES, generator).numpy()
+    return lambda: iou_3d_np(boxes1, boxes2)
+
+@benchmark('generalized_bbox_iou_3d', repeats=50)
+def bench_generalized_bbox_iou_3d(generator):
+    boxes1 = box_cxcyczwhd_to_xyzxyz(random_boxes(2 * NUM_QUERIES, generator))
+    boxes2 = box_cxcyczwhd_to_xyzxyz(random_boxes(2 * NUM_CLASSES, generator))
+    return lambda: generalized_bbox_iou_3d(boxes1, boxes2)
+
+def matcher_benchmark(dense_matching, class_matching):
+    def setup(generator):
+        matcher = HungarianMatcher(
+            cost_class=2, cost_bbox=5, cost_giou=2, dense_matching=dense_matching, dense_matching_lambda=0.5,
+            class_matching=class_matching, class_matching_query_split=QUERY_SPLIT,
+            config={'CL_replay': False, 'mixing_datasets': False}
+        )
+        outputs, targets = synthetic_outputs(2, generator), synthetic_targets(2, generator)
+        return lambda: matcher(outputs, targets)
+    return setup
+
+for _name, _dense, _class in [
+    ('matcher_one2one', False, False), ('matcher_dense', True, False),
+    ('matcher_class', False, True), ('matcher_class_dense', True, True)
+]:
+    benchmark(_name, repeats=20)(matcher_benchmark(_dense, _class))
+
+def deform_attn_benchmark(num_queries):
+    def setup(generator):
+        head_dim = HIDDEN_DIM // NUM_HEADS
+        num_values = sum(math.prod(shape) for shape in LEVEL_SHAPES)
+        num_queries_ = num_values if num_queries is None else num_queries
+        value = torch.randn(1, num_values, NUM_HEADS, head_dim, generator=generator)
+        sampling_locations = torch.rand(
+            1, num_queries_, NUM_HEADS, len(LEVEL_SHAPES), NUM_POINTS, 3, generator=generator
+        )
+        attention_weights = torch.rand(
+            1, num_queries_, NUM_HEADS, len(LEVEL_SHAPES), NUM_POINTS, generator=generator
+        ).softmax(-1)
+        return lambda: ms_deform_attn_core_pytorch(value, LEVEL_SHAPES, sampling_locations, attention_weights)
+    return setup
+
+benchmark('ms_deform_attn_encoder', repeats=5)(deform_attn_benchmark(None))
+benchmark('ms_deform_attn_decoder', repeats=20)(deform_attn_benchmark(NUM_QUERIES))
+
+def msa_attention_benchmark(attention_type, attention_impl):
+    """Times the forward and backward pass of the windowed attention of MSAViT on the largest level."""
+    def setup(generator):
+        attention = Attention(
+            HIDDEN_DIM, MSA_NUM_HEADS, MSA_PATCH_SIZE, attention_type=attention_type, attention_impl=attention_impl
+        )
+        num_windows = math.prod(size // MSA_PATCH_SIZE for size in LEVEL_SHAPES[0])
+        x = torch.randn(num_windows, MSA_PATCH_SIZE**3, HIDDEN_DIM, generator=generator, requires_grad=True)
+        q_ms = torch.randn(x.shape, generator=generator) if attention_type == 'global' else None
+
+        def run():
+            out, _ = attention(x, q_ms)
+            out.sum().backward()
+        return run
+    return setup
+
+for _type, _impl in itertools.product(['local', 'global'], ATTENTION_IMPLS):
+    benchmark(f'msa_attention_{_type}_{_impl}', repeats=10)(msa_attention_benchmark(_type, _impl))
+
+def conv_encoder_benchmark(memory_format):
+    """Times the forward and backward pass of two CNN encoder stages of MSAViT in a memory format."""
+    def setup(generator):
+        encoder = torch.nn.Sequential(EncoderCnnBlock(32, 64, 3, 2), EncoderCnnBlock(64, 128, 3, 2))
+        if memory_format == torch.channels_last_3d:
+            to_channels_last_3d(encoder)
+        x = torch.randn(1, 32, *(size // 4 for size in DATA_SIZE), generator=generator)
+        x = x.contiguous(memory_format=memory_format).requires_grad_()
+
+        def run():
+            encoder(x).sum().backward()
+        return run
+    return setup
+
+benchmark('conv_encoder_contiguous', repeats=5)(conv_encoder_benchmark(torch.contiguous_format))
+benchmark('conv_encoder_channels_last', repeats=5)(conv_encoder_benchmark(torch.channels_last_3d))
+
+@benchmark('position_embedding_sine_3d')
+def bench_position_embedding(generator):
+    position_embedding = PositionEmbeddingSine3D(channels=HIDDEN_DIM)
+    src = torch.randn(1, HIDDEN_DIM, *LEVEL_SHAPES[0], generator=generator)
+    return lambda: position_embedding._compute(src.shape, src.device)   # forward() only looks up the TENSOR_CACHE after the first call
+
+@benchmark('inference', repeats=50)
+def bench_inference(generator):
+    outputs = synthetic_outputs(1, generator)
+    return lambda: inference(outputs)
+
+def merge_patches_benchmark(mode):
+    def setup(generator):
+        patch_size, image_size = (64, 64, 64), (192, 192, 192)
+        patch_positions = torch.tensor(
+            [[x, y, z] for x in range(0, 129, 32) for y in range(0, 129, 32) for z in range(0, 129, 32)]
+        )
+        predictions = {
+            patch_id: {
+                'pred_boxes': random_boxes(NUM_CLASSES, generator).numpy(),
+                'pred_classes': np.arange(1, NUM_CLASSES + 1),
+                'pred_scores': torch.rand(NUM_CLASSES, generator=generator).numpy()
+            } for patch_id in range(patch_positions.shape[0])
+        }
+        return lambda: merge_patches(predictions, patch_positions, patch_size, image_size, mode, config={})
+    return setup
+
+for _mode in ['score', 'average', 'wbf']:
+    benchmark(f'merge_patches_{_mode}', repeats=20)(merge_patches_benchmark(_mode))
+
+def build_evaluator():
+    labels = {str(class_): f'organ{class_}' for class_ in range(1, NUM_CLASSES + 1)}
+    groups = [dict(list(labels.items())[start:stop]) for start, stop in [(0, 1), (1, 3), (3, None)]]
+    return DetectionEvaluator(
+        classes=list(labels.values()), classes_small=groups[0], classes_mid=groups[1], classes_large=groups[2],
+        iou_range_nndet=(0.1, 0.5, 0.05), iou_range_coco=(0.5, 0.95, 0.05), sparse_results=False
+    )
+
+def synthetic_cases(num_cases, generator):
+    cases = []
+    for _ in range(num_cases):
+        gt_boxes = random_boxes(NUM_CLASSES, generator)
+        pred_boxes = gt_boxes + 0.02 * torch.randn(gt_boxes.shape, generator=generator)
+        cases.append((
+            [pred_boxes.numpy()], [np.arange(1, NUM_CLASSES + 1)], [torch.rand(NUM_CLASSES, generator=generator).numpy()],
+            [gt_boxes.numpy()], [np.arange(1, NUM_CLASSES + 1)]
+        ))
+    return cases
+
+@benchmark('evaluator_add', repeats=20)
+def bench_evaluator_add(generator):
+    evaluator, cases = build_evaluator(), synthetic_cases(50, generator)
+
+    def run():
+        evaluator.reset()
+        for case in cases:
+            evaluator.add(*case)
+    return run
+
+@benchmark('evaluator_eval', repeats=10)
+def bench_evaluator_eval(generator):
+    evaluator = build_evaluator()
+    for case in synthetic_cases(50, generator):
+        evaluator.add(*case)
+    return evaluator.eval
+
+
+def run(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    for name, (setup, repeats) in BENCHMARKS.items():
+        if args.filter is not None and not any(filter_ in name for filter_ in args.filter):
+            continue
+        generator = torch.Generator().manual_seed(0)
+        fn = setup(generator)
+        results[name] = measure(fn, repeats=args.repeats or repeats, warmup=args.warmup)
+        print(f"{name:<30} {results[name]['median_ms']:10.3f} ms")
+
+    save_results(results, args.out)
+    print(f'Saved results to {args.out}.')
+
+def compare(args):
+    rows, regressions = compare_results(args.baseline, args.results, threshold=args.threshold)
+    print(format_table(['benchmark', 'baseline [ms]', 'new [ms]', 'ratio', 'status'], rows))
+    if regressions:
+        print(f'{len(regressions)} regression(s) above {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help='Time the kernels and save the results as JSON.')
+    parser_run.add_argument('--out', type=str, default='benchmark_kernels.json', help='Path of the JSON results.')
+    parser_run.add_argument('--filter', nargs='+', default=None, help='Only run benchmarks containing one of these names.')
+    parser_run.add_argument('--repeats', type=int, default=None, help='Overwrites the number of timed calls per benchmark.')
+    parser_run.add_argument('--warmup', type=int, default=2, help='Number of calls before timing.')
+    parser_run.add_argument('--threads', type=int, default=None, help='Number of torch CPU threads.')
+    parser_run.set_defaults(func=run)
+
+    parser_compare = subparsers.add_parser('compare', help='Compare results against a baseline, exits with 1 on regressions.')
+    parser_compare.add_argument('baseline', type=str, help='JSON results of the baseline.')
+    parser_compare.add_argument('results', type=str, help='JSON results to compare.')
+    parser_compare.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown counted as regression.')
+    parser_compare.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
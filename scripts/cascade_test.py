@@ -0,0 +1,129 @@
+"""Script to evaluate coarse-to-fine cascade inference, refining small organs of a full-volume run with a patch run.
+
+Usage:
+    python scripts/cascade_test.py --coarse_run <run> --patch_run <patch run>
+    python scripts/cascade_test.py --coarse_run <run> --patch_run <patch run> --classes pancreas duodenum --margin 0.5
+"""
+
+import os, sys
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from tqdm import tqdm
+import warnings
+warnings.filterwarnings("ignore", message="TypedStorage")
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+
+from transoar.utils.io import load_json, write_json
+from transoar.utils.bboxes import segmentation2bbox
+from transoar.data.patch_dataset import TransoarDataset
+from transoar.data.dataloader import build_loader
+from transoar.models.organdetr_net import OrganDetrNet
+from transoar.models.transoarnet import TransoarNet
+from transoar.cascade import cascade_inference
+from transoar.inference import get_class_ids
+from transoar.evaluator import get_detection_evaluator
+from transoar.utils.checkpoint import get_checkpoint, load_model
+
+# Metrics compared between the coarse pass and the cascade
+METRICS = ['mAP_coco', 'mAP_coco_s', 'mAP_coco_m', 'mAP_coco_l']
+
+
+def load_run(model_class, path_to_run, model_load, device):
+    config = load_json(path_to_run / 'config.json')
+    path_to_ckpt = get_checkpoint(path_to_run, model_load)
+    print(f'Loading checkpoint: {path_to_ckpt}')
+
+    checkpoint = torch.load(path_to_ckpt, map_location='cpu')
+    model, model_device = load_model(model_class(config), checkpoint, device)
+    assert model_device == device, 'quantized models only run on CPUs'
+    return model, config
+
+def num_sliding_window_patches(image_size, patch_size, stride):
+    """Returns the number of patches of a sliding window inference of the whole volume, see gen_patches()."""
+    num_patches = 1
+    for size, patch_size_ in zip(image_size, patch_size):
+        padded_size = max(size + (-size) % stride, patch_size_)
+        num_patches *= (padded_size - patch_size_) // stride + 1
+    return num_patches
+
+def collate_case(batch):
+    return batch[0]
+
+def run(args):
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(args.num_gpu)
+    device = 'cuda' if args.num_gpu >= 0 else 'cpu'
+
+    coarse_model, coarse_config = load_run(OrganDetrNet, Path('./runs/' + args.coarse_run), args.coarse_model_load, device)
+    patch_model, patch_config = load_run(TransoarNet, Path('./runs/' + args.patch_run), args.patch_model_load, device)
+
+    coarse_size = coarse_config['backbone']['data_size']
+    patch_size = patch_config['augmentation']['patch_size']
+    merge_mode = args.merge_mode or patch_config.get('patch_merge_mode', 'custom')
+    fine_classes = get_class_ids(coarse_config['labels'], args.classes) if args.classes else [int(class_) for class_ in coarse_config['labels_small']]
+    print(f'Refining classes {fine_classes} on crops of {patch_size}.')
+
+    # Cases at the high resolution of the patch run
+    set_to_eval = 'val' if args.val else 'test'
+    dataset = TransoarDataset(patch_config, set_to_eval)
+    loader = build_loader(dataset, 1, False, patch_config, collate_case)
+
+    evaluators = {'coarse': get_detection_evaluator(coarse_config), 'cascade': get_detection_evaluator(coarse_config)}
+    per_case = {}
+    for idx, case in enumerate(tqdm(loader)):
+        volume, label = case[0], case[1]
+        gt_boxes, gt_classes = segmentation2bbox(label[None], patch_config['bbox_padding'])
+        gt_boxes, gt_classes = [gt_boxes[0].float().numpy()], [gt_classes[0].numpy()]
+
+        start = time.perf_counter()
+        pred_boxes, pred_classes, pred_scores, info = cascade_inference(
+            coarse_model, patch_model, volume, coarse_size, patch_size, fine_classes, merge_mode=merge_mode,
+            config=patch_config, margin=args.margin, patch_batch_size=args.patch_batch_size, device=device
+        )
+        cascade_ms = (time.perf_counter() - start) * 1000
+
+        evaluators['coarse'].add(*[[pred] for pred in info['coarse']], gt_boxes=gt_boxes, gt_classes=gt_classes)
+        evaluators['cascade'].add(pred_boxes, pred_classes, pred_scores, gt_boxes=gt_boxes, gt_classes=gt_classes)
+        per_case[f'case{idx}'] = {
+            'num_crops': int(info['crop_positions'].shape[0]),
+            'num_sliding_window_patches': num_sliding_window_patches(volume.shape[-3:], patch_size, patch_config['augmentation']['stride']),
+            'cascade_ms': cascade_ms
+        }
+
+    results = {name: evaluator.eval() for name, evaluator in evaluators.items()}
+    results['delta'] = {metric: results['cascade'][metric] - results['coarse'][metric] for metric in METRICS if metric in results['coarse']}
+    for key in ['num_crops', 'num_sliding_window_patches', 'cascade_ms']:
+        results[f'mean_{key}'] = float(np.mean([case[key] for case in per_case.values()]))
+    results.update({'fine_classes': fine_classes, 'margin': args.margin, 'merge_mode': merge_mode})
+    print({metric: results['delta'][metric] for metric in results['delta']}, {key: results[key] for key in results if key.startswith('mean_')})
+
+    path_to_results = Path('./runs/' + args.coarse_run) / 'results' / ('cascade_' + args.patch_run)
+    path_to_results.mkdir(parents=True, exist_ok=True)
+    write_json(results, path_to_results / ('results_' + set_to_eval + '.json'))
+    write_json(per_case, path_to_results / ('per_case_' + set_to_eval + '.json'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Add necessary args
+    parser.add_argument('--coarse_run', required=True, type=str, help='Name of the full-volume experiment in ./runs.')
+    parser.add_argument('--patch_run', required=True, type=str, help='Name of the patch-based experiment in ./runs.')
+    parser.add_argument('--coarse_model_load', type=str, default='last', help='Checkpoint of the coarse run: last, best_val, best_test, epoch number.')
+    parser.add_argument('--patch_model_load', type=str, default='last', help='Checkpoint of the patch run: last, best_val, best_test, epoch number.')
+    parser.add_argument('--num_gpu', type=int, default=-1, help='GPU to run on, -1 for CPU.')
+    parser.add_argument('--val', action='store_true', help='Evaluate on the val instead of the test set.')
+    parser.add_argument('--classes', nargs='+', default=None, help='Organs refined on crops (names or class ids), defaults to labels_small.')
+    parser.add_argument('--margin', type=float, default=0.25, help='Context around the coarse boxes, relative to their size.')
+    parser.add_argument('--merge_mode', type=str, default=None, help='Mode of merge_patches, defaults to patch_merge_mode of the patch run.')
+    parser.add_argument('--patch_batch_size', type=int, default=1, help='Number of crops predicted at once.')
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,87 @@
+"""Checks that training stops with the requeue exit code on a preemption signal and resumes on restart."""
+
+import argparse
+import os, sys
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+from pathlib import Path
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+import torch
+import yaml
+
+from transoar.utils.io import PATH_TO_CONFIG
+from transoar.utils.preemption import PREEMPTED_MARKER, REQUEUE_EXIT_CODE
+
+
+def run_and_signal(config_name, signal_name, timeout):
+    """Starts scripts/train.py and sends the signal once the first step is done.
+
+    Returns:
+        The exit code and the output of the process.
+    """
+    process = subprocess.Popen(
+        [sys.executable, 'scripts/train.py', '--config', config_name],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output, sent = '', False
+    while True:
+        chunk = os.read(process.stdout.fileno(), 4096).decode(errors='replace')
+        if not chunk:
+            break
+        output += chunk
+        if not sent and re.search(r'\| *[1-9]\d*/\d+ \[', output):  # tqdm shows the first finished step
+            process.send_signal(getattr(signal, signal_name))
+            sent = True
+    return process.wait(timeout=timeout), output
+
+def check(name, ok, output=''):
+    print(f'* {ok} {name}')
+    if not ok:
+        print(output[-2000:])
+        sys.exit(1)
+
+def check_preemption(config, args):
+    path_to_run = Path('runs') / config['experiment_name']
+    shutil.rmtree(path_to_run, ignore_errors=True)
+
+    # Preempted after the first step
+    exit_code, output = run_and_signal(args.config_name, args.signal, args.timeout)
+    check(f'exit code {exit_code} is the requeue exit code {REQUEUE_EXIT_CODE}', exit_code == REQUEUE_EXIT_CODE, output)
+    check('run is marked as preempted', (path_to_run / PREEMPTED_MARKER).exists())
+    check('model_last.pt is written', (path_to_run / 'model_last.pt').exists())
+    checkpoint = torch.load(path_to_run / 'model_last.pt', map_location='cpu')
+    print(f"  stopped in epoch {checkpoint['epoch'] + 1} after step {checkpoint.get('step', 0)}")
+
+    # Restart without --resume, continues from model_last.pt and is preempted again
+    exit_code, output = run_and_signal(args.config_name, args.signal, args.timeout)
+    check('restart resumes from model_last.pt', 'loading ckpt' in output, output)
+    check(f'exit code {exit_code} after the restart is the requeue exit code', exit_code == REQUEUE_EXIT_CODE, output)
+
+    shutil.rmtree(path_to_run, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Add necessary args
+    parser.add_argument("--config", type=str, required=True, help="Config to use for training located in /config.")
+    parser.add_argument("--signal", type=str, default='SIGUSR1', help="Signal to send, e.g., SIGUSR1 or SIGTERM.")
+    parser.add_argument("--timeout", type=int, default=600, help="Seconds to wait for the training to stop.")
+    args = parser.parse_args()
+
+    # Train on a copy of the config with its own run directory
+    with open(PATH_TO_CONFIG / (args.config + '.yaml'), 'r') as stream:
+        config = yaml.safe_load(stream)
+    config['experiment_name'] = config['experiment_name'] + '_preemption_check'
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', dir=PATH_TO_CONFIG) as config_file:
+        yaml.safe_dump(config, config_file)
+        config_file.flush()
+        args.config_name = Path(config_file.name).stem
+        check_preemption(config, args)
@@ -0,0 +1,122 @@
+"""Checks that resuming from a mid-epoch checkpoint reproduces the uninterrupted epoch bit-exactly."""
+
+import argparse
+import copy
+import os, sys
+import random
+import tempfile
+from pathlib import Path
+import warnings
+warnings.filterwarnings("ignore", message="TypedStorage")
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+import numpy as np
+import torch
+import monai
+
+from transoar.trainer import Trainer
+from transoar.data.dataloader import get_loader
+from transoar.utils.distributed import init_distributed, cleanup_distributed, wrap_model, unwrap_model, broadcast_object, is_main_process, barrier
+from transoar.utils.io import get_config
+from transoar.models.transoarnet import TransoarNet
+from transoar.models.organdetr_net import OrganDetrNet
+from transoar.models.build import build_criterion
+
+
+MODELS = {'TransoarNet': TransoarNet, 'OrganDetrNet': OrganDetrNet}
+
+
+def seed_everything(seed):
+    seed = seed + int(os.environ.get('RANK', 0))
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    monai.utils.set_determinism(seed=seed)
+    random.seed(seed)
+
+def build_trainer(config, device, path_to_run):
+    """Builds model, optimizer and trainer the same way as scripts/train.py, without pretrained weights."""
+    train_loader = get_loader(config, 'train')
+    model = MODELS[config['model']](config).to(device=device)
+    if config.get('hybrid_dense_matching', False):
+        criterion, dense_hybrid_criterion = build_criterion(config)
+        criterion, dense_hybrid_criterion = criterion.to(device=device), dense_hybrid_criterion.to(device=device)
+    else:
+        criterion, dense_hybrid_criterion = build_criterion(config).to(device=device), None
+
+    optim = torch.optim.AdamW(model.parameters(), lr=float(config['lr']), weight_decay=float(config['weight_decay']))
+    scheduler = torch.optim.lr_scheduler.StepLR(optim, config['lr_drop'], config['lr_gamma'])
+    model = wrap_model(model, device, config)
+    trainer = Trainer(
+        train_loader, None, model, criterion, optim, scheduler, device, config,
+        path_to_run, 0, 0, dense_hybrid_criterion
+    )
+    return trainer, model, optim
+
+def run_epoch(config, device, path_to_run, checkpoint=None):
+    """Trains the first epoch, continued from the mid-epoch checkpoint if given, and returns model and optimizer state."""
+    seed_everything(config['seed'] if checkpoint is None else config['seed'] + 1)  # resumed run has to restore all state from the checkpoint
+    trainer, model, optim = build_trainer(config, device, path_to_run)
+    if checkpoint is not None:
+        unwrap_model(model).load_state_dict(checkpoint['model_state_dict'])
+        optim.load_state_dict(checkpoint['optimizer_state_dict'])
+        trainer.load_resume_state(checkpoint)
+
+    trainer._train_one_epoch(1)
+    trainer._checkpoint_writer.close()
+    barrier()
+    return copy.deepcopy(unwrap_model(model).state_dict()), copy.deepcopy(optim.state_dict())
+
+def tensors_equal(state_a, state_b):
+    if isinstance(state_a, dict):
+        return state_a.keys() == state_b.keys() and all(tensors_equal(state_a[key], state_b[key]) for key in state_a)
+    if isinstance(state_a, (list, tuple)):
+        return len(state_a) == len(state_b) and all(tensors_equal(a, b) for a, b in zip(state_a, state_b))
+    if isinstance(state_a, torch.Tensor):
+        return torch.equal(state_a, state_b)
+    return state_a == state_b
+
+def check_resume(config, args):
+    device = init_distributed(config)
+    config['checkpoint_every_n_steps'] = args.step
+    config['async_checkpointing'] = False
+
+    num_steps = len(get_loader(config, 'train'))
+    if num_steps <= args.step:
+        print(f'The epoch only has {num_steps} steps, choose --step < {num_steps}.')
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_run = Path(broadcast_object(tmp_dir))  # all ranks write to the directory of rank 0
+        model_ref, optim_ref = run_epoch(config, device, path_to_run)
+        checkpoint = torch.load(path_to_run / 'model_last.pt', map_location=device)
+        resumed_step = checkpoint['step']
+        model_resumed, optim_resumed = run_epoch(config, device, path_to_run, checkpoint)
+
+    model_ok, optim_ok = tensors_equal(model_ref, model_resumed), tensors_equal(optim_ref, optim_resumed)
+    if is_main_process():
+        print(f'* {model_ok} model state after resuming from step {resumed_step} of {num_steps}')
+        print(f'* {optim_ok} optimizer state after resuming from step {resumed_step} of {num_steps}')
+    cleanup_distributed()
+    if not (model_ok and optim_ok):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Add necessary args
+    parser.add_argument("--config", type=str, required=True, help="Config to use for training located in /config.")
+    parser.add_argument("--step", type=int, default=2, help="Optimizer steps between mid-epoch checkpoints, the last one of the epoch is resumed.")
+    parser.add_argument("--cpu", action='store_true', help="Run on CPU, GPU kernels like grid_sample are not deterministic.")
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    if args.cpu:
+        config['device'] = 'cpu'
+
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
+
+    check_resume(config, args)
@@ -0,0 +1,140 @@
+"""Script to estimate the FLOPs, parameters and activation memory of configs before training, without a GPU or data.
+
+Usage:
+    python scripts/cost_model.py --configs CL_methods/ABDOMENCT-1K_WORD/msa_def_detr_WORD
+    python scripts/cost_model.py --configs config/CL_methods/ABDOMEN_ATLAS/*.yaml --data_info data_info.json --depth 3
+    python scripts/cost_model.py --configs CL_methods/ABDOMENCT-1K_WORD/msa_def_detr_WORD --data_sizes 160,160,128 224,224,160
+"""
+
+import os, sys
+import argparse
+import contextlib
+import copy
+import json
+import traceback
+from pathlib import Path
+
+import torch
+import yaml
+import warnings
+warnings.filterwarnings("ignore", message="TypedStorage")
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+
+from transoar.utils.io import get_config, load_json, write_json, temporary_data_dir
+from transoar.utils.benchmark import get_environment, format_table
+from transoar.utils.cost_model import CostModel
+from transoar.models.transoarnet import TransoarNet
+from transoar.models.organdetr_net import OrganDetrNet
+
+MODELS = {'TransoarNet': TransoarNet, 'OrganDetrNet': OrganDetrNet}
+COLUMNS = ['params', 'inference_gflops', 'inference_peak_mb', 'train_gflops', 'train_saved_mb']
+HEADER = ['params [M]', 'inference [GFLOPs]', 'inference peak [MB]', 'train [GFLOPs]', 'train saved [MB]']
+SUMMARY = ['params', 'inference_gflops', 'inference_peak_mb', 'train_gflops', 'train_peak_mb', 'train_total_mb']
+SUMMARY_HEADER = ['params [M]', 'inference [GFLOPs]', 'inference peak [MB]', 'train [GFLOPs]', 'train peak [MB]', 'train total [MB]']
+
+
+def load_config(config_name, path_to_data_info, path_to_data):
+    """Loads a config from ./config by name or path.
+
+    A given dataset info is written to path_to_data, which has to be $TRANSOAR_DATA, since the models read it.
+    """
+    config_name = str(Path(config_name).with_suffix('')).removeprefix('config/')
+    if path_to_data_info is None:
+        return config_name, get_config(config_name)
+
+    with open(Path('config') / (config_name + '.yaml'), 'r') as stream:
+        config = yaml.safe_load(stream)
+    data_info = load_json(path_to_data_info)
+    (path_to_data / config['dataset']).mkdir(parents=True, exist_ok=True)
+    write_json(data_info, path_to_data / config['dataset'] / 'data_info.json')
+    config.update(data_info)
+    return config_name, config
+
+def synthetic_targets(config, batch_size):
+    """Returns one box per class, e.g., for the denoising queries of the training step."""
+    num_classes = len(config['labels'])
+    return [{
+        'boxes': torch.cat([torch.full((num_classes, 3), 0.5), torch.full((num_classes, 3), 0.2)], dim=1),
+        'labels': torch.arange(1, num_classes + 1)
+    } for _ in range(batch_size)]
+
+def estimate(config, batch_size, depth):
+    data_size = config['backbone']['data_size']
+    cost_model = CostModel(lambda: MODELS[config['model']](copy.deepcopy(config)))
+    return cost_model.report(
+        [1, config['backbone']['in_channels'], *data_size], [batch_size, config['backbone']['in_channels'], *data_size],
+        targets=synthetic_targets(config, batch_size), depth=depth
+    )
+
+def format_costs(costs):
+    """Formats the costs of modules or stages, omitting the ones without any."""
+    rows = [
+        [name, costs_['params'] / 1e6] + [costs_[column] for column in COLUMNS[1:]]
+        for name, costs_ in costs.items() if any(costs_[column] for column in COLUMNS)
+    ]
+    return format_table(['module'] + HEADER, rows)
+
+def run(args):
+    rows, results = [], []
+    # A given dataset info is read by the models from a temporary $TRANSOAR_DATA
+    with temporary_data_dir() if args.data_info is not None else contextlib.nullcontext() as path_to_data:
+        for config_name in args.configs:
+            config_name, config = load_config(config_name, args.data_info, path_to_data)
+            for data_size in args.data_sizes or [None]:
+                config_ = copy.deepcopy(config)
+                if data_size is not None:
+                    config_['backbone']['data_size'] = list(data_size)
+                batch_size = args.batch_size or config_['batch_size']
+                result = {
+                    'config': config_name, 'model': config_['model'], 'backbone': config_['backbone']['name'],
+                    'data_size': 'x'.join(str(size) for size in config_['backbone']['data_size']), 'batch_size': batch_size
+                }
+                try:
+                    result.update(estimate(config_, batch_size, args.depth))
+                except Exception as error:     # e.g., a backbone not supported by the neck
+                    result['error'] = f'{type(error).__name__}: {str(error).splitlines()[0] if str(error) else ""}'
+                    if args.verbose:
+                        traceback.print_exc()
+
+                print(f"\n{config_name} ({result['data_size']}, batch size {batch_size})")
+                if 'error' not in result:
+                    print(format_costs(result['modules']))
+                    print()
+                    print(format_costs(result['stages']))
+                print(json.dumps({key: value for key, value in result.items() if key not in ['modules', 'stages']}))
+                results.append(result)
+
+                summary = {key: result[key] for key in SUMMARY if key in result}
+                if 'params' in summary:
+                    summary['params'] /= 1e6
+                rows.append([result[key] for key in ['config', 'data_size', 'batch_size']] + [
+                    summary.get(key, '-') for key in SUMMARY
+                ] + [result.get('error', '')])
+
+    print()
+    print(format_table(['config', 'data_size', 'batch'] + SUMMARY_HEADER + ['error'], rows))
+
+    if args.out is not None:
+        write_json({'environment': get_environment(), 'results': results}, args.out)
+        print(f'Saved results to {args.out}.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Add necessary args
+    parser.add_argument('--configs', nargs='+', required=True, help='Names or paths of configs in ./config, e.g., CL_methods/ABDOMEN_ATLAS/msa_def_detr_ABDOMEN_ATLAS.')
+    parser.add_argument('--data_info', type=str, default=None, help='Path to the data_info.json of the dataset, defaults to the one in $TRANSOAR_DATA.')
+    parser.add_argument('--data_sizes', nargs='+', default=None, type=lambda size: tuple(int(item) for item in size.split(',')),
+                        help='Input sizes, e.g., 160,224,224. Defaults to the data size of the config.')
+    parser.add_argument('--batch_size', type=int, default=None, help='Batch size of the training step, defaults to the one of the config.')
+    parser.add_argument('--depth', type=int, default=2, help='Modules are grouped by the first depth parts of their names.')
+    parser.add_argument('--out', type=str, default=None, help='Path to save the results as JSON.')
+    parser.add_argument('--verbose', action='store_true', help='Print the traceback of failed configs.')
+    args = parser.parse_args()
+
+    run(args)
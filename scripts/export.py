@@ -0,0 +1,89 @@
+"""Script to export a trained detector to TorchScript or ONNX and check it against the eager model.
+
+Usage:
+    python scripts/export.py --run <run> --format torchscript
+    python scripts/export.py --run <run> --format onnx --classes liver spleen
+    python scripts/export.py --run <patch_run> --patch
+"""
+
+import os, sys
+import argparse
+from pathlib import Path
+
+import torch
+import warnings
+warnings.filterwarnings("ignore", message="TypedStorage")
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+
+from transoar.utils.io import load_json, write_json
+from transoar.models.transoarnet import TransoarNet
+from transoar.models.organdetr_net import OrganDetrNet
+from transoar.inference import get_class_ids
+from transoar.utils.checkpoint import get_checkpoint, load_model
+from transoar.export import export_model, load_exported, check_parity, OUTPUT_NAMES
+
+SUFFIXES = {'torchscript': '.pt', 'onnx': '.onnx'}
+
+MODELS = {'TransoarNet': TransoarNet, 'OrganDetrNet': OrganDetrNet}
+
+
+def run(args):
+    path_to_run = Path('./runs/' + args.run)
+    config = load_json(path_to_run / 'config.json')
+    path_to_ckpt = get_checkpoint(path_to_run, args.model_load)
+    print(f'Loading checkpoint: {path_to_ckpt}')
+
+    checkpoint = torch.load(path_to_ckpt, map_location='cpu')
+    model, _ = load_model(MODELS[config['model']](config), checkpoint, 'cpu')
+
+    class_ids = get_class_ids(config['labels'], args.classes) if args.classes else None
+    if class_ids:
+        model.set_inference_classes(class_ids)
+
+    # The exported graph is specialized to this input shape, the patches for runs of patch_train.py
+    generator = torch.Generator().manual_seed(0)
+    input_size = config['augmentation']['patch_size'] if args.patch else config['backbone']['data_size']
+    example = torch.randn(1, config['backbone']['in_channels'], *input_size, generator=generator)
+
+    path_to_export = Path(args.out) if args.out else path_to_run / 'export' / (path_to_ckpt.stem + SUFFIXES[args.format])
+    path_to_export.parent.mkdir(parents=True, exist_ok=True)
+    export_model(model, example, path_to_export, format=args.format, opset_version=args.opset)
+    print(f'Exported {args.format} model to {path_to_export}.')
+
+    # Everything needed to serve the model without the config of the run
+    write_json({
+        'format': args.format,
+        'checkpoint': str(path_to_ckpt),
+        'input_shape': list(example.shape),
+        'outputs': OUTPUT_NAMES,
+        'labels': {str(class_id): config['labels'][str(class_id)] for class_id in (class_ids or map(int, config['labels']))}
+    }, path_to_export.with_suffix('.json'))
+
+    # Compare the exported detections with the eager model and inference() on random volumes
+    inputs = [torch.randn(example.shape, generator=generator) for _ in range(args.num_checks)]
+    parity = check_parity(model, load_exported(path_to_export), inputs, atol=args.atol)
+    print(f'Parity with eager model: {parity}')
+    if not parity['passed']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Add necessary args
+    parser.add_argument('--run', required=True, type=str, help='Name of experiment in ./runs.')
+    parser.add_argument('--model_load', type=str, default='last', help='Load model from checkpoint. Options: last, best_val, best_test, epoch number.')
+    parser.add_argument('--format', type=str, default='torchscript', choices=list(SUFFIXES), help='Format of the exported model.')
+    parser.add_argument('--out', type=str, default=None, help='Path of the exported model, defaults to ./runs/<run>/export.')
+    parser.add_argument('--classes', nargs='+', default=None, help='Only detect these organs (names or class ids).')
+    parser.add_argument('--patch', action='store_true', help='Run trained with patch_train.py, exports the model for single patches.')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version.')
+    parser.add_argument('--num_checks', type=int, default=2, help='Number of random inputs of the parity check.')
+    parser.add_argument('--atol', type=float, default=1e-4, help='Tolerated difference of boxes and scores to the eager model.')
+    args = parser.parse_args()
+
+    run(args)
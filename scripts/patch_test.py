@@ -23,8 +23,10 @@ except:
     pass
 from transoar.data.patch_dataloader import get_loader
 from transoar.models.transoarnet import TransoarNet
-from transoar.evaluator import DetectionEvaluator, SegmentationEvaluator
-from transoar.inference import inference
+from transoar.evaluator import SegmentationEvaluator, get_detection_evaluator
+from transoar.inference import inference, get_class_ids
+from transoar.quantization import QUANTIZED_SUFFIX
+from transoar.utils.checkpoint import load_model
 from transoar.utils.bboxes import merge_patches
 from transoar.utils.bboxes import box_cxcyczwhd_to_xyzxyz, iou_3d
 from scripts.train import match
@@ -41,12 +43,15 @@ class Tester:
         self._per_patch = args.per_patch
         self._class_dict = self.config['labels']
         self._segm_eval = False #self.config['backbone']['use_seg_proxy_loss']
+        self._patch_batch_size = args.patch_batch_size
 
         os.environ["CUDA_VISIBLE_DEVICES"] = str(args.num_gpu)
         self._device = 'cuda' if args.num_gpu >= 0 else 'cpu'
 
         # Get path to checkpoint
-        avail_checkpoints = [path for path in path_to_run.iterdir() if 'model_' in str(path)]
+        avail_checkpoints = [
+            path for path in path_to_run.iterdir() if 'model_' in str(path) and (QUANTIZED_SUFFIX in path.stem) == args.int8
+        ]
         avail_checkpoints.sort(key=lambda x: len(str(x)))
         if args.last:
             path_to_ckpt = avail_checkpoints[0]
@@ -57,15 +62,7 @@ class Tester:
         self._set_to_eval = 'val' if args.val else 'test'
         self._test_loader = get_loader(self.config, self._set_to_eval, batch_size=1)
 
-        self._evaluator = DetectionEvaluator(
-            classes=list(self.config['labels'].values()),
-            classes_small=self.config['labels_small'],
-            classes_mid=self.config['labels_mid'],
-            classes_large=self.config['labels_large'],
-            iou_range_nndet=(0.1, 0.5, 0.05),
-            iou_range_coco=(0.5, 0.95, 0.05),
-            sparse_results=False
-        )
+        self._evaluator = get_detection_evaluator(self.config, from_data_info=False)
 
         #self._segm_evaluator = SegmentationEvaluator(seg_fg_bg=self.config['backbone']['fg_bg'],
         #                                             ce_dice=self._segm_eval, 
@@ -74,9 +71,13 @@ class Tester:
         self._model = TransoarNet(self.config).to(device=self._device)
 
         # Load checkpoint
-        checkpoint = torch.load(path_to_ckpt, map_location=self._device)
-        self._model.load_state_dict(checkpoint['model_state_dict'])
-        self._model.eval()
+        checkpoint = torch.load(path_to_ckpt, map_location='cpu')
+        self._model, self._device = load_model(self._model, checkpoint, self._device)
+
+        # Class-subset inference, queries of other classes are pruned if they are assigned by a query split
+        self._inference_classes = get_class_ids(self._class_dict, args.classes) if args.classes else None
+        if self._inference_classes and self.config.get('class_matching', False) and self.config.get('class_matching_query_split', []):
+            self._model.set_inference_classes(self._inference_classes)
 
         # Create dir to store results
         self._path_to_results = path_to_run / 'results' / path_to_ckpt.parts[-1][:-3]
@@ -88,43 +89,52 @@ class Tester:
   
     def run(self):
         per_sample_results = {}
+        num_patches, num_skipped_patches = 0, 0
         with torch.no_grad():
-            for idx, (data, mask, bboxes, seg_mask, paths, patch_pos, padded_img, patch_bbox) in enumerate(tqdm(self._test_loader)):
+            progress_bar = tqdm(self._test_loader)
+            for idx, (data, mask, bboxes, seg_mask, paths, patch_pos, padded_img, patch_bbox, num_skipped) in enumerate(progress_bar):
+                num_patches += len(data) + num_skipped
+                num_skipped_patches += num_skipped
+                progress_bar.set_postfix({'skipped_patches': f'{num_skipped_patches}/{num_patches}'})
                 
                 assert seg_mask[0].shape == padded_img.shape, f"{seg_mask.shape} - {padded_img.shape}"
                 # Put data to gpu
                 inf_out_patches = {} # track predictions for all patches of one image
                
-                for ch in range(data.shape[0]): # iterate
-                    patch_targets = {
-                        'boxes': patch_bbox[ch][0].to(dtype=torch.float, device=self._device),
-                        'labels': patch_bbox[ch][1].to(device=self._device)
-                    }
-                    patch_gt_boxes = [patch_targets['boxes'].detach().cpu().numpy()]
-                    patch_gt_classes = [patch_targets['labels'].detach().cpu().numpy()]
+                # Patches are views into the padded volume and only materialized per sub-batch
+                for start in range(0, len(data), self._patch_batch_size):
+                    data_c = data[start:start + self._patch_batch_size].to(device=self._device)
 
-                    data_c = data[ch,:].to(device=self._device)[None,:]
-                    
                     # Make prediction
                     out = self._model(data_c)
 
                     # Format out to fit evaluator and estimate best predictions per class
-                    pred_boxes, pred_classes, pred_scores = inference(out)
-                    inf_out_patches[ch] = {"pred_boxes": pred_boxes[0],
-                                       "pred_classes": pred_classes[0],
-                                       "pred_scores": pred_scores[0]}
-                    if self._save_preds and self._per_patch:
-                        save_pred_visualization(
-                            pred_boxes[0], pred_classes[0], patch_gt_boxes[0], patch_gt_classes[0], mask[0][ch][None,:], 
-                            self._path_to_vis, self._class_dict, str(idx)+"-"+str(ch)
-                        )
-                    if self._per_sample_results and self._per_patch:
-                        sample_name = paths[0].stem + f'_case{idx}-{ch}'
-                        per_sample_results[sample_name] = self.export_per_sample_results(sample_name,
-                                                                                         pred_classes,
-                                                                                         patch_gt_classes,
-                                                                                         pred_boxes,
-                                                                                         patch_gt_boxes)
+                    batch_pred_boxes, batch_pred_classes, batch_pred_scores = inference(out, classes=self._inference_classes)
+                    for b, ch in enumerate(range(start, start + data_c.shape[0])): # iterate
+                        pred_boxes, pred_classes, pred_scores = [batch_pred_boxes[b]], [batch_pred_classes[b]], [batch_pred_scores[b]]
+                        inf_out_patches[ch] = {"pred_boxes": pred_boxes[0],
+                                           "pred_classes": pred_classes[0],
+                                           "pred_scores": pred_scores[0]}
+                        if not self._per_patch:
+                            continue
+
+                        patch_gt_boxes = [patch_bbox[ch][0].to(dtype=torch.float).numpy()]
+                        patch_gt_classes = [patch_bbox[ch][1].numpy()]
+                        if self._inference_classes is not None:
+                            keep = np.isin(patch_gt_classes[0], self._inference_classes)
+                            patch_gt_boxes, patch_gt_classes = [patch_gt_boxes[0][keep]], [patch_gt_classes[0][keep]]
+                        if self._save_preds:
+                            save_pred_visualization(
+                                pred_boxes[0], pred_classes[0], patch_gt_boxes[0], patch_gt_classes[0], mask[ch], 
+                                self._path_to_vis, self._class_dict, str(idx)+"-"+str(ch)
+                            )
+                        if self._per_sample_results:
+                            sample_name = paths[0].stem + f'_case{idx}-{ch}'
+                            per_sample_results[sample_name] = self.export_per_sample_results(sample_name,
+                                                                                             pred_classes,
+                                                                                             patch_gt_classes,
+                                                                                             pred_boxes,
+                                                                                             patch_gt_boxes)
                 # Merge patches
                 #print("patch pos: ",patch_pos)
                 #print("img size: ",padded_img.shape[-3:])
@@ -135,6 +145,9 @@ class Tester:
                     }
                 gt_boxes = [targets['boxes'].detach().cpu().numpy()]
                 gt_classes = [targets['labels'].detach().cpu().numpy()]
+                if self._inference_classes is not None: # only evaluate requested organs
+                    keep = np.isin(gt_classes[0], self._inference_classes)
+                    gt_boxes, gt_classes = [gt_boxes[0][keep]], [gt_classes[0][keep]]
 
                 # Add pred to evaluator
                 self._evaluator.add(
@@ -181,6 +194,8 @@ class Tester:
                       'num_head_params': num_head_params
                       }
             metric_scores.update(num_params_dict)  # Add parameters to result log
+            metric_scores.update({'num_patches': num_patches, 'num_skipped_patches': num_skipped_patches})
+            print(f"Skipped {num_skipped_patches} of {num_patches} background patches.")
 
             write_json(metric_scores, self._path_to_results / ('results_' + self._set_to_eval + '.json'))
             if self._per_sample_results:
@@ -228,12 +243,15 @@ if __name__ == "__main__":
     parser.add_argument('--num_gpu', type=int, default=-1, help='Use model_last instead of model_best.')
     parser.add_argument('--val', action='store_true', help='Evaluate performance on test set.')
     parser.add_argument('--last', action='store_true', help='Use model_last instead of model_best.')
+    parser.add_argument('--int8', action='store_true', help='Use the INT8 checkpoints written by quantize.py, runs on CPU.')
     parser.add_argument('--save_preds', action='store_true', help='Save predictions.')
     #parser.add_argument('--save_attn_map', action='store_true', help='Saves attention maps.') # not implemented for patch-based
     parser.add_argument('--per_sample_results', action='store_true', help='Saves per sample results of predictions.')
     parser.add_argument('--per_patch', action='store_true', help='If per_sample_results is set evals results for each patch.\
                                                                   If save_preds is set → generates visualizations for every patch.')    
+    parser.add_argument('--patch_batch_size', type=int, default=1, help='Number of sliding window patches materialized and predicted at once.')
     
+    parser.add_argument('--classes', nargs='+', default=None, help='Only detect these organs (names or class ids).')
     args = parser.parse_args()
 
     tester = Tester(args)
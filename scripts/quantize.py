@@ -0,0 +1,135 @@
+"""Script to quantize a trained detector to INT8 for CPU inference and compare it with the float model.
+
+Usage:
+    python scripts/quantize.py --run <run> --num_calibration 8
+    python scripts/quantize.py --run <run> --no_conv --exclude "*.sampling_offsets"
+    python scripts/test.py --run <run> --model_load last_int8
+    python scripts/quantize.py --run <patch_run> --patch
+    python scripts/patch_test.py --run <patch_run> --int8
+"""
+
+import os, sys
+import argparse
+from pathlib import Path
+
+import torch
+from tqdm import tqdm
+import warnings
+warnings.filterwarnings("ignore", message="TypedStorage")
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+print("append to path & chdir:", base_dir)
+os.chdir(base_dir)
+sys.path.append(base_dir)
+
+from transoar.utils.io import load_json, write_json
+from transoar.utils.benchmark import measure, get_environment, format_table
+from transoar.data.dataloader import get_loader
+from transoar.data.patch_dataloader import get_loader as get_patch_loader
+from transoar.models.transoarnet import TransoarNet
+from transoar.models.organdetr_net import OrganDetrNet
+from transoar.evaluator import get_detection_evaluator
+from transoar.inference import inference
+from transoar.quantization import quantize_model, state_dict_mb, QUANTIZED_SUFFIX
+from transoar.utils.checkpoint import get_checkpoint, load_model
+
+# Metrics compared between the float and the INT8 model
+METRICS = ['mAP_coco', 'mAP_coco_s', 'mAP_coco_m', 'mAP_coco_l', 'latency_ms', 'weights_mb']
+
+MODELS = {'TransoarNet': TransoarNet, 'OrganDetrNet': OrganDetrNet}
+
+
+@torch.no_grad()
+def evaluate(model, loader, config):
+    """Returns the detection metrics of model on all cases of loader, like test.py."""
+    evaluator = get_detection_evaluator(config)
+    for data, _, bboxes, *_ in tqdm(loader):
+        pred_boxes, pred_classes, pred_scores = inference(model(data))
+        evaluator.add(
+            pred_boxes=pred_boxes,
+            pred_classes=pred_classes,
+            pred_scores=pred_scores,
+            gt_boxes=[bboxes[0][0].float().numpy()],
+            gt_classes=[bboxes[0][1].numpy()]
+        )
+    return evaluator.eval()
+
+def run(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    path_to_run = Path('./runs/' + args.run)
+    config = load_json(path_to_run / 'config.json')
+    path_to_ckpt = get_checkpoint(path_to_run, args.model_load)
+    print(f'Loading checkpoint: {path_to_ckpt}')
+
+    checkpoint = torch.load(path_to_ckpt, map_location='cpu')
+    model, _ = load_model(MODELS[config['model']](config), checkpoint, 'cpu')
+
+    # Activation ranges of the convolutions are observed on a few training cases, not on the evaluated ones
+    calibration_loader = (get_patch_loader if args.patch else get_loader)(config, 'train', batch_size=1)
+    calibration_data = []
+    for data, *_ in calibration_loader:
+        calibration_data.append(data)
+        if len(calibration_data) == args.num_calibration:
+            break
+    quantized_model, settings = quantize_model(
+        model, calibration_data, linear=not args.no_linear, conv=not args.no_conv, exclude=args.exclude, engine=args.engine
+    )
+    print(f'Quantized model with {settings}.')
+
+    path_to_quantized = path_to_run / (path_to_ckpt.stem + QUANTIZED_SUFFIX + '.pt')
+    torch.save({
+        'epoch': checkpoint.get('epoch'),
+        'model_state_dict': quantized_model.state_dict(),
+        'quantization': settings,
+        'source_checkpoint': str(path_to_ckpt)
+    }, path_to_quantized)
+    print(f'Saved quantized model to {path_to_quantized}.')
+
+    # Compare accuracy, latency and size of the weights of both models. Patch runs are evaluated with
+    # the sliding window inference of patch_test.py --int8, so only latency and size are compared here.
+    set_to_eval = 'val' if args.val else 'test'
+    loader = get_loader(config, set_to_eval, batch_size=1, test_script=not args.val) if not args.patch else None
+    example = next(iter(loader))[0] if not args.patch else calibration_data[0]
+    results = {}
+    for name, model_ in [('fp32', model), ('int8', quantized_model)]:
+        results[name] = evaluate(model_, loader, config) if not (args.no_eval or args.patch) else {}
+        with torch.no_grad():
+            results[name]['latency_ms'] = measure(lambda: model_(example), repeats=args.repeats, warmup=1)['median_ms']
+        results[name]['weights_mb'] = state_dict_mb(model_)
+    results['delta'] = {
+        metric: results['int8'][metric] - results['fp32'][metric] for metric in METRICS if metric in results['fp32']
+    }
+    print(format_table(
+        ['metric', 'fp32', 'int8', 'delta'],
+        [[metric, results['fp32'][metric], results['int8'][metric], results['delta'][metric]] for metric in results['delta']]
+    ))
+
+    path_to_results = path_to_run / 'results' / path_to_quantized.stem
+    path_to_results.mkdir(parents=True, exist_ok=True)
+    write_json(
+        {'environment': get_environment(), 'settings': settings, 'calibration_cases': len(calibration_data), **results},
+        path_to_results / ('quantization_' + set_to_eval + '.json')
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # Add necessary args
+    parser.add_argument('--run', required=True, type=str, help='Name of experiment in ./runs.')
+    parser.add_argument('--model_load', type=str, default='last', help='Load model from checkpoint. Options: last, best_val, best_test, epoch number.')
+    parser.add_argument('--num_calibration', type=int, default=8, help='Number of training cases to calibrate the convolutions on.')
+    parser.add_argument('--no_linear', action='store_true', help='Keep the linear layers in float.')
+    parser.add_argument('--no_conv', action='store_true', help='Keep the 3D convolutions in float.')
+    parser.add_argument('--exclude', nargs='+', default=[], help='Patterns of names of modules kept in float, e.g., "*.sampling_offsets".')
+    parser.add_argument('--engine', type=str, default=None, help='Quantized engine, e.g., x86, fbgemm or qnnpack.')
+    parser.add_argument('--val', action='store_true', help='Evaluate on the val instead of the test set.')
+    parser.add_argument('--no_eval', action='store_true', help='Only compare latency and size.')
+    parser.add_argument('--patch', action='store_true', help='Run trained with patch_train.py, calibrates on training patches and only compares latency and size.')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of timed inferences.')
+    parser.add_argument('--threads', type=int, default=None, help='Number of torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
@@ -26,8 +26,9 @@ import matplotlib.pyplot as plt
 from transoar.data.dataloader import get_loader
 # from transoar.models.transoarnet import TransoarNet
 from transoar.models.organdetr_net import OrganDetrNet
-from transoar.evaluator import DetectionEvaluator, SegmentationEvaluator
-from transoar.inference import inference
+from transoar.evaluator import SegmentationEvaluator, get_detection_evaluator
+from transoar.inference import inference, get_class_ids
+from transoar.utils.checkpoint import get_checkpoint, load_model
 from transoar.utils.bboxes import box_cxcyczwhd_to_xyzxyz, iou_3d
 from scripts.train import match
 
@@ -54,49 +55,14 @@ class Tester:
         self._device = 'cuda' if args.num_gpu >= 0 else 'cpu'
 
         # Get path to checkpoint
-        avail_checkpoints = [path for path in path_to_run.iterdir() if 'model_' in str(path)]
-        avail_checkpoints.sort(key=lambda x: len(str(x)))
-
-        for a in avail_checkpoints:
-            if args.model_load == str(a):
-                path_to_ckpt = a
-                break
-        else:
-            if args.model_load == 'last':
-                path_to_ckpt = [path for path in avail_checkpoints if 'last' in str(path)]
-            elif args.model_load == 'best':
-                path_to_ckpt = [path for path in avail_checkpoints if 'best' in str(path)]
-            elif args.model_load == 'best_val':
-                path_to_ckpt = [path for path in avail_checkpoints if 'best_val' in str(path)]
-            elif args.model_load == 'best_test':
-                path_to_ckpt = [path for path in avail_checkpoints if 'best_test' in str(path)]
-            elif isinstance(int(args.model_load), int):
-                path_to_ckpt = [path for path in avail_checkpoints if args.model_load in str(path)]
-
-        
-            if len(path_to_ckpt) == 0:
-                raise ValueError('No checkpoint found for specified epoch.')
-            path_to_ckpt = path_to_ckpt[0]
-
+        path_to_ckpt = get_checkpoint(path_to_run, args.model_load)
         print(f'Loading checkpoint: {path_to_ckpt}')
 
         # Build necessary components
         self._set_to_eval = 'val' if args.val else 'test'
         self._test_loader = get_loader(self.config, self._set_to_eval, batch_size=1, test_script=True)
 
-        data_path = os.environ.get('TRANSOAR_DATA')
-        data_dir = Path(data_path).resolve()
-        self.dataset1_config = load_json(data_dir / self.config['dataset'] / "data_info.json")
-
-        self._evaluator = DetectionEvaluator(
-            classes=list(self.dataset1_config['labels'].values()),
-            classes_small=self.dataset1_config['labels_small'],
-            classes_mid=self.dataset1_config['labels_mid'],
-            classes_large=self.dataset1_config['labels_large'],
-            iou_range_nndet=(0.1, 0.5, 0.05),
-            iou_range_coco=(0.5, 0.95, 0.05),
-            sparse_results=False
-        )
+        self._evaluator = get_detection_evaluator(self.config)
 
         self._segm_evaluator = SegmentationEvaluator(seg_fg_bg=self.config['backbone']['fg_bg'],
                                                      ce_dice=self._segm_eval, 
@@ -105,7 +71,7 @@ class Tester:
         self._model = OrganDetrNet(self.config).to(device=self._device)
 
         # Load checkpoint
-        checkpoint = torch.load(path_to_ckpt, map_location=self._device)
+        checkpoint = torch.load(path_to_ckpt, map_location='cpu')
         if self.config['backbone']['name'].lower() == "resnet": # fix renamed projection layers for runs pre-e23ce8b4
             fixed_dict = {}
             for k, v in checkpoint['model_state_dict'].items():
@@ -119,14 +85,24 @@ class Tester:
                     fixed_dict[k] = v
             checkpoint['model_state_dict'] = fixed_dict
 
-        try:
-            self._model.load_state_dict(checkpoint['model_state_dict'],strict=True)
-        except Exception as e:
-            print("These layers could not be loaded: ", e)
-            print("Loading pretrained model with strict=False ...")
-            self._model.load_state_dict(checkpoint['model_state_dict'],strict=False)
-        
-        self._model.eval()
+        self._model, self._device = load_model(self._model, checkpoint, self._device, strict=False)
+
+        # Class-subset inference, queries of other classes are pruned if they are assigned by a query split
+        self._inference_classes = get_class_ids(self._class_dict, args.classes) if args.classes else None
+        if self._inference_classes and self.config.get('class_matching', False) and self.config.get('class_matching_query_split', []):
+            self._model.set_inference_classes(self._inference_classes)
+
+        # Adaptive inference, the decoder stops once the predictions of consecutive layers are stable
+        self._results_suffix = ''
+        if args.early_exit_iou is not None:
+            self._model.set_early_exit(args.early_exit_iou, args.early_exit_score, args.early_exit_min_layers)
+            self._results_suffix = f'_early_exit_{args.early_exit_iou}_{args.early_exit_score}'
+
+        # Queries that are background after prune_layer decoder layers are not decoded any further
+        if args.prune_threshold is not None:
+            assert not self._save_attn_map, "sampling locations of pruned queries are not exported"
+            self._model.set_query_pruning(args.prune_threshold, args.prune_layer)
+            self._results_suffix += f'_prune_{args.prune_layer}_{args.prune_threshold}'
 
         # Create dir to store results
         self._path_to_results = path_to_run / 'results' / path_to_ckpt.parts[-1][:-3]
@@ -159,6 +135,8 @@ class Tester:
                         lambda self, input, output: (backbone_attn_weights_list.append(output[-1].detach().clone())))
                         )
         per_sample_results = {}
+        decoder_layers = {}
+        active_queries = {}
         with torch.no_grad():
             for idx, (data, mask, bboxes, seg_mask, paths) in enumerate(tqdm(self._test_loader)):
                 # Put data to gpu
@@ -176,15 +154,22 @@ class Tester:
 
                 # Make prediction
                 out = self._model(data)
+                if 'num_decoder_layers' in out:
+                    decoder_layers[paths[0].stem + f'_case{idx}'] = out['num_decoder_layers']
+                if 'num_active_queries' in out:
+                    active_queries[paths[0].stem + f'_case{idx}'] = out['num_active_queries']
 
                 # Format out to fit evaluator and estimate best predictions per class
                 if self._save_attn_map:
-                    pred_boxes, pred_classes, pred_scores, query_ids = inference(out, vis_queries=self._save_attn_map)
+                    pred_boxes, pred_classes, pred_scores, query_ids = inference(out, vis_queries=self._save_attn_map, classes=self._inference_classes)
                 else:
-                    pred_boxes, pred_classes, pred_scores = inference(out)
+                    pred_boxes, pred_classes, pred_scores = inference(out, classes=self._inference_classes)
                     
                 gt_boxes = [targets['boxes'].detach().cpu().numpy()]
                 gt_classes = [targets['labels'].detach().cpu().numpy()]
+                if self._inference_classes is not None: # only evaluate requested organs
+                    keep = np.isin(gt_classes[0], self._inference_classes)
+                    gt_boxes, gt_classes = [gt_boxes[0][keep]], [gt_classes[0][keep]]
 
                 # Add pred to evaluator
                 self._evaluator.add(
@@ -409,7 +394,15 @@ class Tester:
                       }
             metric_scores.update(num_params_dict)  # Add parameters to result log
 
-            write_json(metric_scores, self._path_to_results / ('results_' + self._set_to_eval + '.json'))
+            if decoder_layers: # latency proxy of early exit
+                metric_scores['mean_decoder_layers'] = float(np.mean(list(decoder_layers.values())))
+                write_json(decoder_layers, self._path_to_results / ('decoder_layers_' + self._set_to_eval + self._results_suffix + '.json'))
+
+            if active_queries: # queries decoded per layer with query pruning
+                metric_scores['mean_active_queries'] = float(np.mean([np.mean(queries) for queries in active_queries.values()]))
+                write_json(active_queries, self._path_to_results / ('active_queries_' + self._set_to_eval + self._results_suffix + '.json'))
+
+            write_json(metric_scores, self._path_to_results / ('results_' + self._set_to_eval + self._results_suffix + '.json'))
             if self._per_sample_results:
                 write_json(per_sample_results, self._path_to_results / ('per_sample_results_' + self._set_to_eval + '.json'))
             
@@ -429,6 +422,12 @@ if __name__ == "__main__":
     parser.add_argument('--vis_mode', type=str, default="o3d", help='Set type of visualization. \'o3d\' (default) or \'nii\' .')
     parser.add_argument('--exp_img', action='store_true', help='Exports input image as nii.gz. Only works with vis_mode==nii.')
     parser.add_argument('--save_msa_attn_map', action='store_true', help='Exports attn weights of msa backbone as npy.')
+    parser.add_argument('--classes', nargs='+', default=None, help='Only detect these organs (names or class ids).')
+    parser.add_argument('--early_exit_iou', type=float, default=None, help='Stop decoding once the boxes of consecutive layers have this IoU.')
+    parser.add_argument('--early_exit_score', type=float, default=0.05, help='Max. score change between consecutive layers for early exit.')
+    parser.add_argument('--early_exit_min_layers', type=int, default=1, help='Number of decoder layers that run before early exit.')
+    parser.add_argument('--prune_threshold', type=float, default=None, help='Prune queries from the decoder above this background probability.')
+    parser.add_argument('--prune_layer', type=int, default=1, help='Number of decoder layers that decode all queries before pruning.')
     args = parser.parse_args()
 
     tester = Tester(args)
@@ -16,6 +16,11 @@ import monai, re
 
 from transoar.trainer_CL import Trainer_CL
 from transoar.data.dataloader import get_loader
+from transoar.data.loader_tuning import get_tuned_loader_settings
+from transoar.utils.distributed import init_distributed, wrap_model, is_main_process, barrier
+from transoar.utils.preemption import (
+    install_preemption_handler, was_preempted, clear_preempted, run_training
+)
 from transoar.utils.io import get_config, write_json, get_meta_data
 # from transoar.models.transoarnet import TransoarNet
 from transoar.models.organdetr_net import OrganDetrNet
@@ -106,8 +111,8 @@ def match(n, keywords):
     return out
 
 def train(config, args):
-    os.environ["CUDA_VISIBLE_DEVICES"] = config['device'][-1]
-    device = 'cuda'
+    device = init_distributed(config) # multi-process if launched with torchrun
+    install_preemption_handler(config.get('preemption_signals', ['SIGTERM', 'SIGUSR1']))
 
     # if device == 'cuda':
     #     # use bfloat16 for the entire notebook
@@ -117,8 +122,14 @@ def train(config, args):
     #         torch.backends.cuda.matmul.allow_tf32 = True
     #         torch.backends.cudnn.allow_tf32 = True
 
+    path_to_run = Path(os.getcwd()) / 'runs' / config['experiment_name']
+    resume = config.get('resume', False) or args.resume or was_preempted(path_to_run)  # auto-resume after preemption
+
     # Build necessary components
     train_loader = get_loader(config, 'train')
+    if config.get('autotune_loader', False):  # chosen settings are saved in config.json and reused when resuming
+        config.update(get_tuned_loader_settings(train_loader, config, device, path_to_run, resume))
+        train_loader = get_loader(config, 'train')
 
     if config['overfit']:
         val_loader = get_loader(config, 'train')
@@ -201,8 +212,8 @@ def train(config, args):
 
 
     # Init logging
-    path_to_run = Path(os.getcwd()) / 'runs' / config['experiment_name']
-    path_to_run.mkdir(exist_ok=True)
+    if is_main_process():
+        path_to_run.mkdir(exist_ok=True)
 
     # Start CL approach from old model if not mixing datasets training
     if config["mixing_datasets"] is False and config["CL"] is True:
@@ -230,10 +241,10 @@ def train(config, args):
         print("Main model loaded.")
 
     # Load checkpoint if applicable
-    if config.get('resume', False) or args.resume:
+    if resume:
         ckpt_file = get_last_ckpt(path_to_run)
         print(f'[+] loading ckpt {ckpt_file} ...')
-        checkpoint = torch.load(Path(ckpt_file))
+        checkpoint = torch.load(Path(ckpt_file), map_location=device)
 
         checkpoint['scheduler_state_dict']['step_size'] = config['lr_drop']
 
@@ -295,7 +306,10 @@ def train(config, args):
     except:
         pass
 
-    write_json(config, path_to_run / 'config.json')
+    if is_main_process():
+        write_json(config, path_to_run / 'config.json')
+    barrier()
+    clear_preempted(path_to_run)
 
     # Load auxiliary model and old model if applicable
     if config["mixing_datasets"] or config["CL_replay"] or config["CL"] is False or (config["CL"] is True and
@@ -346,12 +360,17 @@ def train(config, args):
         for param in old_model.parameters():
             param.requires_grad = False
 
+    # Gradients are all-reduced across ranks in distributed training
+    model = wrap_model(model, device, config)
+
     # Build trainer and start training
     trainer = Trainer_CL(
         train_loader, val_loader, test_loader, model, criterion, optim, scheduler, device, config, 
         path_to_run, epoch, metric_start_val, metric_start_test, dense_hybrid_criterion, aux_model, old_model
     )
-    trainer.run()
+    if resume:
+        trainer.load_resume_state(checkpoint)  # scaler and position in an interrupted epoch
+    run_training(trainer, config)  # exits with the requeue code on preemption
         
 
 if __name__ == "__main__":
@@ -368,10 +387,11 @@ if __name__ == "__main__":
     config = get_config(args.config)
 
     # To get reproducable results
-    torch.manual_seed(config['seed'])
-    np.random.seed(config['seed'])
-    monai.utils.set_determinism(seed=config['seed'])
-    random.seed(config['seed'])
+    seed = config['seed'] + int(os.environ.get('RANK', 0)) # different augmentations per rank
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    monai.utils.set_determinism(seed=seed)
+    random.seed(seed)
 
     torch.backends.cudnn.benchmark = False  # performance vs. reproducibility
     torch.backends.cudnn.deterministic = True
@@ -0,0 +1,110 @@
+"""Coarse-to-fine cascade inference, refining small organs with a patch model on high-resolution crops."""
+
+import itertools
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from transoar.inference import inference
+from transoar.utils.bboxes import merge_patches
+
+
+def resize_volume(volume, size):
+    """Resizes a volume of shape [C, X, Y, Z] to the input size of the coarse model, returns a batch of one."""
+    return F.interpolate(volume[None].float(), size=tuple(size), mode='trilinear', align_corners=False)
+
+def crop_positions(boxes, image_size, patch_size, margin=0.25):
+    """Returns the offsets of the crops of patch_size covering each box and its margin.
+
+    A box fitting into a patch is covered by one crop centered on it, larger boxes by crops
+    overlapping by half a patch. Crops are shifted into the image where possible.
+
+    Args:
+        boxes: A np.array of shape [N, 6] with boxes in the normalized cxcyczwhd format.
+        image_size: The spatial size of the high-resolution image.
+        patch_size: The spatial size of a crop.
+        margin: Context added on each side of a box, relative to its size.
+
+    Returns:
+        A tensor of shape [num_crops, 3] containing the unique offsets of the crops.
+    """
+    image_size, patch_size = np.asarray(image_size), np.asarray(patch_size)
+    positions = set()
+    for box in boxes:
+        center, extent = box[:3] * image_size, box[3:] * image_size * (1 + 2 * margin)
+        axis_positions = []
+        for center_, extent_, image_size_, patch_size_ in zip(center, extent, image_size, patch_size):
+            start, end = center_ - max(extent_, patch_size_) / 2, center_ + max(extent_, patch_size_) / 2 - patch_size_
+            num_crops = int(np.ceil((end - start) / (patch_size_ / 2))) + 1 if end > start else 1
+            axis_positions.append([
+                int(np.clip(round(position), 0, max(image_size_ - patch_size_, 0))) for position in np.linspace(start, end, num_crops)
+            ])
+        positions.update(itertools.product(*axis_positions))
+    return torch.tensor(sorted(positions), dtype=torch.long).reshape(-1, 3)
+
+def extract_crops(volume, positions, patch_size):
+    """Returns the crops of volume [C, X, Y, Z] at positions as a batch, zero padded at the image border."""
+    crops = []
+    for x, y, z in positions.tolist():
+        crop = volume[:, x:x + patch_size[0], y:y + patch_size[1], z:z + patch_size[2]]
+        padding = [0, patch_size[2] - crop.shape[3], 0, patch_size[1] - crop.shape[2], 0, patch_size[0] - crop.shape[1]]
+        crops.append(F.pad(crop, padding, mode='constant', value=0))
+    return torch.stack(crops).float()
+
+@torch.no_grad()
+def cascade_inference(
+    coarse_model, patch_model, volume, coarse_size, patch_size, fine_classes, merge_mode='custom',
+    config=None, margin=0.25, patch_batch_size=1, device='cpu'
+):
+    """Detects all organs at low resolution and refines fine_classes on high-resolution crops.
+
+    The coarse model localizes all organs in the resized volume. Crops around the boxes of the
+    fine classes are taken from the high-resolution volume, the patch model predicts on them and
+    merge_patches() combines their predictions. Predictions of the fine classes replace the coarse
+    ones, classes the patch model misses keep their coarse prediction.
+
+    Args:
+        coarse_model: A detector trained on volumes of coarse_size, e.g., OrganDetrNet.
+        patch_model: A detector trained on high-resolution patches, e.g., TransoarNet of a patch run.
+        volume: The high-resolution volume of shape [C, X, Y, Z].
+        coarse_size: The input size of the coarse model.
+        patch_size: The input size of the patch model.
+        fine_classes: Class ids refined by the patch model, e.g., the small organs.
+        merge_mode: Mode of merge_patches().
+        config: Config of the patch run, providing the organ size groups for merge_patches().
+        margin: Context around the coarse boxes, relative to their size.
+        patch_batch_size: Number of crops predicted at once.
+        device: Device the models run on.
+
+    Returns:
+        The boxes, classes and scores like inference() for a batch of one and a dict containing
+        the coarse predictions and the crop offsets.
+    """
+    coarse_boxes, coarse_classes, coarse_scores = inference(coarse_model(resize_volume(volume, coarse_size).to(device)))
+    coarse_boxes, coarse_classes, coarse_scores = coarse_boxes[0], coarse_classes[0], coarse_scores[0]
+
+    refine = np.isin(coarse_classes, fine_classes)
+    positions = crop_positions(coarse_boxes[refine], volume.shape[-3:], patch_size, margin)
+    info = {'coarse': (coarse_boxes, coarse_classes, coarse_scores), 'crop_positions': positions}
+    if positions.shape[0] == 0:
+        return [coarse_boxes], [coarse_classes], [coarse_scores], info
+
+    crops = extract_crops(volume, positions, patch_size)
+    predictions = {}
+    for start in range(0, crops.shape[0], patch_batch_size):
+        batch_boxes, batch_classes, batch_scores = inference(patch_model(crops[start:start + patch_batch_size].to(device)))
+        for crop_id, (boxes, classes, scores) in enumerate(zip(batch_boxes, batch_classes, batch_scores), start):
+            predictions[crop_id] = {'pred_boxes': boxes, 'pred_classes': classes, 'pred_scores': scores}
+    fine_boxes, fine_classes_, fine_scores = merge_patches(
+        predictions, positions, patch_size, volume.shape[-3:], mode=merge_mode, config=config
+    )
+
+    # Fine predictions of the refined classes replace the coarse ones
+    refined = np.isin(fine_classes_[0], coarse_classes[refine])
+    keep = ~np.isin(coarse_classes, fine_classes_[0][refined])
+    boxes = np.concatenate([coarse_boxes[keep], fine_boxes[0][refined]])
+    classes = np.concatenate([coarse_classes[keep], fine_classes_[0][refined]])
+    scores = np.concatenate([coarse_scores[keep], fine_scores[0][refined]])
+    order = np.argsort(classes, kind='stable')
+    return [boxes[order]], [classes[order]], [scores[order]], info
@@ -5,6 +5,7 @@ from torch.utils.data import DataLoader
 
 from transoar.data.dataset import TransoarDataset
 from transoar.utils.bboxes import segmentation2bbox
+from transoar.utils.distributed import get_sampler
 
 def get_loader(config, split, batch_size=None, test_script=False):
     batch_size = batch_size or config['batch_size'] # Default batch size
@@ -14,36 +15,36 @@ def get_loader(config, split, batch_size=None, test_script=False):
     # Test script
     if test_script:
         dataset = TransoarDataset(config, split, dataset=1, selected_samples=None, test_script=True)
-        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=config['num_workers'], collate_fn=collator)
+        return build_loader(dataset, batch_size, shuffle, config, collator)
 
     # Test split if CL_reg, CL_replay or mixing_datasets is True
     if split == 'test' and (config.get("CL_reg") or config.get("CL_replay") or config.get("mixing_datasets") or config.get("test")):
         dataset_1 = TransoarDataset(config, split, dataset=1)
         dataset_2 = TransoarDataset(config, split, dataset=2)
-        dataloader_1 = DataLoader(dataset_1, batch_size=batch_size, shuffle=shuffle, num_workers=config['num_workers'], collate_fn=collator)
-        dataloader_2 = DataLoader(dataset_2, batch_size=batch_size, shuffle=shuffle, num_workers=config['num_workers'], collate_fn=collator)
+        dataloader_1 = build_loader(dataset_1, batch_size, shuffle, config, collator)
+        dataloader_2 = build_loader(dataset_2, batch_size, shuffle, config, collator)
         return (dataloader_1, dataloader_2)
 
     # CL_reg training or validation
     if config.get("CL_reg") and not config.get("CL_replay") and not config.get("mixing_datasets"):
         dataset = TransoarDataset(config, split, dataset=1) # Take the dataset of task 2 for CL_reg
-        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=config['num_workers'], collate_fn=collator)
+        return build_loader(dataset, batch_size, shuffle, config, collator)
 
     # CL_replay training or validation
     if config.get("CL_replay") and not config.get("CL_reg") and not config.get("mixing_datasets"):
         dataset = TransoarDataset(config, split, dataset=2 if split == 'train' else 1) # Take the dataset of task 1 for CL_replay
         batch_size = 1 if split == 'train' else batch_size
-        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=config['num_workers'], collate_fn=collator)
+        return build_loader(dataset, batch_size, shuffle, config, collator)
 
     # Mixing datasets training
     if config.get("mixing_datasets") and not config.get("CL_reg") and not config.get("CL_replay"):
         dataset = TransoarDataset(config, split) # Normal training
-        return DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=config['num_workers'], collate_fn=collator)
+        return build_loader(dataset, batch_size, False, config, collator, group_size=2 if split == 'train' else 1) # keep the interleaved pairs together
 
     dataset = TransoarDataset(config, split) # Normal training
 
     # Return dataloader with collator
-    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=config['num_workers'], collate_fn=collator)
+    return build_loader(dataset, batch_size, shuffle, config, collator)
 
 
 
@@ -55,13 +56,27 @@ def get_loader_CLreplay_selected_samples(config, split, batch_size=None, selecte
 
     dataset = TransoarDataset(config, split, dataset=1, selected_samples=selected_samples)
 
-    dataloader = DataLoader(
-        dataset, batch_size=batch_size, shuffle=shuffle,
-        num_workers=config['num_workers'], collate_fn=collator
-    )
+    dataloader = build_loader(dataset, batch_size, shuffle, config, collator, group_size=2) # keep the interleaved pairs together
 
     return dataloader
 
+def build_loader(dataset, batch_size, shuffle, config, collator, group_size=1):
+    """Creates the DataLoader, with a resumable sampler that splits the dataset over all ranks.
+
+    Besides num_workers, the config can set pin_memory, persistent_workers and prefetch_factor,
+    e.g., as chosen by autotune_loader. With a group_size > 1, groups of consecutive samples are
+    kept together on one rank, e.g., the interleaved pairs of the mixing and replay datasets.
+    """
+    num_workers = config['num_workers']
+    persistent_workers = config.get('persistent_workers', False) and num_workers > 0
+    return DataLoader(
+        dataset, batch_size=batch_size,
+        sampler=get_sampler(dataset, shuffle, config.get('seed', 0), sample_seeds=persistent_workers, group_size=group_size),
+        num_workers=num_workers, collate_fn=collator, pin_memory=config.get('pin_memory', False),
+        persistent_workers=persistent_workers,
+        prefetch_factor=config.get('prefetch_factor', 2) if num_workers > 0 else None
+    )
+
 # def init_fn(worker_id):
 #     """
 #     https://github.com/pytorch/pytorch/issues/7068
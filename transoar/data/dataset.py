@@ -8,6 +8,24 @@ from torch.utils.data import Dataset
 
 from transoar.data.transforms import get_transforms
 
+
+def get_sample_seed(idx):
+    """Returns the augmentation seed of a sample, which depends on the seed of the epoch and idx.
+
+    In a worker torch.initial_seed() is the base seed of the epoch plus the worker id. The worker
+    id is removed so that a sample is augmented the same way no matter which worker loads it,
+    e.g., after resuming from a mid-epoch checkpoint.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    worker_id = 0 if worker_info is None else worker_info.id
+    return (torch.initial_seed() - worker_id + idx) % 2**32
+
+def split_index(idx):
+    """Returns the index and augmentation seed of a sample, samplers yield both for persistent workers."""
+    if isinstance(idx, tuple):
+        return idx
+    return idx, get_sample_seed(idx)
+
 class TransoarDataset(Dataset):
     """Dataset class of the transoar project."""
     def __init__(self, config, split, dataset=1, selected_samples=None, test_script=False):
@@ -101,6 +119,7 @@ class TransoarDataset(Dataset):
         return len(self._data)
 
     def __getitem__(self, idx):
+        idx, sample_seed = split_index(idx)
         if self._config['overfit']:
             idx = 0
 
@@ -129,7 +148,7 @@ class TransoarDataset(Dataset):
             }
 
             # Apply data augmentation
-            self._augmentation.set_random_state(torch.initial_seed() + idx)
+            self._augmentation.set_random_state(sample_seed)
 
             data_transformed = self._augmentation(data_dict)
             data, label = data_transformed['image'], data_transformed['label']
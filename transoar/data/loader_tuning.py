@@ -0,0 +1,148 @@
+"""Detection of data loader stalls and tuning of the data loader settings."""
+
+import copy
+import os
+import time
+
+import torch
+
+from transoar.data.dataloader import build_loader
+from transoar.utils.distributed import all_gather_object, get_world_size, is_main_process
+from transoar.utils.io import load_json
+
+LOADER_SETTINGS = ['num_workers', 'prefetch_factor', 'pin_memory', 'persistent_workers']
+
+
+class LoaderMonitor:
+    """Measures how long the training loop waits for batches compared to processing them."""
+    def __init__(self, stall_threshold=0.2):
+        self._stall_threshold = stall_threshold
+        self.reset()
+
+    def iterate(self, iterable):
+        """Yields the items of iterable, timing the waits in next() and the steps in between."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            wait_end = time.perf_counter()
+            self._wait += wait_end - start
+            yield item
+            self._compute += time.perf_counter() - wait_end
+            self._num_steps += 1
+
+    def reset(self):
+        self._wait = 0
+        self._compute = 0
+        self._num_steps = 0
+
+    def summary(self):
+        """Returns the mean wait and compute time per step in ms and the stalled fraction, resets the monitor."""
+        num_steps = max(self._num_steps, 1)
+        stats = {
+            'wait_ms': self._wait * 1000 / num_steps,
+            'compute_ms': self._compute * 1000 / num_steps,
+            'stall_fraction': self._wait / max(self._wait + self._compute, 1e-9)
+        }
+        self.reset()
+        return stats
+
+    def is_stalled(self, stats):
+        return stats['stall_fraction'] > self._stall_threshold
+
+
+def measure_loader(loader, num_batches, device, num_epochs=2):
+    """Returns the batches per second of loader, including worker start-up and host to device copies.
+
+    Iterates num_epochs times over the first num_batches batches, so that start-up costs, which
+    persistent workers only pay once, are counted.
+    """
+    num_loaded = 0
+    start = time.perf_counter()
+    for _ in range(num_epochs):
+        for step, (data, *_) in enumerate(loader):
+            data.to(device=device, non_blocking=True)
+            num_loaded += 1
+            if step + 1 >= num_batches:
+                break
+    if 'cuda' in str(device):
+        torch.cuda.synchronize()
+    return num_loaded / (time.perf_counter() - start)
+
+def autotune_loader(loader, config, device):
+    """Searches the loader settings with the highest throughput for the dataset of loader.
+
+    The settings are tuned one after the other, starting with num_workers, each keeping the best
+    value found so far. All ranks use the settings chosen by rank 0.
+
+    Args:
+        loader: A loader created by build_loader, its dataset, batch size and collator are reused.
+        config: The run config, providing the search space and the current settings.
+        device: The device batches are copied to.
+
+    Returns:
+        A dict containing the chosen num_workers, prefetch_factor, pin_memory and persistent_workers.
+    """
+    num_batches = config.get('loader_autotune_batches', 10)
+    max_workers = len(os.sched_getaffinity(0)) // get_world_size() if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    search_space = {
+        'num_workers': [
+            num_workers for num_workers in config.get('loader_autotune_workers', [0, 2, 4, 8, 16]) if num_workers <= max_workers
+        ],
+        'prefetch_factor': config.get('loader_autotune_prefetch', [2, 4, 8]),
+        'pin_memory': [False, True] if 'cuda' in str(device) else [False],
+        'persistent_workers': [False, True]
+    }
+    shuffle = getattr(loader.sampler, 'shuffle', False)
+
+    settings = {
+        'num_workers': config['num_workers'],
+        'prefetch_factor': config.get('prefetch_factor', 2),
+        'pin_memory': config.get('pin_memory', False),
+        'persistent_workers': config.get('persistent_workers', False)
+    }
+    results = {}
+    for name in LOADER_SETTINGS:
+        best_value, best_throughput = settings[name], 0
+        for value in search_space[name]:
+            trial = {**settings, name: value}
+            if trial['num_workers'] == 0 and name in ['prefetch_factor', 'persistent_workers']:
+                continue    # no effect without workers
+
+            key = tuple(trial.values())
+            if key not in results:
+                trial_config = copy.deepcopy(config)
+                trial_config.update(trial)
+                trial_loader = build_loader(loader.dataset, loader.batch_size, shuffle, trial_config, loader.collate_fn)
+                results[key] = measure_loader(trial_loader, num_batches, device)
+                del trial_loader    # shuts down persistent workers
+
+                if is_main_process():
+                    print(f'Loader autotuning: {trial} -> {results[key]:.2f} batches/s')
+            if results[key] > best_throughput:
+                best_value, best_throughput = value, results[key]
+        settings[name] = best_value
+
+    settings = all_gather_object(settings)[0]
+    if is_main_process():
+        print(f'Loader autotuning chose {settings}.')
+    return settings
+
+def get_tuned_loader_settings(loader, config, device, path_to_run, resume):
+    """Returns the loader settings chosen by autotune_loader.
+
+    A resumed run, e.g., after preemption, reuses the settings tuned at its first start, which are
+    saved in the config.json of the run, instead of searching them again.
+    """
+    path_to_config = path_to_run / 'config.json'
+    if resume and path_to_config.exists():
+        run_config = load_json(path_to_config)
+        if run_config.get('autotune_loader', False) and all(name in run_config for name in LOADER_SETTINGS):
+            settings = {name: run_config[name] for name in LOADER_SETTINGS}
+            if is_main_process():
+                print(f'Loader autotuning: reusing {settings} of {path_to_config}.')
+            return settings
+    return autotune_loader(loader, config, device)
@@ -1,10 +1,12 @@
 """Module containing dataloader related functionality."""
 
+import math
 import torch
-from torch.utils.data import DataLoader
+import torch.nn.functional as F
 
 from transoar.data.patch_dataset import TransoarDataset
 from transoar.utils.bboxes import segmentation2bbox
+from transoar.data.dataloader import build_loader
 try:
     import matplotlib.pyplot as plt
 except:
@@ -20,10 +22,7 @@ def get_loader(config, split, batch_size=None):
     shuffle = False if split in ['test', 'val'] else config['shuffle']
 
     dataset = TransoarDataset(config, split)
-    dataloader = DataLoader(
-        dataset, batch_size=batch_size, shuffle=shuffle,
-        num_workers=config['num_workers'], collate_fn=collator
-    )
+    dataloader = build_loader(dataset, batch_size, shuffle, config, collator)
     return dataloader
 
 # def init_fn(worker_id):
@@ -42,6 +41,50 @@ def get_loader(config, split, batch_size=None):
 #     torch.manual_seed(seed)
 
 
+class SlidingWindowPatches:
+    """Sliding window patches of a padded volume without copying the volume.
+
+    The patches are strided unfold views into the padded tensor. Indexing with an integer returns
+    the view of a single patch of shape [C, *patch_size], indexing with a slice materializes the
+    selected patches as one sub-batch of shape [B, C, *patch_size].
+    """
+    def __init__(self, padded_tensor, patch_size, stride, patch_ids=None):
+        self._padded_tensor = padded_tensor
+        self._patch_size = patch_size
+        self._stride = stride
+        self._windows = padded_tensor.unfold(1, patch_size, stride).unfold(2, patch_size, stride).unfold(3, patch_size, stride)
+        self._grid_size = self._windows.shape[1:4]
+        if patch_ids is None:
+            patch_ids = torch.arange(self._grid_size.numel())
+        self._patch_ids = patch_ids
+
+    def __len__(self):
+        return self._patch_ids.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self), self._windows.shape[0], *self._windows.shape[-3:])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return torch.stack([self[i] for i in range(*idx.indices(len(self)))])
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'patch index {idx} out of range for {len(self)} patches')
+        patch_id = int(self._patch_ids[idx])
+        _, ny, nz = self._grid_size
+        return self._windows[:, patch_id // (ny * nz), (patch_id // nz) % ny, patch_id % nz]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def select(self, mask):
+        """Returns the patches selected by a bool mask or index tensor, still as views."""
+        return SlidingWindowPatches(self._padded_tensor, self._patch_size, self._stride, self._patch_ids[mask])
+
+
 class TransoarCollator:
     def __init__(self, config, split):
         self._bbox_padding = config['bbox_padding']
@@ -51,6 +94,14 @@ class TransoarCollator:
         self._patch_size = patch_size[0]
         assert all(element == self._patch_size for element in patch_size), "Only patches with same size along each axis supported right now!"
 
+        # Foreground pre-test to skip tiles of pure air or padding in sliding window inference
+        self._skip_background = config.get('skip_background_patches', False)
+        self._fg_threshold = config.get('patch_fg_threshold', 0.0)    # intensities are scaled to [0, 1], air and padding are 0
+        self._fg_min_fraction = config.get('patch_fg_min_fraction', 0.0)
+        self._fg_downsample = config.get('patch_fg_downsample', 4)
+
+        self._offsets_cache = {}
+
     def __call__(self, batch):
         batch_images = []
         batch_labels = []
@@ -59,27 +110,33 @@ class TransoarCollator:
             assert len(batch) == 1
             batch_paths = []
             for image, label, path in batch:
-                # Trick: since batch size is 1, we simple use the batch dimension to stack patches
+                # Patches are views into the padded volume, they are only materialized per inference sub-batch
                 batch_images, padded_batch_images, patch_offsets = self.gen_patches(image, self._stride, self._patch_size)
-                test_patch_mask, batch_labels, _ = self.gen_patches(label, self._stride, self._patch_size)
-                batch_masks.append(test_patch_mask)
+                test_patch_mask, padded_batch_labels, _ = self.gen_patches(label, self._stride, self._patch_size)
+                num_skipped = 0
+                if self._skip_background:
+                    fg_patches = self.foreground_patch_mask(padded_batch_images, self._stride, self._patch_size)
+                    batch_images, test_patch_mask, patch_offsets = batch_images.select(fg_patches), test_patch_mask.select(fg_patches), patch_offsets[fg_patches]
+                    num_skipped = int((~fg_patches).sum())
                 #batch_images, batch_labels = self.filter_empty_patches(batch_images, batch_labels)
-                                            
-                batch_images = batch_images.chunk(batch_images.shape[0], dim=0)
-                batch_labels = batch_labels.chunk(batch_labels.shape[0], dim=0)
+
+                batch_labels.append(padded_batch_labels)
                 batch_paths.append(path)
 
         elif self._split == 'val':
             assert len(batch) == 1
             for image, label in batch:
-                # Trick: since batch size is 1, we simple use the batch dimension to stack patches
-                batch_images, _, _ = self.gen_patches(image, self._stride, self._patch_size)
+                # Patches are views into the padded volume, they are only materialized per inference sub-batch
+                batch_images, padded_batch_images, _ = self.gen_patches(image, self._stride, self._patch_size)
                 batch_labels, padded_batch_labels, patch_offsets = self.gen_patches(label, self._stride, self._patch_size)
+                num_skipped = 0
+                if self._skip_background:
+                    fg_patches = self.foreground_patch_mask(padded_batch_images, self._stride, self._patch_size)
+                    batch_images, batch_labels, patch_offsets = batch_images.select(fg_patches), batch_labels.select(fg_patches), patch_offsets[fg_patches]
+                    num_skipped = int((~fg_patches).sum())
                 batch_masks.append(torch.zeros_like(image))
                 #batch_images, batch_labels, patch_offsets = self.filter_empty_patches(batch_images, batch_labels, patch_offsets)
                                             
-                batch_images = batch_images.chunk(batch_images.shape[0], dim=0)
-                batch_labels = batch_labels.chunk(batch_labels.shape[0], dim=0)
                 # vizualization for patches
                 #plt.imshow(batch_images[0][0,:,:,96], cmap='gray')
                 #plt.savefig('my_slice.png')
@@ -97,24 +154,11 @@ class TransoarCollator:
 
         
         if self._split == 'val':
-            batch_bboxes, batch_classes = [],[]
-            batch_bboxes_tmp, batch_classes_tmp = segmentation2bbox(torch.stack(batch_labels), self._bbox_padding, excl_crossed_boundary=True)
+            # segmentation2bbox iterates the patches, so only one patch is materialized at a time
+            batch_bboxes, batch_classes = segmentation2bbox(batch_labels, self._bbox_padding, excl_crossed_boundary=True)
             whole_padded_boxes, whole_padded_classes = segmentation2bbox(torch.stack([padded_batch_labels]), self._bbox_padding)
-            batch_labels_tmp, batch_images_tmp, patch_offsets_tmp = [],[],[]
-            b_classes = []
-            for idx, bc in enumerate(batch_classes_tmp): # iterate patches
-                #if bc.numel():  # if tensor not empty
-                    # only keep non-empty patches
-                batch_bboxes.append(batch_bboxes_tmp[idx])
-                batch_classes.append(bc)
-                batch_labels_tmp.append(batch_labels[idx])
-                batch_images_tmp.append(batch_images[idx])
-                patch_offsets_tmp.append(patch_offsets[idx])
-                b_classes.extend(torch.unique(bc).tolist())  # add class ids present in patch
-            batch_labels, batch_images, patch_offsets = tuple(batch_labels_tmp), tuple(batch_images_tmp), torch.stack(patch_offsets_tmp)
-            b_classes = set(b_classes)  # get ids which are present in the current image
             """with open(f'cls_val_sliding_win_{self._patch_size}_{self._stride}.txt', 'a') as fp:
-                for item in b_classes:
+                for item in set(torch.cat(batch_classes).tolist()):
                     fp.write("%s\n" % item)"""
         else:
             # Generate bboxes and corresponding class labels
@@ -125,11 +169,11 @@ class TransoarCollator:
                         fp.write("%s\n" % item.item())"""
         if self._split == 'test':
             #batch_bboxes, batch_classes = segmentation2bbox(torch.stack(batch_labels), self._bbox_padding)
-            batch_mask_bboxes, batch_mask_classes = segmentation2bbox(torch.stack(batch_masks).permute(1,0,2,3,4), self._bbox_padding)
-            return torch.stack(batch_images), torch.stack(batch_masks), list(zip(batch_bboxes, batch_classes)), torch.stack(batch_labels), batch_paths, patch_offsets, padded_batch_images, list(zip(batch_mask_bboxes, batch_mask_classes))
+            batch_mask_bboxes, batch_mask_classes = segmentation2bbox(test_patch_mask, self._bbox_padding)
+            return batch_images, test_patch_mask, list(zip(batch_bboxes, batch_classes)), torch.stack(batch_labels), batch_paths, patch_offsets, padded_batch_images, list(zip(batch_mask_bboxes, batch_mask_classes)), num_skipped
         elif self._split == 'val':
-            # returns patch images, _, patch boxes, patch labels, patch offsets, whole padded labels, whole_padded_boxes, whole_padded_classes
-            return torch.stack(batch_images), torch.stack(batch_masks), list(zip(batch_bboxes, batch_classes)), torch.stack(batch_labels), patch_offsets, padded_batch_labels, list(zip(whole_padded_boxes, whole_padded_classes))
+            # returns patch images, _, patch boxes, patch labels, patch offsets, whole padded labels, whole_padded_boxes, whole_padded_classes, num skipped patches
+            return batch_images, torch.stack(batch_masks), list(zip(batch_bboxes, batch_classes)), batch_labels, patch_offsets, padded_batch_labels, list(zip(whole_padded_boxes, whole_padded_classes)), num_skipped
         return torch.stack(batch_images), torch.stack(batch_masks), list(zip(batch_bboxes, batch_classes)), torch.stack(batch_labels)
 
     def gen_patches(self, input_tensor, stride, patch_size):
@@ -148,20 +192,37 @@ class TransoarCollator:
         for size in padding:
             padding_both_sides.extend([size // 2, size - size // 2])
         padded_tensor = torch.nn.functional.pad(input_tensor, padding_both_sides, mode='constant', value=0)
-        padded_size = padded_tensor.shape[-3:]
-        def extract_patches(input_tensor, patch_size, stride_size):
-            patches = input_tensor.unfold(1, patch_size, stride_size)
-            patches = patches.unfold(2, patch_size, stride_size)
-            patches = patches.unfold(3, patch_size, stride_size)
-            patches = patches.contiguous()
-            patches = patches.view(-1, patch_size, patch_size, patch_size)
-            return patches
-        patches = extract_patches(padded_tensor, patch_size, stride)
-        grid = torch.meshgrid([torch.arange(0, size - patch_size + 1, stride) for size, patch_size in zip(padded_tensor.shape[-3:], [patch_size,patch_size,patch_size])])
-        offsets = torch.stack(grid, dim=-1).reshape(-1, 3)
-        assert patches.shape[0] == offsets.shape[0], "error in offset computation"
+        patches = SlidingWindowPatches(padded_tensor, patch_size, stride)
+        offsets = self.patch_offsets(tuple(padded_tensor.shape[-3:]), stride, patch_size)
+        assert len(patches) == offsets.shape[0], "error in offset computation"
         return patches, padded_tensor, offsets
 
+    def patch_offsets(self, padded_size, stride, patch_size):
+        """Offsets of the sliding window patches in the order of SlidingWindowPatches, cached per padded shape."""
+        key = (padded_size, stride, patch_size)
+        if key not in self._offsets_cache:
+            grid = [torch.arange(0, size - patch_size + 1, stride) for size in padded_size]
+            self._offsets_cache[key] = torch.cartesian_prod(*grid).reshape(-1, 3)
+        return self._offsets_cache[key]
+
+    def foreground_patch_mask(self, padded_image, stride, patch_size):
+        """Cheap foreground pre-test for the tiles generated by gen_patches.
+
+        The body mask is computed once per volume on a strided subsample of the padded image,
+        the foreground fraction of every tile is then a single average pooling over this mask.
+
+        Returns:
+            A bool tensor of shape [num_patches] in the order of the patch offsets, True for tiles
+            that may contain organs.
+        """
+        factor = math.gcd(math.gcd(stride, patch_size), self._fg_downsample)
+        body_mask = (padded_image[..., ::factor, ::factor, ::factor] > self._fg_threshold).float()
+        fg_fraction = F.avg_pool3d(body_mask[None], kernel_size=patch_size // factor, stride=stride // factor)
+        fg_patches = fg_fraction.flatten() > self._fg_min_fraction
+        if not fg_patches.any():    # keep all tiles instead of returning an empty case
+            fg_patches[:] = True
+        return fg_patches
+
     def filter_empty_patches(self, batch_images, batch_labels, patch_offsets):
         mask = torch.sum(batch_labels, dim=(1,2,3)) != 0
         # Use this mask to select the non-zero channels from the tensor
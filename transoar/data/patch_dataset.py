@@ -6,8 +6,10 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 
+from transoar.data.dataset import split_index
 from transoar.data.patch_transforms import get_transforms
-from transoar.utils.bboxes import segmentation2bbox
+from transoar.utils.io import load_pkl, write_pkl
+from transoar.utils.distributed import is_main_process, broadcast_object
 import monai
 #data_base_dir = "/mnt/data/transoar_prep/dataset/"  #"datasets/"
 
@@ -35,79 +37,178 @@ class TransoarDataset(Dataset):
 
         self._augmentation = get_transforms(split, config)
 
+        if split == 'train' and config['augmentation']['use_augmentation']:
+            self._patch_size = config['augmentation']['patch_size'][0]
+            self._stride = config['augmentation']['stride']
+            self._context = config.get('patch_sampling_context', self._patch_size // 8)   # margin for spatial augmentations
+            self._scale_intensity = monai.transforms.ScaleIntensityRanged(
+                keys=['image'], a_min=config['foreground_voxel_statistics']['percentile_00_5'], 
+                a_max=config['foreground_voxel_statistics']['percentile_99_5'], b_min=0.0, b_max=1.0, clip=True
+            )
+
+            # Sampling ratios of the organ size classes, 'random' draws crops regardless of organs
+            self._sampling_ratios = {'small': 1, 'mid': 1, 'large': 1, 'random': 0}
+            self._sampling_ratios.update(config.get('patch_sampling_ratios', {}))
+            self._size_group = {}
+            for group in ['small', 'mid', 'large']:
+                self._size_group.update({int(class_): group for class_ in config[f'labels_{group}']})
+
+            # Per-case, per-class extents, computed once and cached next to the split
+            self._class_extents = self.load_class_extents(config.get('patch_sampling_points', 64))
+
     def __len__(self):
         return len(self._data)
 
     def __getitem__(self, idx):
+        idx, sample_seed = split_index(idx)
         if self._config['overfit']:
             idx = 0
-        successful_crop = False
         case = self._data[idx]
         path_to_case = self._path_to_split / case
         data_path, label_path = sorted(list(path_to_case.iterdir()), key=lambda x: len(str(x)))
 
-        # Load npy files
-        data, label = np.load(data_path), np.load(label_path)
-        #print("pre-aug", data.shape)
+        if self._config['augmentation']['use_augmentation'] and self._split == 'train':
+            # Only the sampled region is read from disk
+            data, label = np.load(data_path, mmap_mode='r'), np.load(label_path, mmap_mode='r')
+            rng = np.random.default_rng(sample_seed)
+            patch_start = self.sample_patch_start(case, label.shape[-3:], rng)
+            data_dict = self.crop_region(data, label, patch_start - self._context, self._patch_size + 2 * self._context)
 
-        if self._config['augmentation']['use_augmentation']:
+            # Spatial augmentations on the region, center crop to the patch, intensity augmentations
+            self._augmentation.set_random_state(sample_seed + 1)
+            data_transformed = self._augmentation(data_dict)
+            data, label = data_transformed['image'], data_transformed['label']
+        elif self._config['augmentation']['use_augmentation']:
+            # Load npy files
+            data, label = np.load(data_path), np.load(label_path)
             data_dict = {
                 'image': data,
                 'label': label
             }
-            # Apply data augmentation
-            self._augmentation.set_random_state(torch.randint(0,2**30,(1,)).item())
-            if self._split == 'train': # added check for non-empty patches for training
-                padding_size = self.gen_padding_size(label, self._config['augmentation']['patch_size'][0],
-                                                     self._config['augmentation']['stride'])
-                scale_int = monai.transforms.ScaleIntensityRanged(
-                            # keys=['image'], a_min=-57, a_max=164, b_min=0.0, b_max=1.0, clip=True
-                            keys=['image'], a_min=self._config['foreground_voxel_statistics']['percentile_00_5'], 
-                            a_max=self._config['foreground_voxel_statistics']['percentile_99_5'], b_min=0.0, b_max=1.0, clip=True
-                            )
-                pad = monai.transforms.SpatialPadd( # patches also contain padded space like in val or test
-                        keys=['image', 'label'],
-                        spatial_size=padding_size # this is indiv. for every image, → can't be in the regular augmentator
-                    )
-                data_transformed = scale_int(data_dict)
-                data_transformed = pad(data_transformed)
-                try_counter = 0
-                while(not successful_crop and try_counter < 5): # try 5 random crops, if no organs found, last random crop w/o organs used
-                    data_transformed = self._augmentation(data_transformed) # random crop + regular augmentation
-                    data, label = data_transformed['image'], data_transformed['label']
-                    batch_bboxes, batch_classes = segmentation2bbox(label[None,:], self._config['bbox_padding'], excl_crossed_boundary=True)
-                    try_counter += 1
-                    for bc in batch_classes:
-                        if bc.numel():  # if tensor not empty
-                            successful_crop = True
-
-            else:
-                data_transformed = self._augmentation(data_dict)
-                data, label = data_transformed['image'], data_transformed['label']
-                            
-
+            self._augmentation.set_random_state(sample_seed)
+            data_transformed = self._augmentation(data_dict)
+            data, label = data_transformed['image'], data_transformed['label']
         else:
-            data, label = torch.tensor(data), torch.tensor(label)
+            data, label = torch.tensor(np.load(data_path)), torch.tensor(np.load(label_path))
         #print("post-aug", data.shape)
         if self._split == 'test':
             return data, label, path_to_case # path is used for visualization of predictions on source data
         else:
             return data, label
-        
-    def gen_padding_size(self, input_tensor, patch_size, stride):
-        padding = []
-        input_tensor = torch.tensor(input_tensor)
-        for idx, s in enumerate(input_tensor.shape[-3:]):
+
+    def load_class_extents(self, num_points):
+        """Returns the class extents of all cases, see get_class_extents().
+
+        The extents are cached in class_extents_<split>.pkl next to the split directory, only cases
+        missing from the cache are computed. The main process reads and updates the cache, the other
+        ranks receive the extents from it. The cache has to be deleted when the data is preprocessed
+        again.
+        """
+        extents = None
+        if is_main_process():
+            path_to_cache = self._path_to_split.parent / f'class_extents_{self._split}.pkl'
+            cache = load_pkl(path_to_cache) if path_to_cache.exists() else {}
+            if cache.get('num_points') != num_points:
+                cache = {'num_points': num_points, 'extents': {}}
+
+            missing_cases = [case for case in self._data if case not in cache['extents']]
+            if missing_cases:
+                cache['extents'].update({case: self.get_class_extents(case, num_points) for case in missing_cases})
+                try:    # written to a temporary file first, so that an interrupted write leaves no broken cache
+                    write_pkl(cache, path_to_cache.with_suffix('.tmp'))
+                    os.replace(path_to_cache.with_suffix('.tmp'), path_to_cache)
+                except OSError as error:    # e.g., read-only data directory
+                    print(f'Could not cache the class extents in {path_to_cache}: {error}')
+            extents = {case: cache['extents'][case] for case in self._data}
+        return broadcast_object(extents)
+
+    def get_class_extents(self, case, num_points):
+        """Computes the extent and a random subset of voxels of every organ of a case.
+
+        Args:
+            case: Name of the case in the split directory.
+            num_points: Max number of voxels stored per organ to draw patch positions from.
+
+        Returns:
+            A dict mapping class ids to tuples (min [3], max [3], points [num_points, 3]) in voxel
+            coordinates. Organs which segmentation2bbox would ignore as too small are excluded.
+        """
+        path_to_case = self._path_to_split / case
+        _, label_path = sorted(list(path_to_case.iterdir()), key=lambda x: len(str(x)))
+        label = np.asarray(np.load(label_path, mmap_mode='r')[0])
+
+        fg_indices = np.flatnonzero(label)
+        fg_classes = label.ravel()[fg_indices]
+        order = np.argsort(fg_classes, kind='stable')
+        fg_indices, fg_classes = fg_indices[order], fg_classes[order]
+        classes, starts = np.unique(fg_classes, return_index=True)
+
+        rng = np.random.default_rng(0)
+        extents = {}
+        for class_, indices in zip(classes, np.split(fg_indices, starts[1:])):
+            coords = np.stack(np.unravel_index(indices, label.shape), axis=-1)
+            min_coords, max_coords = coords.min(axis=0), coords.max(axis=0)
+            if ((max_coords - min_coords) < 5).any():
+                continue
+            points = coords[rng.choice(coords.shape[0], min(num_points, coords.shape[0]), replace=False)]
+            extents[int(class_)] = (min_coords, max_coords, points)
+        return extents
+
+    def sample_patch_start(self, case, shape, rng):
+        """Draws the lower corner of a patch containing at least one organ of the case.
+
+        A size group is drawn with the configured sampling ratios among the groups present in the
+        case, then an organ of this group. Along axes where the organ fits into the patch the whole
+        extent is kept inside the patch, otherwise one of the organ's voxels is.
+        """
+        padded_size = np.array(self.gen_padding_size(shape, self._patch_size, self._stride))
+        shape = np.array(shape)
+        min_start = -((padded_size - shape) // 2)  # same padding as in sliding window inference
+        max_start = min_start + padded_size - self._patch_size
+
+        extents = self._class_extents[case]
+        groups = {}
+        for class_ in extents:
+            groups.setdefault(self._size_group.get(class_, 'large'), []).append(class_)
+        candidates = [group for group in groups if self._sampling_ratios[group] > 0] + ['random']
+        ratios = np.array([self._sampling_ratios[group] for group in candidates], dtype=float)
+        if ratios.sum() == 0:
+            return rng.integers(min_start, max_start + 1)
+        group = candidates[rng.choice(len(candidates), p=ratios / ratios.sum())]
+        if group == 'random':
+            return rng.integers(min_start, max_start + 1)
+
+        min_coords, max_coords, points = extents[groups[group][rng.integers(len(groups[group]))]]
+        point = points[rng.integers(points.shape[0])]
+        fits = (max_coords - min_coords + 1) <= self._patch_size
+        low = np.where(fits, max_coords, point) - self._patch_size + 1
+        high = np.where(fits, min_coords, point)
+        return np.clip(rng.integers(low, high + 1), min_start, max_start)
+
+    def crop_region(self, data, label, start, size):
+        """Crops a cubic region, parts outside the volume are zero like the padding of the patch inference."""
+        start = np.asarray(start)
+        src_start = np.maximum(start, 0)
+        src_end = np.minimum(start + size, data.shape[-3:])
+        src = (slice(None),) + tuple(slice(lo, hi) for lo, hi in zip(src_start, src_end))
+        dst = (slice(None),) + tuple(slice(lo, hi) for lo, hi in zip(src_start - start, src_end - start))
+
+        region = self._scale_intensity({'image': np.asarray(data[src]), 'label': np.asarray(label[src])})
+        data_dict = {
+            'image': np.zeros((data.shape[0], size, size, size), dtype=np.float32),
+            'label': np.zeros((label.shape[0], size, size, size), dtype=label.dtype)
+        }
+        data_dict['image'][dst] = np.asarray(region['image'])
+        data_dict['label'][dst] = region['label']
+        return data_dict
+
+    def gen_padding_size(self, shape, patch_size, stride):
+        """Returns the padded size of a volume in sliding window inference, see TransoarCollator.gen_patches."""
+        padded_size = []
+        for s in shape[-3:]:
             pd = s%stride
             pd = 0 if pd == 0 else stride-pd
             if (s+pd) < patch_size:  # check if one patch fits
                 pd = patch_size - s  # add padding to get min. patch size
-            padding.append(pd)
-        padding.reverse()
-
-        padding_both_sides = []
-        for size in padding:
-            padding_both_sides.extend([size // 2, size - size // 2])
-        padded_tensor = torch.nn.functional.pad(input_tensor, padding_both_sides, mode='constant', value=0)
-        padded_size = padded_tensor.shape[-3:]
+            padded_size.append(s + pd)
         return padded_size
@@ -9,7 +9,7 @@ from monai.transforms import (
     Orientationd,
     ScaleIntensityRanged,
     Resized,
-    RandSpatialCropd,
+    CenterSpatialCropd,
     RandCropByPosNegLabeld,
     SpatialPadd,
     RandGaussianNoised,
@@ -96,10 +96,9 @@ def get_transforms(split, config):
                 keys=['image', 'label'], prob=config['augmentation']['p_flip'],
                 spatial_axis=config['augmentation']['flip_axis'][2]
             ),
-            RandSpatialCropd(
+            CenterSpatialCropd( # the dataset samples a region around the patch, see TransoarDataset
                 keys=['image', 'label'],
-                roi_size=patch_size,
-                random_size=False, random_center=True
+                roi_size=patch_size
             ),
 
             # Intensity transformations
@@ -3,7 +3,10 @@ Module containing the evaluator of the transoar project.
 Parts are adapted from https://github.com/cocodataset/cocoapi and https://github.com/MIC-DKFZ/nnDetection.
 """
 
+import os
 from functools import partial
+from pathlib import Path
+
 import torch
 import torch.nn.functional as F
 import numpy as np
@@ -11,6 +14,8 @@ from monai.metrics import HausdorffDistanceMetric
 
 from transoar.metric import Metric
 from transoar.utils.bboxes import iou_3d_np
+from transoar.utils.distributed import all_gather_object
+from transoar.utils.io import load_json
 from transoar.models.criterion import SoftDiceLoss
 
 
@@ -240,6 +245,42 @@ class DetectionEvaluator:
         """
         self.results_list = []
 
+    def gather(self, num_cases=None):
+        """
+        Collect the results of all ranks in distributed evaluation, so that every rank
+        evaluates the complete set. No-op in single process runs.
+
+        The DistributedSampler pads the shards of all ranks to the same length by repeating
+        cases. The results are put back in the order of the sampler, where rank r evaluated the
+        positions r, r + world_size, ..., and only the first num_cases are kept.
+        """
+        rank_results = all_gather_object(self.results_list)
+        num_positions = max(len(results) for results in rank_results)
+        self.results_list = [
+            results[position] for position in range(num_positions) for results in rank_results if position < len(results)
+        ][:num_cases]
+
+def get_detection_evaluator(config, from_data_info=True):
+    """Returns the DetectionEvaluator of the test scripts for the classes of a run.
+
+    Args:
+        config: The config of the run.
+        from_data_info: Read the labels and size groups from the data_info.json of the dataset in
+            TRANSOAR_DATA instead of the config.
+    """
+    data_config = config
+    if from_data_info:
+        data_config = load_json(Path(os.environ.get('TRANSOAR_DATA')).resolve() / config['dataset'] / 'data_info.json')
+    return DetectionEvaluator(
+        classes=list(data_config['labels'].values()),
+        classes_small=data_config['labels_small'],
+        classes_mid=data_config['labels_mid'],
+        classes_large=data_config['labels_large'],
+        iou_range_nndet=(0.1, 0.5, 0.05),
+        iou_range_coco=(0.5, 0.95, 0.05),
+        sparse_results=False
+    )
+
 
 def matching_batch(
     iou_fn, 
@@ -0,0 +1,131 @@
+"""Export of the detector and its post-processing to TorchScript or ONNX for serving without the training stack."""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from transoar.inference import inference
+from transoar.models.ops.modules.ms_deform_attn import MSDeformAttn
+
+EXPORT_FORMATS = ['torchscript', 'onnx']
+OUTPUT_NAMES = ['pred_boxes', 'pred_classes', 'pred_scores', 'valid']
+
+
+class ExportableDetector(nn.Module):
+    """Runs the detector and the post-processing of inference() with tensor ops only.
+
+    Instead of lists of variable length, one detection per class is returned, i.e., boxes of
+    shape [batch, classes, 6], class ids, scores and a mask of the classes that were detected.
+    The eager post-processing returns exactly the valid entries.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        out = self.model(x)
+        pred_logits, pred_boxes = out['pred_logits'], out['pred_boxes']
+        class_ids = out.get('class_ids', torch.arange(pred_logits.shape[-1])).to(pred_logits.device)
+        return postprocess(pred_logits, pred_boxes, class_ids)
+
+
+def postprocess(pred_logits, pred_boxes, class_ids):
+    """Selects the query with the highest score of every class, see inference().
+
+    Column 0 of the logits is the background, class_ids maps the columns to ascending class ids.
+    """
+    pred_probs = F.softmax(pred_logits, dim=-1)
+    pred_scores, pred_columns = pred_probs.max(dim=-1)                                       # [Batch, Queries]
+
+    columns = torch.arange(1, pred_logits.shape[-1], device=pred_logits.device)
+    matches = pred_columns[:, :, None] == columns[None, None, :]                            # [Batch, Queries, Classes]
+    best_ids = torch.where(matches, pred_scores[:, :, None], -torch.ones_like(pred_scores[:, :, None])).argmax(dim=1)
+
+    boxes = pred_boxes.gather(1, best_ids[..., None].expand(-1, -1, pred_boxes.shape[-1]))
+    scores = pred_scores.gather(1, best_ids)
+    classes = class_ids[1:][None].expand(pred_logits.shape[0], -1)
+    return boxes, classes, scores, matches.any(dim=1)
+
+def set_exportable(model, exportable=True):
+    """Switches the deformable attention of model to the exportable sampling."""
+    for module in model.modules():
+        if isinstance(module, MSDeformAttn):
+            module.exportable = exportable
+
+def export_model(model, example, path, format='torchscript', opset_version=17):
+    """Traces the detector with post-processing for inputs of the shape of example and saves it to path.
+
+    The graph is specialized to the input shape and the options of model, e.g., class subsets.
+
+    Args:
+        model: A detector in eval mode, e.g., OrganDetrNet.
+        example: An input batch of the served shape, usually [1, 1, *data_size].
+        path: Path of the artifact.
+        format: 'torchscript' or 'onnx', which requires the onnx package.
+        opset_version: ONNX opset.
+    """
+    assert format in EXPORT_FORMATS, f'format must be one of {EXPORT_FORMATS}'
+    set_exportable(model)
+    detector = ExportableDetector(model).eval()
+    try:
+        with torch.no_grad():
+            if format == 'torchscript':
+                traced = torch.jit.trace(detector, example, check_trace=False, strict=False)
+                traced.save(str(path))
+            else:
+                torch.onnx.export(
+                    detector, (example,), str(path), input_names=['image'], output_names=OUTPUT_NAMES,
+                    opset_version=opset_version, dynamo=False, external_data=False
+                )
+    finally:
+        set_exportable(model, False)
+
+def load_exported(path):
+    """Returns a function mapping an input tensor to the outputs of an exported detector."""
+    if str(path).endswith('.onnx'):
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(str(path), providers=['CPUExecutionProvider'])
+        input_name = session.get_inputs()[0].name
+        return lambda x: tuple(torch.from_numpy(output) for output in session.run(None, {input_name: x.cpu().numpy()}))
+
+    module = torch.jit.load(str(path), map_location='cpu')
+
+    @torch.no_grad()
+    def run(x):
+        return module(x)
+    return run
+
+def to_detections(outputs):
+    """Converts the outputs of an exported detector to the lists of arrays returned by inference()."""
+    boxes, classes, scores, valid = (output.cpu().numpy() for output in outputs)
+    return (
+        [boxes_[valid_] for boxes_, valid_ in zip(boxes, valid)],
+        [classes_[valid_] for classes_, valid_ in zip(classes, valid)],
+        [scores_[valid_] for scores_, valid_ in zip(scores, valid)]
+    )
+
+@torch.no_grad()
+def check_parity(model, exported, inputs, atol=1e-4):
+    """Compares the detections of an exported detector with the eager model and inference().
+
+    Returns:
+        A dict with the max. absolute box and score differences and whether the detected classes
+        match, over all inputs.
+    """
+    results = {'max_box_diff': 0., 'max_score_diff': 0., 'classes_match': True}
+    for x in inputs:
+        eager_boxes, eager_classes, eager_scores = inference(model(x))
+        boxes, classes, scores = to_detections(exported(x))
+        for eager_boxes_, eager_classes_, eager_scores_, boxes_, classes_, scores_ in zip(
+            eager_boxes, eager_classes, eager_scores, boxes, classes, scores
+        ):
+            if not np.array_equal(eager_classes_, classes_):
+                results['classes_match'] = False
+                continue
+            results['max_box_diff'] = max(results['max_box_diff'], float(np.abs(eager_boxes_ - boxes_).max(initial=0)))
+            results['max_score_diff'] = max(results['max_score_diff'], float(np.abs(eager_scores_ - scores_).max(initial=0)))
+
+    results['passed'] = results['classes_match'] and max(results['max_box_diff'], results['max_score_diff']) <= atol
+    return results
@@ -7,13 +7,21 @@ from transoar.utils.bboxes import iou_3d_np
 
 iou_checking = False  # prints ioUs of multiple predictions per class (e.g., for checking all predictions in dense matching)
 
-def inference(out, vis_queries=False):
+def inference(out, vis_queries=False, classes=None):
+    # Logit columns of class-subset models are mapped to class ids by out['class_ids']
+    pred_logits = out['pred_logits']
+    class_ids = out.get('class_ids', torch.arange(pred_logits.shape[-1])).cpu()
+    if classes is not None: # restrict post-processing to requested classes
+        keep = torch.tensor([idx for idx, class_ in enumerate(class_ids.tolist()) if class_ == 0 or class_ in classes])
+        pred_logits, class_ids = pred_logits[..., keep.to(pred_logits.device)], class_ids[keep]
+    class_ids = class_ids.numpy()
+
     # Get probabilities from output logits
-    pred_probs = F.softmax(out['pred_logits'], dim=-1)
+    pred_probs = F.softmax(pred_logits, dim=-1)
 
     # Transform into np arrays and store as a list of arrays, as required in evaluator
     pred_boxes = [boxes.detach().cpu().numpy() for boxes in out['pred_boxes']]
-    pred_classes = [torch.max(probs, dim=-1)[1].detach().cpu().numpy() for probs in pred_probs]
+    pred_classes = [class_ids[torch.max(probs, dim=-1)[1].detach().cpu().numpy()] for probs in pred_probs]
     pred_scores = [torch.max(probs, dim=-1)[0].detach().cpu().numpy() for probs in pred_probs]
 
     #if type(out['pred_seg']) is not int or:
@@ -75,3 +83,43 @@ def inference(out, vis_queries=False):
     if vis_queries:
         return pred_boxes, pred_classes, pred_scores, quer    
     return pred_boxes, pred_classes, pred_scores
+
+def get_class_ids(labels, classes):
+    """Maps organ names or class ids, e.g., given on the command line, to class ids.
+
+    Args:
+        labels: The labels of the config, mapping class ids as str to organ names.
+        classes: Organ names or class ids.
+    """
+    name_to_id = {name: int(id_) for id_, name in labels.items()}
+    class_ids = []
+    for class_ in classes:
+        if class_ in name_to_id:
+            class_ids.append(name_to_id[class_])
+        elif str(class_) in labels:
+            class_ids.append(int(class_))
+        else:
+            raise ValueError(f'Unknown organ {class_}, available: {list(name_to_id)}')
+    return class_ids
+
+def predictions_stable(previous, current, iou_threshold=0.9, score_threshold=0.05):
+    """Checks whether the post-processed predictions of two decoder layers agree, e.g., to exit early.
+
+    Predictions agree if the same classes are detected and the box of every class overlaps with
+    the previous one by at least iou_threshold and its score changes by at most score_threshold.
+
+    Args:
+        previous: Boxes, classes and scores returned by inference() for the previous layer.
+        current: Boxes, classes and scores returned by inference() for the current layer.
+    """
+    for prev_boxes, prev_classes, prev_scores, boxes, classes, scores in zip(*previous, *current):
+        if not np.array_equal(prev_classes, classes):
+            return False
+        if classes.size == 0:
+            continue
+
+        # Classes are sorted by inference(), i.e., the boxes of a class have the same index
+        ious = np.diag(iou_3d_np(prev_boxes, boxes))
+        if (ious < iou_threshold).any() or (np.abs(prev_scores - scores) > score_threshold).any():
+            return False
+    return True
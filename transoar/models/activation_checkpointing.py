@@ -0,0 +1,190 @@
+"""Config-driven activation checkpointing of the stages and layers of backbones and necks."""
+
+import types
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+MB = 2**20
+
+_num_recomputing = 0    # > 0 while checkpointed forwards are recomputed in the backward pass
+
+# Named groups of checkpointable submodules, given as name patterns matched part by part with
+# fnmatch, e.g., '_encoder.*' matches '_encoder.0' but not '_encoder.0._block'
+CHECKPOINT_GROUPS = {
+    'msavit': {
+        'encoder': ['_encoder.*'],
+        'msa': ['_decoder.msa_dec.*.levels.*.blocks.*']
+    },
+    'fpn': {
+        'encoder': ['_encoder.*']
+    },
+    'resnet': {
+        'encoder': ['layer1.*', 'layer2.*', 'layer3.*', 'layer4.*']
+    },
+    'attn_fpn': {
+        'encoder': ['_encoder._stages.*'],
+        'swin': ['_encoder._stages.*._block.*.blocks.*'],
+        'decoder_attn': ['_decoder._refine.refine_def_attn.layers.*']
+    },
+    'swin_unetr': {
+        'encoder': ['swin_unetr.swinViT.layers?.*']
+    },
+    'def_detr': {
+        'encoder': ['encoder.layers.*'],
+        'decoder': ['decoder.layers.*']
+    },
+    'msa_encoder': {
+        'msa': ['msa_enc.*.levels.*.blocks.*']
+    }
+}
+
+
+def apply_activation_checkpointing(module, targets, groups, prefix):
+    """Recomputes the activations of the targeted submodules of module in the backward pass.
+
+    Args:
+        module: A backbone or neck.
+        targets: Names of groups in groups or patterns of submodule names, e.g., ['encoder', '_decoder.msa_dec.1'].
+        groups: The checkpoint groups of the module, see CHECKPOINT_GROUPS.
+        prefix: Prefix of the reported group names, e.g., 'backbone'.
+
+    Returns:
+        A list of the names of the checkpointed submodules.
+    """
+    checkpointed = []
+    for target in targets or []:
+        group = f'{prefix}.{target}'
+        matched = False
+        for pattern in groups.get(target, [target]):
+            for name, submodule in module.named_modules():
+                if not _matches(name, pattern):
+                    continue
+                matched = True
+                # Nested checkpoints only add recomputation
+                if not any(name.startswith(outer + '.') for outer in checkpointed) and name not in checkpointed:
+                    checkpoint_module(submodule, group)
+                    checkpointed.append(name)
+        if not matched:
+            raise ValueError(f'Activation checkpointing target {target} matches no module of {type(module).__name__}.')
+    return checkpointed
+
+def checkpoint_module(module, group):
+    """Replaces the forward of module with a checkpointed forward while training."""
+    module._checkpoint_group = group
+    module._checkpoint_enabled = True
+    module.forward = types.MethodType(_checkpointed_forward, module)
+
+def set_activation_checkpointing(model, enabled, group=None):
+    """Enables or disables the checkpointed modules of model, optionally only of one group."""
+    for module in model.modules():
+        if hasattr(module, '_checkpoint_group') and group in [None, module._checkpoint_group]:
+            module._checkpoint_enabled = enabled
+
+def is_recomputing():
+    """Returns True while the activations of a checkpointed module are recomputed.
+
+    The forward hooks of the submodules run again during the recomputation in the backward pass,
+    hooks measuring the forward pass, e.g., of StepTimer and MemoryProfiler, skip these calls.
+    """
+    return _num_recomputing > 0
+
+def get_checkpoint_groups(model):
+    return sorted({module._checkpoint_group for module in model.modules() if hasattr(module, '_checkpoint_group')})
+
+def measure_checkpointing_savings(model, step, device):
+    """Measures the activation memory a training step saves by each checkpoint group.
+
+    Runs step once with all groups disabled and once per group with only this group enabled.
+    The saved activations are counted with saved tensor hooks, the peak is read from the CUDA
+    allocator or, on other devices, equals the saved activations.
+
+    Args:
+        model: A model with checkpointed modules.
+        step: A function running the forward and backward pass of a training step.
+        device: The device the model runs on.
+
+    Returns:
+        A dict mapping 'none' and every group to the saved activations and peak memory in MB.
+    """
+    groups = get_checkpoint_groups(model)
+    param_storages = {param.untyped_storage().data_ptr() for param in model.parameters()}
+    results = {}
+    for group in ['none'] + groups:
+        set_activation_checkpointing(model, False)
+        if group != 'none':
+            set_activation_checkpointing(model, True, group)
+        results[group] = _measure_step(step, device, param_storages)
+
+    set_activation_checkpointing(model, True)
+    for group in groups:
+        results[group]['saving_mb'] = results['none']['peak_mb'] - results[group]['peak_mb']
+    return results
+
+
+def _checkpointed_forward(self, *args, **kwargs):
+    forward = type(self).forward.__get__(self)
+    if not (self._checkpoint_enabled and self.training and torch.is_grad_enabled()):
+        return forward(*args, **kwargs)
+
+    num_calls = 0
+    def run(*args, **kwargs):
+        nonlocal num_calls
+        num_calls += 1
+        if num_calls == 1:
+            return forward(*args, **kwargs)
+        with _frozen_running_stats(self), _recomputing():  # the recomputation must not update batch norm statistics again
+            return forward(*args, **kwargs)
+    return checkpoint(run, *args, use_reentrant=False, **kwargs)
+
+@contextmanager
+def _recomputing():
+    global _num_recomputing
+    _num_recomputing += 1
+    try:
+        yield
+    finally:
+        _num_recomputing -= 1
+
+@contextmanager
+def _frozen_running_stats(module):
+    norms = [
+        submodule for submodule in module.modules()
+        if isinstance(submodule, nn.modules.batchnorm._NormBase) and submodule.track_running_stats
+    ]
+    states = [{name: buffer.clone() for name, buffer in norm.named_buffers(recurse=False)} for norm in norms]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for norm, state in zip(norms, states):
+                for name, buffer in norm.named_buffers(recurse=False):
+                    buffer.copy_(state[name])
+
+def _matches(name, pattern):
+    parts, pattern_parts = name.split('.'), pattern.split('.')
+    return len(parts) == len(pattern_parts) and all(fnmatchcase(part, pattern_part) for part, pattern_part in zip(parts, pattern_parts))
+
+def _measure_step(step, device, param_storages):
+    use_cuda = 'cuda' in str(device) and torch.cuda.is_available()
+    saved_storages, saved_bytes = set(), 0
+
+    def pack_hook(tensor):
+        nonlocal saved_bytes
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in saved_storages and storage.data_ptr() not in param_storages:
+            saved_storages.add(storage.data_ptr())
+            saved_bytes += storage.nbytes()
+        return tensor
+
+    if use_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        step()
+    peak = torch.cuda.max_memory_allocated() - start if use_cuda else saved_bytes
+    return {'saved_mb': saved_bytes / MB, 'peak_mb': peak / MB}
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import math
 from typing import Sequence, Type, Tuple, Union, List, Optional, Dict
 import torch
@@ -17,6 +18,10 @@ WO_SELF_ATT = False
 _NUM_CROSS_ATT = -1
 ndims = 3 # H,W,D
 
+# naive: materializes the attention matrix, sdpa: fused F.scaled_dot_product_attention,
+# chunked: attends chunks of windows and recomputes their attention matrices in the backward pass
+ATTENTION_IMPLS = ["naive", "sdpa", "chunked"]
+
 
 #from detectron2.modeling import BACKBONE_REGISTRY, Backbone, ShapeSpec
 att_dtype = torch.float16
@@ -270,9 +275,13 @@ class Attention(nn.Module):
                 qk_scale=None,
                 attn_drop=0.,
                 proj_drop=0.,
+                attention_impl="naive",
+                attention_chunk_size=4096,
+                rel_pos_bias=False,
             )->None:
 
         super().__init__()
+        assert attention_impl in ATTENTION_IMPLS, f"`attention_impl` must be one of {ATTENTION_IMPLS}"
 
         if isinstance(patch_size, int):
             patch_size = [patch_size]*ndims
@@ -308,8 +317,14 @@ class Attention(nn.Module):
             relative_coords[:, :, 1] *= (2 * self.patch_size[2] - 1)
             relative_position_index = relative_coords.sum(-1)  # Ww*Wh*Wd, Ww*Wh*Wd
             #register_buffer("relative_position_index", relative_position_index)
+            if rel_pos_bias:
+                self.relative_position_bias_table = relative_position_bias_table
+                self.register_buffer("relative_position_index", relative_position_index, persistent=False)
 
         self.attention_type = attention_type
+        self.attention_impl = attention_impl
+        self.attention_chunk_size = attention_chunk_size
+        self.rel_pos_bias = rel_pos_bias and attention_type == "local"
 
         if self.attention_type=="local":
             self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
@@ -331,7 +346,6 @@ class Attention(nn.Module):
         if self.attention_type=="local":
             qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
             q, k, v = qkv[0], qkv[1], qkv[2]
-            q = q * self.scale
         else:
             B = q_ms.size()[0]
 
@@ -339,33 +353,45 @@ class Attention(nn.Module):
             kv = self.qkv(x).reshape(B_, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
             k, v = kv[0], kv[1]
 
-            q = k.clone()#.type(att_dtype)
-            q_tmp = q_ms.reshape(B, self.num_heads, N, C // self.num_heads)
+            # Window i attends with the queries of q_ms window i % B
+            q = q_ms.reshape(B, self.num_heads, N, C // self.num_heads)
+            if B_ != B:
+                q = q[torch.arange(B_, device=q.device) % B]
+            #print(f'B:{B}, N:{N}, C:{C},  B_:{B_}, out:{q.size()}')
 
-            div_ = int(B_//B)
-            rem_ = B_ - B * div_
-            q_tmp = q_tmp.repeat(div_, 1, 1, 1)
-            q_tmp = q_tmp.reshape(B * div_, self.num_heads, N, C // self.num_heads)
+        bias = self.get_relative_position_bias(N) if self.rel_pos_bias else None
 
-            index = torch.tensor(range(0,B * div_))
-            #print(x.dtype, q.dtype, q_tmp.dtype , 'global:  x, q  q_tmp<<<<<<< ')
-            q[index.long(), :, :, :] = q_tmp
+        attn = None
+        if self.attention_impl == "sdpa":
+            x = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=bias.to(q.dtype) if bias is not None else None, dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale
+            )
+        elif self.attention_impl == "chunked":
+            x = torch.cat([
+                self._attend_checkpointed(q[start:start + self.attention_chunk_size], k[start:start + self.attention_chunk_size],
+                                          v[start:start + self.attention_chunk_size], bias)
+                for start in range(0, B_, self.attention_chunk_size)
+            ])
+        else:
+            x, attn = self._attend(q, k, v, bias)
 
-            if rem_ > 0:
-                index = torch.tensor(range(B * div_,B * div_+rem_))
-                q[index.long(), :, :, :] = q_tmp[torch.tensor(range(rem_)), :, :, :]
-            q = q * self.scale
-            #print(f'B:{B}, N:{N}, C:{C},  B_:{B_}, out:{q.size()}')
+        x = x.transpose(1, 2).reshape(B_, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        #print(f'Attention-  q:{q.size()}, k:{k.size()}, v:{v.size()}')
+        #x = x.type(x_dtype)
+        return x, attn
 
-        attn = (q @ k.transpose(-2, -1))
+    def get_relative_position_bias(self, N):
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(N, N, -1)
+        return relative_position_bias.permute(2, 0, 1).contiguous().unsqueeze(0)  # 1, nH, N, N
 
-        '''
-        if self.attention_type == 'local':
-            relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                self.patch_size[0]**ndims, self.patch_size[0]**ndims, -1)
-            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()
-            attn = attn + relative_position_bias.unsqueeze(0)
-        '''
+    def _attend(self, q, k, v, bias):
+        """Materializes the attention matrix of all windows, returns the output and the attention."""
+        q = q * self.scale
+        attn = (q @ k.transpose(-2, -1))
+        if bias is not None:
+            attn = attn + bias
 
         # TODO still using too much RAM
         #attn = self.softmax(attn)
@@ -373,13 +399,13 @@ class Attention(nn.Module):
 
 
         attn = self.attn_drop(attn)
+        return attn @ v, attn
 
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
-        x = self.proj(x)
-        x = self.proj_drop(x)
-        #print(f'Attention-  q:{q.size()}, k:{k.size()}, v:{v.size()}')
-        #x = x.type(x_dtype)
-        return x, attn
+    def _attend_checkpointed(self, q, k, v, bias):
+        """Attends a chunk of windows, recomputing its attention matrix in the backward pass."""
+        if not (self.training and torch.is_grad_enabled()):
+            return self._attend(q, k, v, bias)[0]
+        return torch.utils.checkpoint.checkpoint(lambda *inputs: self._attend(*inputs)[0], q, k, v, bias, use_reentrant=False)
 
 
 def get_patches(x, patch_size):
@@ -434,6 +460,9 @@ class ViTBlock(nn.Module):
                 attention_type,
                 norm_layer,
                 layer_scale,
+                attention_impl="naive",
+                attention_chunk_size=4096,
+                rel_pos_bias=False,
         )->None:
         super().__init__()
         self.patch_size = patch_size
@@ -459,6 +488,9 @@ class ViTBlock(nn.Module):
                               qk_scale=qk_scale,
                               attn_drop=attn_drop,
                               proj_drop=drop,
+                              attention_impl=attention_impl,
+                              attention_chunk_size=attention_chunk_size,
+                              rel_pos_bias=rel_pos_bias,
         )
 
         self.drop_path = timm_DropPath(drop_path) if drop_path > 0. else nn.Identity()
@@ -575,7 +607,10 @@ class ViTLayer(nn.Module):
                 norm_layer,
                 norm_type,
                 layer_scale,
-                act_layer
+                act_layer,
+                attention_impl="naive",
+                attention_chunk_size=4096,
+                rel_pos_bias=False,
         )->None:
         super().__init__()
         self.patch_size = patch_size
@@ -596,7 +631,10 @@ class ViTLayer(nn.Module):
                                     act_layer=act_layer,
                                     norm_layer=norm_layer,
                                     layer_scale=layer_scale,
-                                    input_dims=input_dims)
+                                    input_dims=input_dims,
+                                    attention_impl=attention_impl,
+                                    attention_chunk_size=attention_chunk_size,
+                                    rel_pos_bias=rel_pos_bias)
                             for k in range(depth)]
                             )
 
@@ -652,7 +690,10 @@ class ViT(nn.Module):
                 norm_layer=nn.LayerNorm,
                 layer_scale=None,
                 img_size=None,
-                NUM_CROSS_ATT=-1):
+                NUM_CROSS_ATT=-1,
+                attention_impl="naive",
+                attention_chunk_size=4096,
+                rel_pos_bias=False):
         super().__init__()
 
 
@@ -700,7 +741,10 @@ class ViT(nn.Module):
                             norm_layer=norm_layer,
                             layer_scale=layer_scale,
                             norm_type=norm_type,
-                            act_layer=act_layer
+                            act_layer=act_layer,
+                            attention_impl=attention_impl,
+                            attention_chunk_size=attention_chunk_size,
+                            rel_pos_bias=rel_pos_bias
             )
             self.levels.append(level)
         #self.apply(self._init_weights)
@@ -783,7 +827,7 @@ def downsampler_fn(data, out_size):
                                      recompute_scale_factor=None, 
                                      #antialias=False
     )
-    return out.to(data.get_device())
+    return out.to(data.device)
 
 
 # **************************************************
@@ -919,7 +963,10 @@ class Decoder(nn.Module):
                             attn_drop_rate=config['attn_drop_rate'],
                             norm_layer=nn.LayerNorm,
                             layer_scale=1e-5,
-                            img_size=img_size
+                            img_size=img_size,
+                            attention_impl=config.get('attention_impl', 'naive'),
+                            attention_chunk_size=config.get('attention_chunk_size', 4096),
+                            rel_pos_bias=config.get('rel_pos_bias', False)
                     ))
         if  self._msa and self.msa_seg:
             self._seg_head = nn.ModuleList()
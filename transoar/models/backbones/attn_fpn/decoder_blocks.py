@@ -8,6 +8,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from transoar.models.ops.modules import MSDeformAttn
+from transoar.utils.cache import TENSOR_CACHE
 
 
 class DecoderDefAttnBlock(nn.Module):
@@ -63,6 +64,8 @@ class DecoderDefAttnBlock(nn.Module):
         return valid_ratio
 
     def forward(self, fmaps, pos_embeds):
+        channels_last = fmaps[0].is_contiguous(memory_format=torch.channels_last_3d)
+
         # prepare input for refinement
         src_flatten = []
         lvl_pos_embed_flatten = []
@@ -71,7 +74,7 @@ class DecoderDefAttnBlock(nn.Module):
             bs, c, d, h, w = src.shape
             spatial_shape = (d, h, w)
             spatial_shapes.append(spatial_shape)
-            src = src.flatten(2).transpose(1, 2)                                # [Batch, Patches, HiddenDim]   
+            src = src.permute(0, 2, 3, 4, 1).flatten(1, 3)                     # [Batch, Patches, HiddenDim], a view also for channels_last_3d
             pos_embed = pos_embed.flatten(2).transpose(1, 2)                    # [Batch, Patches, HiddenDim]
             lvl_pos_embed = pos_embed + self.level_embed[lvl].view(1, 1, -1)    # [Batch, Patches, HiddenDim]
             lvl_pos_embed_flatten.append(lvl_pos_embed)
@@ -93,7 +96,10 @@ class DecoderDefAttnBlock(nn.Module):
         # Prepare output
         out_shapes = [[bs, c] + shape.tolist() for shape in spatial_shapes]
         fmaps = torch.split(memory, spatial_shapes.prod(axis=-1).tolist(), dim=1)
-        fmaps = [fmap.transpose(-1, -2).reshape(shape) for fmap, shape in zip(fmaps, out_shapes)]
+        if channels_last:   # keep the layout of the input fmaps without copying
+            fmaps = [fmap.unflatten(1, shape[2:]).permute(0, 4, 1, 2, 3) for fmap, shape in zip(fmaps, out_shapes)]
+        else:
+            fmaps = [fmap.transpose(-1, -2).reshape(shape) for fmap, shape in zip(fmaps, out_shapes)]
 
         return fmaps
 
@@ -106,6 +112,14 @@ class DefAttnTransformer(nn.Module):
 
     @staticmethod
     def get_reference_points(spatial_shapes, device):
+        # Only depends on the spatial shapes, cached over steps
+        key = (tuple(map(tuple, spatial_shapes.tolist())), device)
+        return TENSOR_CACHE.get(
+            'attn_fpn_ref_points', key, lambda: DefAttnTransformer._compute_reference_points(spatial_shapes, device)
+        )
+
+    @staticmethod
+    def _compute_reference_points(spatial_shapes, device):
         # No mask in use
         valid_ratios = torch.ones_like(spatial_shapes, dtype=torch.float)[None]
 
@@ -169,7 +183,7 @@ class DefAttnLayer(nn.Module):
 
     def forward(self, src, pos, reference_points, spatial_shapes, level_start_index, padding_mask=None):
         # self attention -> query and input_flatten are the same
-        src2 = self.self_attn(self.with_pos_embed(src, pos), reference_points, src, spatial_shapes, level_start_index, padding_mask)
+        src2, _ = self.self_attn(self.with_pos_embed(src, pos), reference_points, src, spatial_shapes, level_start_index, padding_mask)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
 
@@ -1,6 +1,6 @@
 """Module containing code of the backbones encoder blocks."""
 
-from functools import reduce, lru_cache
+from functools import reduce
 from operator import mul
 
 import torch
@@ -10,6 +10,8 @@ import numpy as np
 from timm.models.layers import DropPath, trunc_normal_
 from einops import rearrange
 
+from transoar.utils.cache import TENSOR_CACHE
+
 
 class EncoderCnnBlock(nn.Module):
     def __init__(
@@ -391,9 +393,12 @@ def get_window_size(x_size, window_size, shift_size=None):
     else:
         return tuple(use_window_size), tuple(use_shift_size)
 
-# cache each stage results
-@lru_cache()
 def compute_mask(D, H, W, window_size, shift_size, device):
+    # Cache the mask of each stage
+    key = (D, H, W, tuple(window_size), tuple(shift_size), device)
+    return TENSOR_CACHE.get('swin_attn_mask', key, lambda: _compute_mask(D, H, W, window_size, shift_size, device))
+
+def _compute_mask(D, H, W, window_size, shift_size, device):
     img_mask = torch.zeros((1, D, H, W, 1), device=device)  # 1 Dp Hp Wp 1
     cnt = 0
     for d in slice(-window_size[0]), slice(-window_size[0], -shift_size[0]), slice(-shift_size[0],None):
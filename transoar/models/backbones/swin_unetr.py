@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import os
+import inspect
 from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
 from monai.metrics import DiceMetric
@@ -27,10 +28,12 @@ class Swin_UNETR(nn.Module):
         pretrained = cfg.get('pretrained', False)
         self.out_fmaps = cfg['out_fmaps']
 
+        # img_size was only checked against the input and is removed since monai 1.5
+        size_kwargs = {'img_size': img_size} if 'img_size' in inspect.signature(SwinUNETR.__init__).parameters else {}
         
         if pretrained:
             self.swin_unetr = SwinUNETR(
-                img_size=img_size,
+                **size_kwargs,
                 in_channels=1,
                 out_channels=14,
                 feature_size=48,
@@ -43,7 +46,7 @@ class Swin_UNETR(nn.Module):
             print("Use pretrained weights")
         else:
             self.swin_unetr = SwinUNETR(
-                img_size=img_size,
+                **size_kwargs,
                 in_channels=in_channels,
                 out_channels=out_channels,
                 feature_size=feature_size,
@@ -1,10 +1,14 @@
 """Module containing functionality to build different parts of the model."""
 
+import torch
+from torch import nn
+
 from transoar.models.matcher import HungarianMatcher
 from transoar.models.criterion import TransoarCriterion
 from transoar.models.backbones.attn_fpn.attn_fpn import AttnFPN
 from transoar.models.necks.def_detr_transformer import DeformableTransformer
 from transoar.models.position_encoding import PositionEmbeddingSine3D, PositionEmbeddingLearned3D
+from transoar.models.activation_checkpointing import apply_activation_checkpointing, CHECKPOINT_GROUPS
 
 from transoar.models.backbones.resnet3d import ResNet3D
 from transoar.models.backbones.fpn import FPN
@@ -17,15 +21,31 @@ import os
 
 def build_backbone(config):
     if config['name'].lower() in ['attn_fpn']:
-        return AttnFPN(config)
+        model = AttnFPN(config)
     elif config['name'].lower() in ['fpn']:
-        return FPN(config)
+        model = FPN(config)
     elif config['name'].lower() in ['msavit']:
-        return MSAViT(config)
+        model = MSAViT(config)
     elif config['name'].lower() in ['resnet']:
-        return ResNet3D(config)
+        model = ResNet3D(config)
     elif config['name'].lower() in ['swin_unetr']:
-        return Swin_UNETR(config)
+        model = Swin_UNETR(config)
+    else:
+        return None
+
+    if config.get('channels_last', False):
+        to_channels_last_3d(model)
+    apply_activation_checkpointing(
+        model, config.get('activation_checkpointing', []), CHECKPOINT_GROUPS[config['name'].lower()], 'backbone'
+    )
+    return model
+
+def to_channels_last_3d(model):
+    """Converts the 3D conv weights of model to NDHWC, so that convs keep channels_last_3d inputs in this layout."""
+    for module in model.modules():
+        if isinstance(module, (nn.Conv3d, nn.ConvTranspose3d)):
+            module.weight.data = module.weight.data.contiguous(memory_format=torch.channels_last_3d)
+    return model
 
 def build_neck(config):
     model = DeformableTransformer(
@@ -51,6 +71,7 @@ def build_neck(config):
         dn=config.get('dn', {}).get('enabled', False),
     ) 
 
+    apply_activation_checkpointing(model, config.get('activation_checkpointing', []), CHECKPOINT_GROUPS['def_detr'], 'neck')
     return model
 
 def build_criterion(config):
@@ -0,0 +1,55 @@
+"""Class-subset inference shared by the detectors, which prunes the queries and head rows of other classes."""
+
+import itertools
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class ClassSubsetMixin:
+    """Adds set_inference_classes() to a detector.
+
+    The detector has to set self._query_split, the number of queries of each class with class
+    matching or [] otherwise, as well as self.two_stage and self.num_patterns.
+    """
+    _inference_query_ids = None
+    _inference_class_ids = None
+
+    def set_inference_classes(self, classes=None):
+        """Restricts inference to a subset of organs, None restores all classes.
+
+        Requires class matching with a query split, so that the queries assigned to other classes
+        are dropped before the decoder. Only the classification head rows of the background and
+        the requested classes are evaluated, out['class_ids'] maps the logits back to class ids.
+        """
+        if classes is None:
+            self._inference_query_ids, self._inference_class_ids = None, None
+            return
+
+        assert self._query_split, "class-subset inference requires class_matching with class_matching_query_split"
+        assert not self.two_stage and self.num_patterns == 0, "class-subset inference not supported for two stage and query patterns"
+        classes = sorted(set(int(class_) for class_ in classes))
+        assert all(1 <= class_ <= len(self._query_split) for class_ in classes), "requested class without query group"
+
+        group_starts = [0] + list(itertools.accumulate(self._query_split))
+        self._inference_query_ids = torch.cat([torch.arange(group_starts[class_ - 1], group_starts[class_]) for class_ in classes])
+        self._inference_class_ids = torch.tensor([0] + classes)
+
+    def _class_subset_active(self):
+        return self._inference_class_ids is not None and not self.training
+
+    def _select_queries(self, query_embeds):
+        """Drops the queries assigned to other classes before the decoder."""
+        return query_embeds[self._inference_query_ids.to(query_embeds.device)]
+
+    def _classify(self, cls_head, hs_lvl, class_subset):
+        """Returns the class logits of the decoder output hs_lvl, only of the requested classes for class_subset."""
+        if not class_subset:
+            return cls_head(hs_lvl)
+
+        # Only evaluate head rows of background and requested classes
+        class_ids = self._inference_class_ids.to(hs_lvl.device)
+        if isinstance(cls_head, nn.Linear):
+            return F.linear(hs_lvl, cls_head.weight[class_ids], cls_head.bias[class_ids])
+        return cls_head(hs_lvl)[..., class_ids] # quantized head without float weights
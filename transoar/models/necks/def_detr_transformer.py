@@ -7,6 +7,7 @@ import torch.nn.functional as F
 from torch import nn
 
 from transoar.models.ops.modules import MSDeformAttn
+from transoar.utils.cache import TENSOR_CACHE
 
 
 
@@ -69,23 +70,38 @@ class DeformableTransformerEncoder(nn.Module):
 
     @staticmethod
     def get_reference_points(spatial_shapes, valid_ratios, device):
-        reference_points_list = []
+        # Patch centers only depend on the spatial shapes, cached over steps
+        key = (tuple(map(tuple, spatial_shapes.tolist())), device)
+        centers, sizes, levels = TENSOR_CACHE.get(
+            'encoder_patch_centers', key, lambda: DeformableTransformerEncoder._get_patch_centers(key[0], device)
+        )
+
+        def compute():
+            # Get relative coords in range [0, 1], ref points in masked areas have values > 1
+            reference_points = centers[None] / (valid_ratios[:, levels] * sizes[None])  # [Batch, AllLvlPatches, RelativeRefCoords]
+            return reference_points[:, :, None] * valid_ratios[:, None] # Valid ratio also in format WHD/XYZ
+
+        # Without padding, also the reference points only depend on the shapes
+        if bool((valid_ratios == 1).all()):
+            return TENSOR_CACHE.get('encoder_ref_points', key + (valid_ratios.shape[0],), compute)
+        return compute()
+
+    @staticmethod
+    def _get_patch_centers(spatial_shapes, device):
+        """Returns the centers and level sizes of all patches in format WHD/XYZ and their levels."""
+        centers_list, sizes_list, levels_list = [], [], []
         for lvl, (D_, H_, W_) in enumerate(spatial_shapes):
 
             ref_z, ref_y, ref_x = torch.meshgrid(
                 torch.linspace(0.5, D_ - 0.5, D_, dtype=torch.float32, device=device),
                 torch.linspace(0.5, H_ - 0.5, H_, dtype=torch.float32, device=device),
-                torch.linspace(0.5, W_ - 0.5, W_, dtype=torch.float32, device=device)
+                torch.linspace(0.5, W_ - 0.5, W_, dtype=torch.float32, device=device),
+                indexing='ij'
             )
-            # Get relative coords in range [0, 1], ref points in masked areas have values > 1
-            ref_z = ref_z.reshape(-1)[None] / (valid_ratios[:, None, lvl, 2] * D_)
-            ref_y = ref_y.reshape(-1)[None] / (valid_ratios[:, None, lvl, 1] * H_)
-            ref_x = ref_x.reshape(-1)[None] / (valid_ratios[:, None, lvl, 0] * W_)
-            ref = torch.stack((ref_x, ref_y, ref_z), -1)    # Coords in format WHD/XYZ
-            reference_points_list.append(ref)
-        reference_points = torch.cat(reference_points_list, 1)  # [Batch, AllLvlPatches, RelativeRefCoords]
-        reference_points = reference_points[:, :, None] * valid_ratios[:, None] # Valid ratio also in format WHD/XYZ
-        return reference_points
+            centers_list.append(torch.stack((ref_x.reshape(-1), ref_y.reshape(-1), ref_z.reshape(-1)), -1))
+            sizes_list.append(torch.tensor([W_, H_, D_], dtype=torch.float32, device=device).expand(D_ * H_ * W_, 3))
+            levels_list.append(torch.full((D_ * H_ * W_,), lvl, dtype=torch.long, device=device))
+        return torch.cat(centers_list), torch.cat(sizes_list), torch.cat(levels_list)
 
     def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None):
         output = src
@@ -206,10 +222,12 @@ class DeformableTransformerDecoder(nn.Module):
             self.high_dim_query_proj = MLP(d_model, d_model, d_model, 3)
 
     def forward(self, tgt, reference_points, src, src_spatial_shapes, src_level_start_index, src_valid_ratios,
-                query_pos=None, src_padding_mask=None, self_attn_mask=None):
+                query_pos=None, src_padding_mask=None, self_attn_mask=None, exit_fn=None, prune_fn=None):
         output = tgt
         intermediate = []
         intermediate_reference_points = []
+        active_ids = None           # indices of the decoded queries once queries are pruned, [Batch, ActiveQueries]
+        full_attn_mask = self_attn_mask
         for lid, layer in enumerate(self.layers):
             if reference_points.shape[-1] == self.num_classes+7: # query contrast is enabled
                 reference_points_def = reference_points[:, :, :6] # input for deformable attention
@@ -229,6 +247,11 @@ class DeformableTransformerDecoder(nn.Module):
 
             reference_points_input = reference_points_def
             output = layer(lid, output, query_pos, reference_points_input, src, src_spatial_shapes, src_level_start_index, src_padding_mask, reference_points, self_attn_mask)
+
+            # Adaptive inference, exit_fn predicts from the output and input references of the layer
+            exit_ = exit_fn is not None and exit_fn(
+                lid, output, reference_points[:, :, :6] if reference_points.shape[-1] == self.num_classes+7 else reference_points
+            )
             
             # hack implementation for iterative bounding box refinement
             if self.bbox_embed is not None:
@@ -255,18 +278,54 @@ class DeformableTransformerDecoder(nn.Module):
                     new_reference_points = new_reference_points.sigmoid()
                     reference_points = new_reference_points.detach()
 
+            # Pruned queries keep the output and reference points of the layer they were pruned after
+            if active_ids is None:
+                output_all, reference_points_all = output, reference_points
+            else:
+                output_all = _scatter_queries(output_all, active_ids, output)
+                reference_points_all = _scatter_queries(reference_points_all, active_ids, reference_points)
+
             if self.return_intermediate:
-                intermediate.append(output)
-                if reference_points.shape[-1] == self.num_classes+7:
-                    intermediate_reference_points.append(reference_points[:, :, :6])
+                intermediate.append(output_all)
+                if reference_points_all.shape[-1] == self.num_classes+7:
+                    intermediate_reference_points.append(reference_points_all[:, :, :6])
                 else:
-                    assert reference_points.shape[-1] == 6 or reference_points.shape[-1] == 3
-                    intermediate_reference_points.append(reference_points)
+                    assert reference_points_all.shape[-1] == 6 or reference_points_all.shape[-1] == 3
+                    intermediate_reference_points.append(reference_points_all)
+
+            # Progressive query pruning, prune_fn records the decoded queries of every layer, including the
+            # exiting one, and returns a mask of the queries the next layers decode
+            keep = prune_fn(lid, output, exit_) if prune_fn is not None else None
+            if exit_:
+                break
+
+            if keep is not None and not keep.all():
+                ids = _get_keep_ids(keep)
+                output, reference_points = _gather_queries(output, ids), _gather_queries(reference_points, ids)
+                if query_pos is not None:
+                    query_pos = _gather_queries(query_pos, ids)
+                active_ids = ids if active_ids is None else active_ids.gather(1, ids)
+                if full_attn_mask is not None:
+                    assert full_attn_mask.dim() == 2, "query pruning requires a self attention mask shared by the batch"
+                    self_attn_mask = full_attn_mask[active_ids[:, :, None], active_ids[:, None, :]].repeat_interleave(layer.nheads, 0)
 
         if self.return_intermediate:
             return torch.stack(intermediate), torch.stack(intermediate_reference_points)
 
-        return output, reference_points
+        return output_all, reference_points_all
+
+
+def _get_keep_ids(keep):
+    """Returns the sorted indices of the kept queries, padded with pruned ones to the same number per batch element."""
+    num_keep = max(int(keep.sum(1).max()), 1)
+    ids = torch.sort((~keep).int(), dim=1, stable=True)[1][:, :num_keep]
+    return ids.sort(dim=1)[0]
+
+def _gather_queries(tensor, ids):
+    return tensor.gather(1, ids[..., None].expand(-1, -1, tensor.shape[-1]))
+
+def _scatter_queries(tensor, ids, values):
+    return tensor.scatter(1, ids[..., None].expand(-1, -1, values.shape[-1]), values)
 
 
 def _get_clones(module, N):
@@ -517,7 +576,7 @@ class DeformableTransformer(nn.Module):
         output_memory = self.enc_output_norm(self.enc_output(output_memory))
         return output_memory, output_proposals
     
-    def forward(self, srcs, masks, query_embed, pos_embeds, dn_mask=None, noised_gt_box=None, noised_gt_onehot=None, targets=None):
+    def forward(self, srcs, masks, query_embed, pos_embeds, dn_mask=None, noised_gt_box=None, noised_gt_onehot=None, targets=None, exit_fn=None, prune_fn=None):
         assert self.two_stage or query_embed is not None
         
         # prepare input for encoder
@@ -529,7 +588,7 @@ class DeformableTransformer(nn.Module):
             bs, c, d, h, w = src.shape
             spatial_shape = (d, h, w)
             spatial_shapes.append(spatial_shape)
-            src = src.flatten(2).transpose(1, 2)                                # [Batch, Patches, HiddenDim]   
+            src = src.permute(0, 2, 3, 4, 1).flatten(1, 3)                     # [Batch, Patches, HiddenDim], a view also for channels_last_3d
             mask = mask.flatten(1)                                              # [Batch, Patches ]
             pos_embed = pos_embed.flatten(2).transpose(1, 2)                    # [Batch, Patches, HiddenDim]
             lvl_pos_embed = pos_embed + self.level_embed[lvl].view(1, 1, -1)    # [Batch, Patches, HiddenDim]
@@ -631,7 +690,8 @@ class DeformableTransformer(nn.Module):
         # decoder
         hs, inter_references_out = self.decoder(
             tgt, reference_points, memory, spatial_shapes, level_start_index, valid_ratios, 
-            query_pos=query_embed if not self.use_dab else None, src_padding_mask=mask_flatten, self_attn_mask=dn_mask
+            query_pos=query_embed if not self.use_dab else None, src_padding_mask=mask_flatten, self_attn_mask=dn_mask,
+            exit_fn=exit_fn, prune_fn=prune_fn
         )
 
 
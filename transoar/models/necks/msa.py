@@ -254,7 +254,8 @@ class Attention(nn.Module):
             Tensor: Processed global query tensor.
         """
         q_tmp: Tensor = q_ms.reshape(B, self.num_heads, N, C // self.num_heads)
-        div_, rem_ = divmod(B_, B)
+        div_ = B_ // B     # divmod does not support the traced sizes of torch.jit.trace
+        rem_ = B_ - B * div_
         q_tmp = q_tmp.repeat(div_, 1, 1, 1)
         q_tmp = q_tmp.reshape(B * div_, self.num_heads, N, C // self.num_heads)
         
@@ -653,7 +654,7 @@ def downsampler_fn(data, out_size):
                                      recompute_scale_factor=None, 
                                      #antialias=False
     )
-    return out.to(data.get_device())
+    return out.to(data.device)
 
 
 class MSAEncoder(nn.Module):
@@ -10,6 +10,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import itertools
+
 import torch
 import torch.nn.functional as F
 from torch.autograd import Function
@@ -63,3 +65,41 @@ def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations,
     attention_weights = attention_weights.transpose(1, 2).reshape(N_*M_, 1, Lq_, L_*P_)
     output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1).view(N_, M_*D_, Lq_)
     return output.transpose(1, 2).contiguous()
+
+
+def ms_deform_attn_core_exportable(value, value_spatial_shapes, sampling_locations, attention_weights):
+    """Same as ms_deform_attn_core_pytorch, but samples with gathers instead of the 3D grid_sample.
+
+    Trilinear interpolation with zero padding and align_corners=False is computed from the eight
+    neighbouring voxels of each sampling location, which only needs ops that TorchScript and ONNX
+    export on every opset.
+    """
+    N_, S_, M_, D_ = value.shape
+    _, Lq_, M_, L_, P_, _ = sampling_locations.shape
+
+    # Split projection of input features back into individual levels
+    value_list = value.split([D_ * H_ * W_ for D_, H_, W_ in value_spatial_shapes], dim=1)
+
+    sampling_value_list = []
+    for lid_, (D, H, W) in enumerate(value_spatial_shapes):
+        value_l_ = value_list[lid_].flatten(2).transpose(1, 2).reshape(N_*M_, D_, D*H*W)                           # [Batch*NumHeads, FeatureDim, D*H*W]
+        sampling_locations_l_ = sampling_locations[:, :, :, lid_].transpose(1, 2).reshape(N_*M_, Lq_*P_, 3)        # [Batch*NumHeads, AllLvlPatches*NumPoints, Offset]
+
+        # Voxel coordinates of the sampling locations, which are in format WHD/XYZ
+        x = sampling_locations_l_[..., 0] * W - 0.5
+        y = sampling_locations_l_[..., 1] * H - 0.5
+        z = sampling_locations_l_[..., 2] * D - 0.5
+        x0, y0, z0 = x.floor(), y.floor(), z.floor()
+
+        sampling_value_l_ = 0
+        for corner_z, corner_y, corner_x in itertools.product([z0, z0 + 1], [y0, y0 + 1], [x0, x0 + 1]):
+            weight = (1 - (x - corner_x).abs()) * (1 - (y - corner_y).abs()) * (1 - (z - corner_z).abs())
+            valid = (corner_x >= 0) & (corner_x <= W - 1) & (corner_y >= 0) & (corner_y <= H - 1) & (corner_z >= 0) & (corner_z <= D - 1)
+            index = (corner_z.clamp(0, D - 1) * H + corner_y.clamp(0, H - 1)) * W + corner_x.clamp(0, W - 1)
+            corner_value = value_l_.gather(2, index.long()[:, None].expand(-1, D_, -1))                            # [Batch*NumHeads, FeatureDim, AllLvlPatches*NumPoints]
+            sampling_value_l_ = sampling_value_l_ + corner_value * (weight * valid)[:, None]
+        sampling_value_list.append(sampling_value_l_.view(N_*M_, D_, Lq_, P_))
+
+    attention_weights = attention_weights.transpose(1, 2).reshape(N_*M_, 1, Lq_, L_*P_)
+    output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1).view(N_, M_*D_, Lq_)
+    return output.transpose(1, 2).contiguous()
@@ -18,7 +18,7 @@ from torch import nn
 import torch.nn.functional as F
 from torch.nn.init import xavier_uniform_, constant_
 
-from transoar.models.ops.functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_core_pytorch
+from transoar.models.ops.functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_core_pytorch, ms_deform_attn_core_exportable
 
 
 def _is_power_of_2(n):
@@ -52,6 +52,7 @@ class MSDeformAttn(nn.Module):
         self.n_heads = n_heads
         self.n_points = n_points
         self.use_cuda = use_cuda
+        self.exportable = False     # set by export_model to sample without the 3D grid_sample
 
         self.sampling_offsets = nn.Linear(d_model, n_heads * n_levels * n_points * 3)   # 3 -> offset of ref coords 
         self.attention_weights = nn.Linear(d_model, n_heads * n_levels * n_points)
@@ -142,6 +143,8 @@ class MSDeformAttn(nn.Module):
             output = MSDeformAttnFunction.apply(
                 value, input_spatial_shapes, input_level_start_index, sampling_locations, attention_weights, self.im2col_step
             )
+        elif self.exportable:
+            output = ms_deform_attn_core_exportable(value, input_spatial_shapes, sampling_locations, attention_weights)
         else:
             output = ms_deform_attn_core_pytorch(value, input_spatial_shapes, sampling_locations, attention_weights)
 
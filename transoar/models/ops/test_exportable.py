@@ -0,0 +1,85 @@
+# ------------------------------------------------------------------------------------------------
+# Checks the exportable sampling of the deformable attention against the grid_sample path on CPU.
+# Run from this directory: python test_exportable.py
+# ------------------------------------------------------------------------------------------------
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import torch
+
+from functions.ms_deform_attn_func import ms_deform_attn_core_pytorch, ms_deform_attn_core_exportable
+
+
+N, M, C = 2, 3, 4
+Lq, L, P = 5, 2, 4
+shapes = torch.as_tensor([(3, 6, 4), (2, 3, 2)], dtype=torch.long)
+S = sum([(D*H*W).item() for D, H, W in shapes])
+
+
+def get_inputs(sampling_locations, dtype=torch.double):
+    generator = torch.Generator().manual_seed(0)
+    value = torch.rand(N, S, M, C, generator=generator, dtype=dtype)
+    attention_weights = torch.rand(N, Lq, M, L, P, generator=generator, dtype=dtype) + 1e-5
+    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    return value, sampling_locations.to(dtype), attention_weights
+
+def border_locations():
+    """Locations on the faces and corners of the volume and on the centers of the outermost voxels of each level."""
+    generator = torch.Generator().manual_seed(1)
+    sampling_locations = torch.rand(N, Lq, M, L, P, 3, generator=generator)
+    sampling_locations[:, 0] = torch.randint(0, 2, (N, M, L, P, 3), generator=generator).float()     # Corners
+    sampling_locations[:, 1, ..., 0] = 0                                                                # Faces
+    sampling_locations[:, 2, ..., 1] = 1
+    for lid_, (D, H, W) in enumerate(shapes.tolist()):                                                  # Outermost voxel centers
+        sampling_locations[:, 3, :, lid_, :, 0] = 0.5 / W
+        sampling_locations[:, 3, :, lid_, :, 1] = 1 - 0.5 / H
+        sampling_locations[:, 3, :, lid_, :, 2] = 0.5 / D
+    return sampling_locations
+
+def outside_locations():
+    """Locations partially outside, i.e., within half a voxel of the volume, and completely outside of it."""
+    generator = torch.Generator().manual_seed(2)
+    sampling_locations = torch.rand(N, Lq, M, L, P, 3, generator=generator)
+    sampling_locations[:, 0, ..., 0] = -0.1
+    sampling_locations[:, 1, ..., 1] = 1.1
+    sampling_locations[:, 2] = torch.rand(N, M, L, P, 3, generator=generator) * 4 - 1.5
+    sampling_locations[:, 3] = -2
+    sampling_locations[:, 4] = 3
+    return sampling_locations
+
+@torch.no_grad()
+def check_forward_equal_with_pytorch(name, sampling_locations, dtype=torch.double, atol=1e-10):
+    value, sampling_locations, attention_weights = get_inputs(sampling_locations, dtype)
+    output_pytorch = ms_deform_attn_core_pytorch(value, shapes, sampling_locations, attention_weights)
+    output_exportable = ms_deform_attn_core_exportable(value, shapes, sampling_locations, attention_weights)
+    fwdok = torch.allclose(output_exportable, output_pytorch, rtol=0, atol=atol)
+    max_abs_err = (output_exportable - output_pytorch).abs().max()
+
+    print(f'* {fwdok} check_forward_equal_with_pytorch_{name}: max_abs_err {max_abs_err:.2e}')
+    assert fwdok, f'exportable sampling differs from grid_sample for {name} locations'
+
+def check_gradient_equal_with_pytorch(name, sampling_locations, atol=1e-10):
+    grads = []
+    for func in [ms_deform_attn_core_pytorch, ms_deform_attn_core_exportable]:
+        inputs = [input_.requires_grad_() for input_ in get_inputs(sampling_locations)]
+        func(inputs[0], shapes, *inputs[1:]).sum().backward()
+        grads.append([input_.grad for input_ in inputs])
+
+    # Gradients wrt. the locations differ where the interpolation is not differentiable, i.e., on voxel centers
+    gradok = all(torch.allclose(grad_exportable, grad_pytorch, rtol=0, atol=atol) for grad_pytorch, grad_exportable in zip(grads[0][::2], grads[1][::2]))
+    max_abs_err = max((grad_exportable - grad_pytorch).abs().max() for grad_pytorch, grad_exportable in zip(grads[0][::2], grads[1][::2]))
+
+    print(f'* {gradok} check_gradient_equal_with_pytorch_{name}: max_abs_err {max_abs_err:.2e}')
+    assert gradok, f'gradients of the exportable sampling differ from grid_sample for {name} locations'
+
+
+if __name__ == '__main__':
+    generator = torch.Generator().manual_seed(3)
+    random_locations = torch.rand(N, Lq, M, L, P, 3, generator=generator)
+
+    for name, sampling_locations in [('random', random_locations), ('border', border_locations()), ('outside', outside_locations())]:
+        check_forward_equal_with_pytorch(name + '_double', sampling_locations)
+        check_forward_equal_with_pytorch(name + '_float', sampling_locations, dtype=torch.float, atol=1e-6)
+        check_gradient_equal_with_pytorch(name, sampling_locations)
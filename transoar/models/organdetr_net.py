@@ -14,13 +14,16 @@ from pathlib import Path
 import os, re
 
 from transoar.models.build import build_backbone, build_neck, build_pos_enc
+from transoar.models.activation_checkpointing import apply_activation_checkpointing, CHECKPOINT_GROUPS
 from transoar.models.necks.def_detr_transformer import inverse_sigmoid
 from transoar.models.necks.msa import MSAEncoder
 from transoar.models.necks.cdn import dn_post_process, prepare_for_cdn, prepare_for_dn
 from transoar.models.matcher import HungarianMatcher
+from transoar.models.class_subset import ClassSubsetMixin
+from transoar.inference import inference, predictions_stable
 from transoar.utils.io import load_json
 
-class OrganDetrNet(nn.Module):
+class OrganDetrNet(ClassSubsetMixin, nn.Module):
     def __init__(self, config, num_organs=None):
         super().__init__()
 
@@ -53,8 +56,13 @@ class OrganDetrNet(nn.Module):
         # Use auxiliary decoding losses if required
         self._aux_loss = config['neck']['aux_loss']
 
+        # Class-subset inference, only possible if queries are assigned to classes
+        self._query_split = config.get('class_matching_query_split', []) if config.get('class_matching', False) else []
+        self._early_exit = None
+
         # Get backbone
         self._backbone = build_backbone(config['backbone'])
+        self._channels_last = config['backbone'].get('channels_last', False)  # input batches in NDHWC layout
         self._backbone_name = config['backbone']['name']
 
         # Get neck
@@ -62,6 +70,9 @@ class OrganDetrNet(nn.Module):
         config['neck']['msa']['out_fmaps'] = config['backbone']['out_fmaps']
         config['neck']['msa']['data_size'] = config['backbone']['data_size']
         self.MSAEncoder = MSAEncoder(config['neck']['msa'])
+        apply_activation_checkpointing(
+            self.MSAEncoder, config['neck']['msa'].get('activation_checkpointing', []), CHECKPOINT_GROUPS['msa_encoder'], 'msa_encoder'
+        )
         self._neck = build_neck(config['neck'])
 
         # Get heads
@@ -140,7 +151,46 @@ class OrganDetrNet(nn.Module):
             self.label_enc = nn.Embedding(self.num_classes + 1, self.hidden_dim)
         assert not (self.hybrid and self.dn['enabled']), "incompatible matching modes enabled"
         assert not (self.hybrid and config.get('dense_q_matching', False)), "incompatible matching modes enabled"
+
+        # Query pruning in the decoder, disabled if not configured
+        self.set_query_pruning(**config['neck'].get('query_pruning', {}))
         
+    def set_early_exit(self, iou_threshold=None, score_threshold=0.05, min_layers=1):
+        """Stops the decoder at inference once the predictions are stable, None runs all layers.
+
+        After every decoder layer, the heads predict from its output and inference() selects the
+        best query per class. Decoding stops once these predictions agree with the ones of the
+        previous layer, see predictions_stable(). out['num_decoder_layers'] reports the layers run.
+
+        Args:
+            iou_threshold: Min. IoU of the boxes of each class between consecutive layers.
+            score_threshold: Max. change of the scores of each class between consecutive layers.
+            min_layers: Number of layers that always run.
+        """
+        if iou_threshold is None:
+            self._early_exit = None
+            return
+        self._early_exit = {'iou_threshold': iou_threshold, 'score_threshold': score_threshold, 'min_layers': min_layers}
+
+    def set_query_pruning(self, threshold=None, layer=1, training=False):
+        """Drops queries from the decoder whose background probability exceeds threshold, None decodes all queries.
+
+        Pruning starts after decoder layer layer and is repeated after every following layer on the
+        remaining queries. Pruned queries keep the output of the layer they were pruned after, i.e.,
+        the predictions of all queries are returned in their original order. out['num_active_queries']
+        reports the number of queries each layer decoded.
+
+        Args:
+            threshold: Background probability above which queries are pruned.
+            layer: Number of decoder layers run with all queries.
+            training: Prune queries also while training, not supported with denoising queries.
+        """
+        if threshold is None:
+            self._query_pruning = None
+            return
+        assert not (training and self.dn['enabled']), "query pruning while training would drop denoising queries"
+        self._query_pruning = {'threshold': threshold, 'layer': layer, 'training': training}
+
     def _reset_parameter(self):
         nn.init.constant_(self._bbox_reg_head.layers[-1].weight.data, 0)
         nn.init.constant_(self._bbox_reg_head.layers[-1].bias.data, 0)
@@ -150,6 +200,8 @@ class OrganDetrNet(nn.Module):
     def forward(self, x, targets=None, num_epoch: int=-1): # in trainer, None when !self.training
         # targets: list of dict{'boxes': , 'labels':}
 
+        if self._channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
         out_backbone = self._backbone(x)
 
         # pass throug msa encoder here
@@ -212,6 +264,13 @@ class OrganDetrNet(nn.Module):
         else:
             query_embeds = self.query_embed.weight
 
+        class_subset = self._class_subset_active()
+        early_exit = self._early_exit is not None and not self.training
+        query_pruning = self._query_pruning is not None and (self._query_pruning['training'] or not self.training)
+        active_queries = []
+        if class_subset: # drop queries assigned to other classes before the decoder
+            query_embeds = self._select_queries(query_embeds)
+
         
 
         if self.training and self.dn['enabled'] and self.dn['dn_number'] > 0 and num_epoch%2 ==0:
@@ -243,7 +302,7 @@ class OrganDetrNet(nn.Module):
             dn_mask = None
             dn_meta = None
         
-        if self.hybrid:
+        if self.hybrid and not class_subset:
             dn_mask = (torch.zeros([self.num_queries,self.num_queries,]).bool().to(det_srcs[-1].device)) # attn mask to limit attn to O2O
             dn_mask[self.num_queries_one2one :,0 : self.num_queries_one2one,] = True
             dn_mask[0 : self.num_queries_one2one,self.num_queries_one2one :,] = True
@@ -257,6 +316,8 @@ class OrganDetrNet(nn.Module):
             input_query_bbox,
             input_query_label,
             targets,
+            exit_fn=self._get_exit_fn(class_subset) if early_exit else None,
+            prune_fn=self._get_prune_fn(class_subset, active_queries) if query_pruning else None,
         )
 
 
@@ -278,22 +339,7 @@ class OrganDetrNet(nn.Module):
                 reference = init_reference_out
             else:
                 reference = inter_references_out[lvl - 1]
-            reference = inverse_sigmoid(reference)
-
-            if self.box_refine:
-                outputs_class = self._cls_head[lvl](hs[lvl])
-                tmp = self._bbox_reg_head[lvl](hs[lvl])
-            else:
-                outputs_class = self._cls_head(hs[lvl])
-                tmp = self._bbox_reg_head(hs[lvl])
-
-            if reference.shape[-1] == 6:
-                tmp += reference
-            else:
-                assert reference.shape[-1] == 3
-                tmp[..., :3] += reference
-
-            outputs_coord = tmp.sigmoid()
+            outputs_class, outputs_coord = self._predict_layer(lvl, hs[lvl], reference, class_subset)
             
             if self.hybrid and self.training:
                 outputs_classes.append(outputs_class[:, 0 : self.num_queries_one2one])
@@ -377,6 +423,12 @@ class OrganDetrNet(nn.Module):
                 }
             if self._aux_loss:
                 out['aux_outputs'] = self._set_aux_loss(pred_logits[:, : self.num_queries], pred_boxes[:, : self.num_queries])
+            if class_subset:
+                out['class_ids'] = self._inference_class_ids
+            if early_exit:
+                out['num_decoder_layers'] = hs.shape[0]
+            if query_pruning:
+                out['num_active_queries'] = active_queries
 
         if  self._msa_seg: 
             out.update({'neck_enc_seg': neck_enc_seg})
@@ -393,6 +445,58 @@ class OrganDetrNet(nn.Module):
             self.num_queries = save_num_queries
         return out
 
+    def _predict_layer(self, lvl, hs_lvl, reference, class_subset):
+        """Predicts class logits and boxes from the output and input reference points of a decoder layer."""
+        reference = inverse_sigmoid(reference)
+
+        outputs_class = self._predict_class(lvl, hs_lvl, class_subset)
+        tmp = self._bbox_reg_head[lvl](hs_lvl) if self.box_refine else self._bbox_reg_head(hs_lvl)
+
+        if reference.shape[-1] == 6:
+            tmp += reference
+        else:
+            assert reference.shape[-1] == 3
+            tmp[..., :3] += reference
+
+        return outputs_class, tmp.sigmoid()
+
+    def _predict_class(self, lvl, hs_lvl, class_subset):
+        cls_head = self._cls_head[lvl] if self.box_refine else self._cls_head
+        return self._classify(cls_head, hs_lvl, class_subset)
+
+    def _get_prune_fn(self, class_subset, active_queries):
+        """Returns the callback of the decoder selecting the queries that are not background, records the active queries.
+
+        The number of decoded queries is recorded for every layer, the pruning decision is skipped
+        after the last layer that runs, i.e., the final or the exiting one.
+        """
+        def prune_fn(lid, hs_lvl, last):
+            active_queries.append(hs_lvl.shape[1])
+            if last or lid + 1 < self._query_pruning['layer'] or lid + 1 == self._neck.decoder.num_layers:
+                return None
+            bg_probs = F.softmax(self._predict_class(lid, hs_lvl, class_subset), dim=-1)[..., 0]
+            return bg_probs <= self._query_pruning['threshold']
+        return prune_fn
+
+    def _get_exit_fn(self, class_subset):
+        """Returns the callback of the decoder that is True once the predictions of a layer are stable."""
+        previous = None
+
+        def exit_fn(lid, hs_lvl, reference):
+            nonlocal previous
+            outputs_class, outputs_coord = self._predict_layer(lid, hs_lvl, reference, class_subset)
+            out = {'pred_logits': outputs_class[:, : self.num_queries], 'pred_boxes': outputs_coord[:, : self.num_queries]}
+            if class_subset:
+                out['class_ids'] = self._inference_class_ids
+            current = inference(out)
+
+            stable = previous is not None and lid + 1 >= self._early_exit['min_layers'] and predictions_stable(
+                previous, current, self._early_exit['iou_threshold'], self._early_exit['score_threshold']
+            )
+            previous = current
+            return stable
+        return exit_fn
+
     @torch.jit.unused
     def _set_aux_loss(self, pred_logits, pred_boxes):
         # Hack to support dictionary with non-homogeneous values
@@ -6,6 +6,8 @@ import torch
 import numpy as np
 from torch import nn
 
+from transoar.utils.cache import TENSOR_CACHE
+
 
 class PositionEmbeddingSine3D(nn.Module):
     """
@@ -25,7 +27,12 @@ class PositionEmbeddingSine3D(nn.Module):
         self.scale = scale
 
     def forward(self, src):
-        mask = torch.zeros_like(src[:, 0], dtype=torch.bool)
+        # Only depends on the shape of src, cached over steps
+        key = (tuple(src.shape), src.device, self.orig_channels, self.temperature, self.normalize, self.scale)
+        return TENSOR_CACHE.get('pos_embed_sine', key, lambda: self._compute(src.shape, src.device))
+
+    def _compute(self, shape, device):
+        mask = torch.zeros((shape[0], *shape[2:]), dtype=torch.bool, device=device)
         not_mask = ~mask
         x_embed = not_mask.cumsum(1, dtype=torch.float32)
         y_embed = not_mask.cumsum(2, dtype=torch.float32)
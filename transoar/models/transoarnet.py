@@ -11,9 +11,10 @@ from transoar.models.build import build_backbone, build_neck, build_pos_enc
 from transoar.models.necks.def_detr_transformer import inverse_sigmoid
 from transoar.models.necks.cdn import dn_post_process, prepare_for_cdn, prepare_for_dn
 from transoar.models.matcher import HungarianMatcher
+from transoar.models.class_subset import ClassSubsetMixin
 from transoar.utils.io import load_json
 
-class TransoarNet(nn.Module):
+class TransoarNet(ClassSubsetMixin, nn.Module):
     def __init__(self, config):
         super().__init__()
 
@@ -54,8 +55,12 @@ class TransoarNet(nn.Module):
         # Use auxiliary decoding losses if required
         self._aux_loss = config['neck']['aux_loss']
 
+        # Class-subset inference, only possible if queries are assigned to classes
+        self._query_split = config.get('class_matching_query_split', []) if config.get('class_matching', False) else []
+
         # Get backbone
         self._backbone = build_backbone(config['backbone'])
+        self._channels_last = config['backbone'].get('channels_last', False)  # input batches in NDHWC layout
         self._backbone_name = config['backbone']['name']
 
         # Get neck
@@ -176,6 +181,8 @@ class TransoarNet(nn.Module):
     def forward(self, x, targets=None, num_epoch: int=-1): # in trainer, None when !self.training
         # targets: list of dict{'boxes': , 'labels':}
 
+        if self._channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
         out_backbone = self._backbone(x)
 
         # Retrieve fmaps
@@ -233,6 +240,10 @@ class TransoarNet(nn.Module):
         else:
             query_embeds = self.query_embed.weight
 
+        class_subset = self._class_subset_active()
+        if class_subset: # drop queries assigned to other classes before the decoder
+            query_embeds = self._select_queries(query_embeds)
+
         
 
         if self.training and self.dn['enabled'] and self.dn['dn_number'] > 0 and num_epoch%2 ==0:
@@ -269,7 +280,7 @@ class TransoarNet(nn.Module):
             dn_mask = None
             dn_meta = None
         
-        if self.hybrid:
+        if self.hybrid and not class_subset:
             dn_mask = (torch.zeros([self.num_queries,self.num_queries,]).bool().to(det_srcs[-1].device)) # attn mask to limit attn to O2O
             dn_mask[self.num_queries_one2one :,0 : self.num_queries_one2one,] = True
             dn_mask[0 : self.num_queries_one2one,self.num_queries_one2one :,] = True
@@ -307,11 +318,12 @@ class TransoarNet(nn.Module):
             reference = inverse_sigmoid(reference)
 
             if self.box_refine:
-                outputs_class = self._cls_head[lvl](hs[lvl])
+                cls_head = self._cls_head[lvl]
                 tmp = self._bbox_reg_head[lvl](hs[lvl])
             else:
-                outputs_class = self._cls_head(hs[lvl])
+                cls_head = self._cls_head
                 tmp = self._bbox_reg_head(hs[lvl])
+            outputs_class = self._classify(cls_head, hs[lvl], class_subset)
 
             if reference.shape[-1] == 6:
                 tmp += reference
@@ -344,7 +356,7 @@ class TransoarNet(nn.Module):
         pred_logits = torch.stack(outputs_classes) # (bs, num_queries+num_noised_gt+num_dn, 6)
         pred_boxes = torch.stack(outputs_coords)
 
-        if self.extra_classes > 0: # inc background class
+        if self.extra_classes > 0 and not class_subset: # inc background class
             pred_logits = pred_logits[:, :, :, :self.num_classes_orig_dataset + 1]
 
         # dn post process
@@ -415,6 +427,8 @@ class TransoarNet(nn.Module):
 
             if self._aux_loss:
                 out['aux_outputs'] = self._set_aux_loss(pred_logits[:, : self.num_queries], pred_boxes[:, : self.num_queries])
+            if class_subset:
+                out['class_ids'] = self._inference_class_ids
 
         if  self._msa_seg: 
             out.update({'neck_enc_seg': neck_enc_seg})
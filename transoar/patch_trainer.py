@@ -4,11 +4,20 @@ import copy
 import numpy as np
 import torch
 from torch.cuda.amp import GradScaler, autocast
-from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 from transoar.evaluator import DetectionEvaluator
 from transoar.inference import inference
+from transoar.utils.checkpoint import CheckpointWriter, get_rng_states, set_rng_states
+from transoar.utils.distributed import (
+    get_summary_writer, unwrap_model, is_main_process, get_rank, get_world_size, set_sampler_epoch,
+    set_grad_sync, all_reduce_mean_dict, all_gather_object
+)
+from transoar.utils.preemption import TrainingPreempted, preemption_requested, mark_preempted
+from transoar.utils.timing import StepTimer
+from transoar.utils.memory import MemoryProfiler
+from transoar.data.loader_tuning import LoaderMonitor
+from transoar.utils.cache import TENSOR_CACHE
 from transoar.utils.bboxes import merge_patches
 
 class Trainer:
@@ -30,8 +39,21 @@ class Trainer:
         self._hybrid = config.get('hybrid_matching', False)
         self._hybrid_K = config.get('hybrid_K', 0)
 
-        self._writer = SummaryWriter(log_dir=path_to_run)
+        self._writer = get_summary_writer(path_to_run)  # only rank 0 writes logs
         self._scaler = GradScaler()
+        self._grad_accumulation_steps = config.get('grad_accumulation_steps', 1)
+        self._checkpoint_writer = CheckpointWriter(  # writes in the background while training continues
+            asynchronous=config.get('async_checkpointing', True),
+            max_pending=config.get('checkpoint_queue_size', 2)
+        )
+        self._checkpoint_every_n_steps = config.get('checkpoint_every_n_steps', 0)
+        self._preemption_check_every_n_steps = config.get('preemption_check_every_n_steps', 10)  # blocking all-reduce under DDP
+        self._timer = StepTimer(device, enabled=config.get('log_step_times', False))
+        self._timer.attach_model(unwrap_model(model), criterion)
+        self._memory_profiler = MemoryProfiler(device, enabled=config.get('profile_memory', False))
+        self._memory_profiler.attach_model(unwrap_model(model), criterion)
+        self._loader_monitor = LoaderMonitor(config.get('loader_stall_threshold', 0.2))
+        self._resume_state = None
 
         self._evaluator = DetectionEvaluator(
             classes=list(config['labels'].values()),
@@ -51,35 +73,61 @@ class Trainer:
         self._model.train()
         # self._criterion.train()
 
-        loss_agg = 0
-        loss_bbox_agg = 0
-        loss_giou_agg = 0
-        loss_cls_agg = 0
-        loss_seg_ce_agg = 0
-        loss_seg_dice_agg = 0
-        loss_dn_agg = {}
-        # Aux loss
-        loss_aux_agg = {}
-        loss_aux_agg_dn = {}
-        # Two stage
-        loss_enc_bbox_agg = 0
-        loss_enc_giou_agg = 0
-        loss_enc_cls_agg = 0
-        # log Hausdorff
-        hd95_agg = 0
-        # contrastive loss
-        loss_contrast_agg = 0
-        # hybrid matching
-        loss_bbox_one2many_agg = 0
-        loss_giou_one2many_agg = 0
-        loss_cls_one2many_agg = 0
-        loss_seg_ce_one2many_agg = 0
-        loss_seg_dice_one2many_agg = 0
-
-        progress_bar = tqdm(self._train_loader)
-        for data, _, bboxes, seg_targets in progress_bar:
+        self._timer.reset()
+
+        # Continue an interrupted epoch from a mid-epoch checkpoint
+        resume_state, self._resume_state = self._resume_state or {}, None
+        start_step = resume_state.get('step', 0)
+        # Per-epoch accumulators, stored as they are in mid-epoch checkpoints
+        agg = {
+            'loss': 0,
+            'loss_bbox': 0,
+            'loss_giou': 0,
+            'loss_cls': 0,
+            'loss_seg_ce': 0,
+            'loss_seg_dice': 0,
+            'loss_dn': {},
+            # Aux loss
+            'loss_aux': {},
+            'loss_aux_dn': {},
+            # Two stage
+            'loss_enc_bbox': 0,
+            'loss_enc_giou': 0,
+            'loss_enc_cls': 0,
+            # log Hausdorff
+            'hd95': 0,
+            # contrastive loss
+            'loss_contrast': 0,
+            # hybrid matching
+            'loss_bbox_one2many': 0,
+            'loss_giou_one2many': 0,
+            'loss_cls_one2many': 0,
+            'loss_seg_ce_one2many': 0,
+            'loss_seg_dice_one2many': 0,
+        }
+        if start_step:
+            agg.update(resume_state['metric_buffers'][get_rank()])
+
+        num_steps = len(self._train_loader)
+        if start_step:
+            set_rng_states(resume_state['epoch_rng_states'][get_rank()])
+            self._train_loader.sampler.set_start_index(start_step * self._train_loader.batch_size)
+        epoch_rng_states = all_gather_object(get_rng_states())
+
+        train_iter = iter(self._train_loader)  # draws the worker seeds of this epoch
+        if start_step:
+            set_rng_states(resume_state['rng_states'][get_rank()])
+        progress_bar = tqdm(self._loader_monitor.iterate(self._timer.time_iterator(train_iter)), total=num_steps, initial=start_step, disable=not is_main_process())
+        for step, (data, _, bboxes, seg_targets) in enumerate(progress_bar, start_step):
+            # Accumulate grads over several batches, they are only synced and applied on the last one
+            group_start = step - step % self._grad_accumulation_steps
+            group_size = min(self._grad_accumulation_steps, num_steps - group_start)
+            update_step = step + 1 == group_start + group_size
+            set_grad_sync(self._model, update_step)
+
             # Put data to gpu
-            data, seg_targets = data.to(device=self._device), seg_targets.to(device=self._device)
+            with self._timer.stage('h2d'):
+                data, seg_targets = data.to(device=self._device), seg_targets.to(device=self._device)
         
             det_targets = []
             for item in bboxes:
@@ -89,6 +137,8 @@ class Trainer:
                 }
                 det_targets.append(target)
 
+            if step == start_step:
+                self._memory_profiler.start()  # profiles the activation memory of the first step
             # Make prediction
             with autocast(): 
                 out, contrast_losses, dn_meta = self._model(data, det_targets, num_epoch=num_epoch)
@@ -125,109 +175,134 @@ class Trainer:
                     loss_abs += loss_val * self._config['loss_coefs'][loss_key.split('_')[0]]
                 for loss_key, loss_val in contrast_losses.items():
                     loss_abs += loss_val # already multiplied coefficient in transoarnet.py
-                    loss_contrast_agg += loss_val 
-
-            self._optimizer.zero_grad()
-            self._scaler.scale(loss_abs).backward()
-
-            # Clip grads to counter exploding grads
-            max_norm = self._config['clip_max_norm']
-            if max_norm > 0:
-                torch.nn.utils.clip_grad_norm_(self._model.parameters(), max_norm)
-
-            self._scaler.step(self._optimizer)
-            self._scaler.update()
-
-            loss_agg += loss_abs.item()
-            loss_bbox_agg += loss_dict['bbox'].item()
-            loss_giou_agg += loss_dict['giou'].item()
-            loss_cls_agg += loss_dict['cls'].item()
-            loss_seg_ce_agg += loss_dict['segce'].item()
-            loss_seg_dice_agg += loss_dict['segdice'].item()
+                    agg['loss_contrast'] += loss_val 
+
+            if step == group_start:
+                self._optimizer.zero_grad()
+            with self._timer.stage('backward'), self._memory_profiler.stage('backward'):
+                self._scaler.scale(loss_abs / group_size).backward()
+            self._memory_profiler.stop()
+
+            if update_step:
+                with self._timer.stage('optimizer'):
+                    # Clip grads to counter exploding grads, they have to be unscaled first
+                    max_norm = self._config['clip_max_norm']
+                    if max_norm > 0:
+                        self._scaler.unscale_(self._optimizer)
+                        torch.nn.utils.clip_grad_norm_(self._model.parameters(), max_norm)
+
+                    self._scaler.step(self._optimizer)
+                    self._scaler.update()
+
+            agg['loss'] += loss_abs.item()
+            agg['loss_bbox'] += loss_dict['bbox'].item()
+            agg['loss_giou'] += loss_dict['giou'].item()
+            agg['loss_cls'] += loss_dict['cls'].item()
+            agg['loss_seg_ce'] += loss_dict['segce'].item()
+            agg['loss_seg_dice'] += loss_dict['segdice'].item()
             if self._hybrid: # hybrid matching
-                loss_bbox_one2many_agg += loss_dict['bbox_one2many'].item()
-                loss_giou_one2many_agg += loss_dict['giou_one2many'].item()
-                loss_cls_one2many_agg += loss_dict['cls_one2many'].item()
-                loss_seg_ce_one2many_agg += loss_dict['segce_one2many'].item()
-                loss_seg_dice_one2many_agg += loss_dict['segdice_one2many'].item()
+                agg['loss_bbox_one2many'] += loss_dict['bbox_one2many'].item()
+                agg['loss_giou_one2many'] += loss_dict['giou_one2many'].item()
+                agg['loss_cls_one2many'] += loss_dict['cls_one2many'].item()
+                agg['loss_seg_ce_one2many'] += loss_dict['segce_one2many'].item()
+                agg['loss_seg_dice_one2many'] += loss_dict['segdice_one2many'].item()
 
             if self._criterion._seg_proxy: # log Hausdorff
-                hd95_agg += hd95
+                agg['hd95'] += hd95
             
             if dn_meta is not None:
-                if len(loss_dn_agg) == 0: # initialize loss entries
-                    loss_dn_agg['bbox_dn'] = 0
-                    loss_dn_agg['giou_dn'] = 0
-                    loss_dn_agg['cls_dn'] = 0
+                if len(agg['loss_dn']) == 0: # initialize loss entries
+                    agg['loss_dn']['bbox_dn'] = 0
+                    agg['loss_dn']['giou_dn'] = 0
+                    agg['loss_dn']['cls_dn'] = 0
                 else:
-                    loss_dn_agg['bbox_dn'] += loss_dict[f'bbox_dn'].item()
-                    loss_dn_agg['giou_dn'] += loss_dict[f'giou_dn'].item()
-                    loss_dn_agg['cls_dn'] += loss_dict[f'cls_dn'].item()
+                    agg['loss_dn']['bbox_dn'] += loss_dict[f'bbox_dn'].item()
+                    agg['loss_dn']['giou_dn'] += loss_dict[f'giou_dn'].item()
+                    agg['loss_dn']['cls_dn'] += loss_dict[f'cls_dn'].item()
             if "aux_outputs" in out:
-                if len(loss_aux_agg) == 0: # initialize loss entries
+                if len(agg['loss_aux']) == 0: # initialize loss entries
                     for i in range(len(out["aux_outputs"])):
-                        loss_aux_agg[f'bbox_{i}'] = 0
-                        loss_aux_agg[f'giou_{i}'] = 0
-                        loss_aux_agg[f'cls_{i}'] = 0
+                        agg['loss_aux'][f'bbox_{i}'] = 0
+                        agg['loss_aux'][f'giou_{i}'] = 0
+                        agg['loss_aux'][f'cls_{i}'] = 0
                 for i in range(len(out["aux_outputs"])):
-                    loss_aux_agg[f'bbox_{i}'] += loss_dict[f'bbox_{i}'].item()
-                    loss_aux_agg[f'giou_{i}'] += loss_dict[f'giou_{i}'].item()
-                    loss_aux_agg[f'cls_{i}'] += loss_dict[f'cls_{i}'].item()
+                    agg['loss_aux'][f'bbox_{i}'] += loss_dict[f'bbox_{i}'].item()
+                    agg['loss_aux'][f'giou_{i}'] += loss_dict[f'giou_{i}'].item()
+                    agg['loss_aux'][f'cls_{i}'] += loss_dict[f'cls_{i}'].item()
                 
                 if dn_meta is not None:
-                    if len(loss_aux_agg_dn) == 0: # initialize loss entries
+                    if len(agg['loss_aux_dn']) == 0: # initialize loss entries
                         for i in range(len(out["aux_outputs"])):
-                            loss_aux_agg_dn[f'bbox_{i}_dn'] = 0
-                            loss_aux_agg_dn[f'giou_{i}_dn'] = 0
-                            loss_aux_agg_dn[f'cls_{i}_dn'] = 0
+                            agg['loss_aux_dn'][f'bbox_{i}_dn'] = 0
+                            agg['loss_aux_dn'][f'giou_{i}_dn'] = 0
+                            agg['loss_aux_dn'][f'cls_{i}_dn'] = 0
                     for i in range(len(out["aux_outputs"])):
-                        loss_aux_agg_dn[f'bbox_{i}_dn'] += loss_dict[f'bbox_{i}_dn'].item()
-                        loss_aux_agg_dn[f'giou_{i}_dn'] += loss_dict[f'giou_{i}_dn'].item()
-                        loss_aux_agg_dn[f'cls_{i}_dn'] += loss_dict[f'cls_{i}_dn'].item()
+                        agg['loss_aux_dn'][f'bbox_{i}_dn'] += loss_dict[f'bbox_{i}_dn'].item()
+                        agg['loss_aux_dn'][f'giou_{i}_dn'] += loss_dict[f'giou_{i}_dn'].item()
+                        agg['loss_aux_dn'][f'cls_{i}_dn'] += loss_dict[f'cls_{i}_dn'].item()
             if "enc_outputs" in out:
-                loss_enc_bbox_agg += loss_dict['bbox_enc'].item()
-                loss_enc_giou_agg += loss_dict['giou_enc'].item()
-                loss_enc_cls_agg += loss_dict['cls_enc'].item()
+                agg['loss_enc_bbox'] += loss_dict['bbox_enc'].item()
+                agg['loss_enc_giou'] += loss_dict['giou_enc'].item()
+                agg['loss_enc_cls'] += loss_dict['cls_enc'].item()
             memory_allocated, memory_cached = get_gpu_memory(self._device)
             progress_bar.set_postfix({'cached': "{:.2f}GB".format(memory_cached/(1024**3))})
+
+            # Mid-epoch checkpoint, training continues with the next step when resuming
+            preempted = update_step and preemption_requested(step // self._grad_accumulation_steps, self._preemption_check_every_n_steps)
+            if preempted or (self._checkpoint_every_n_steps and update_step and (step + 1) % self._checkpoint_every_n_steps == 0 and step + 1 < num_steps):
+                self._save_step_checkpoint(num_epoch, step + 1, epoch_rng_states, agg)
+            if preempted:
+                self._stop_preempted()
             
-        loss = loss_agg / len(self._train_loader)
+        loader_stats = self._loader_monitor.summary()
+        if self._loader_monitor.is_stalled(loader_stats) and is_main_process():
+            print(f"Waited for data during {loader_stats['stall_fraction']:.0%} of epoch {num_epoch}, consider tuning the loader with autotune_loader.")
+        self._write_to_logger(num_epoch, 'loader', **loader_stats)
+        self._write_to_logger(num_epoch, 'tensor_cache', **TENSOR_CACHE.stats())
+        TENSOR_CACHE.reset_stats()
+        self._write_to_logger(num_epoch, 'step_time_ms', **self._timer.summary())
+        if self._memory_profiler.enabled:
+            if is_main_process():
+                (self._path_to_run / 'memory_report.txt').write_text(self._memory_profiler.report())
+            self._write_to_logger(num_epoch, 'activation_memory_mb', **self._memory_profiler.summary())
+
+        loss = agg['loss'] / len(self._train_loader)
         #print(f'total train loss for epoch {num_epoch}: '+str(loss))
-        loss_bbox = loss_bbox_agg / len(self._train_loader)
-        loss_giou = loss_giou_agg / len(self._train_loader)
-        loss_cls = loss_cls_agg / len(self._train_loader)
-        loss_seg_ce = loss_seg_ce_agg / len(self._train_loader)
-        loss_seg_dice = loss_seg_dice_agg / len(self._train_loader)
+        loss_bbox = agg['loss_bbox'] / len(self._train_loader)
+        loss_giou = agg['loss_giou'] / len(self._train_loader)
+        loss_cls = agg['loss_cls'] / len(self._train_loader)
+        loss_seg_ce = agg['loss_seg_ce'] / len(self._train_loader)
+        loss_seg_dice = agg['loss_seg_dice'] / len(self._train_loader)
         if self._hybrid: # hybrid matching
-            loss_bbox_one2many = loss_bbox_one2many_agg / len(self._train_loader)
-            loss_giou_one2many = loss_giou_one2many_agg / len(self._train_loader)
-            loss_cls_one2many = loss_cls_one2many_agg / len(self._train_loader)
-            loss_seg_ce_one2many = loss_seg_ce_one2many_agg / len(self._train_loader)
-            loss_seg_dice_one2many = loss_seg_dice_one2many_agg / len(self._train_loader)
+            loss_bbox_one2many = agg['loss_bbox_one2many'] / len(self._train_loader)
+            loss_giou_one2many = agg['loss_giou_one2many'] / len(self._train_loader)
+            loss_cls_one2many = agg['loss_cls_one2many'] / len(self._train_loader)
+            loss_seg_ce_one2many = agg['loss_seg_ce_one2many'] / len(self._train_loader)
+            loss_seg_dice_one2many = agg['loss_seg_dice_one2many'] / len(self._train_loader)
         
         if self._criterion._seg_proxy:  # log Hausdorff
-            seg_hd95 = hd95_agg / len(self._train_loader)
+            seg_hd95 = agg['hd95'] / len(self._train_loader)
         else:
             seg_hd95 = 0
 
-        loss_contrast = loss_contrast_agg / len(self._train_loader)
+        loss_contrast = agg['loss_contrast'] / len(self._train_loader)
         
-        if len(loss_dn_agg) != 0:
-            for key in loss_dn_agg:
-                value = loss_dn_agg[key] / len(self._train_loader)
+        if len(agg['loss_dn']) != 0:
+            for key in agg['loss_dn']:
+                value = agg['loss_dn'][key] / len(self._train_loader)
                 self._writer.add_scalar("dn/"+key, value, num_epoch)
-        if len(loss_aux_agg) != 0:
-            for key in loss_aux_agg:
-                value = loss_aux_agg[key] / len(self._train_loader)
+        if len(agg['loss_aux']) != 0:
+            for key in agg['loss_aux']:
+                value = agg['loss_aux'][key] / len(self._train_loader)
                 self._writer.add_scalar("train_aux/"+key, value, num_epoch)
-        if len(loss_aux_agg_dn) != 0:
-            for key in loss_aux_agg_dn:
-                value = loss_aux_agg_dn[key] / len(self._train_loader)
+        if len(agg['loss_aux_dn']) != 0:
+            for key in agg['loss_aux_dn']:
+                value = agg['loss_aux_dn'][key] / len(self._train_loader)
                 self._writer.add_scalar("dn/"+key, value, num_epoch)
-        if loss_enc_bbox_agg or loss_enc_giou_agg or loss_enc_cls_agg:
-            self._writer.add_scalar("train_enc/bbox_enc", loss_enc_bbox_agg/len(self._train_loader), num_epoch)
-            self._writer.add_scalar("train_enc/giou_enc", loss_enc_giou_agg/len(self._train_loader), num_epoch)
-            self._writer.add_scalar("train_enc/cls_enc", loss_enc_cls_agg/len(self._train_loader), num_epoch)
+        if agg['loss_enc_bbox'] or agg['loss_enc_giou'] or agg['loss_enc_cls']:
+            self._writer.add_scalar("train_enc/bbox_enc", agg['loss_enc_bbox']/len(self._train_loader), num_epoch)
+            self._writer.add_scalar("train_enc/giou_enc", agg['loss_enc_giou']/len(self._train_loader), num_epoch)
+            self._writer.add_scalar("train_enc/cls_enc", agg['loss_enc_cls']/len(self._train_loader), num_epoch)
 
         if self._hybrid: # log many2one just if hybrid matching is activated
             self._write_to_logger(
@@ -261,15 +336,17 @@ class Trainer:
     @torch.no_grad()
     def _validate(self, num_epoch):
         self._model.eval()
-        set_seg_proxy = self._model._seg_proxy
-        set_msa_seg = self._model._msa_seg
+        model = unwrap_model(self._model)
+        set_seg_proxy = model._seg_proxy
+        set_msa_seg = model._msa_seg
 
-        self._model._seg_proxy = False
-        self._model._msa_seg = False
+        model._seg_proxy = False
+        model._msa_seg = False
         self._criterion._seg_proxy = False
         self._criterion._seg_msa = False
         # self._criterion.eval()
         patches_count = 0
+        skipped_patches_count = 0
 
         loss_agg = 0
         loss_bbox_agg = 0
@@ -285,13 +362,15 @@ class Trainer:
         loss_enc_bbox_agg = 0
         loss_enc_giou_agg = 0
         loss_enc_cls_agg = 0
-        progress_bar = tqdm(self._val_loader)
-        for data, _, bboxes, seg_targets, patch_pos, padded_batch_labels, whole_padded_bboxes in progress_bar:
+        progress_bar = tqdm(self._val_loader, disable=not is_main_process())
+        for data, _, bboxes, seg_targets, patch_pos, padded_batch_labels, whole_padded_bboxes, num_skipped in progress_bar:
+            skipped_patches_count += num_skipped
             # Put data to gpu
             inf_out_patches = {} # track predictions for all patches 
-            for ch in range(data.shape[0]):
+            for ch in range(len(data)):
                 patches_count += 1
-                data_c, seg_targets_c = data[ch,:].to(device=self._device)[None,:], seg_targets[ch,:].to(device=self._device)[None,:]
+                # Patches are views into the padded volume, only the current one is materialized
+                data_c, seg_targets_c = data[ch].to(device=self._device)[None,:], seg_targets[ch].to(device=self._device)[None,:]
                 det_targets = []
                 for item in [bboxes[ch]]:
                     target = {
@@ -302,7 +381,7 @@ class Trainer:
 
                 # Make prediction
                 with autocast():
-                    out = self._model(data_c)
+                    out = model(data_c)
                     loss_dict, _ = self._criterion(out, det_targets, seg_targets_c)
 
                     if self._criterion._seg_proxy: # log Hausdorff
@@ -375,6 +454,7 @@ class Trainer:
         else:
             seg_hd95 = 0
 
+        self._evaluator.gather(len(self._val_loader.dataset))  # results of all ranks
         metric_scores = self._evaluator.eval()
         self._evaluator.reset()
 
@@ -404,7 +484,8 @@ class Trainer:
             giou_loss=loss_giou,
             cls_loss=loss_cls,
             seg_ce_loss=loss_seg_ce,
-            seg_dice_loss=loss_seg_dice
+            seg_dice_loss=loss_seg_dice,
+            skipped_patches=skipped_patches_count
         )
 
         self._write_to_logger(
@@ -419,17 +500,19 @@ class Trainer:
             AP75=metric_scores['AP_IoU_0.75'],
             seg_hd95=seg_hd95 # log Hausdorff
         )
-        self._model._seg_proxy = set_seg_proxy
-        self._model._msa_seg = set_msa_seg
+        model._seg_proxy = set_seg_proxy
+        model._msa_seg = set_msa_seg
         self._criterion._seg_proxy = set_seg_proxy
         self._criterion._seg_msa = set_msa_seg
 
     def run(self):
-        if self._epoch_to_start == 0:   # For initial performance estimation
+        if self._epoch_to_start == 0 and self._resume_state is None:   # For initial performance estimation
             self._validate(0)
 
         for epoch in range(self._epoch_to_start + 1, self._config['epochs'] + 1):
-            print("starting epoch ", epoch)
+            if is_main_process():
+                print("starting epoch ", epoch)
+            set_sampler_epoch(self._train_loader, epoch)
             self._train_one_epoch(epoch)
 
             # Log learning rates
@@ -450,26 +533,65 @@ class Trainer:
             if (epoch % 500) == 0:
                 self._save_checkpoint(epoch, f'model_epoch_{epoch}.pt')
 
+            if preemption_requested():  # signal during validation, model_last.pt is up to date
+                self._stop_preempted()
+
+        self._checkpoint_writer.close()
+
     def _write_to_logger(self, num_epoch, category, **kwargs):
-        for key, value in kwargs.items():
-            name = category + '/' + key
-            self._writer.add_scalar(name, value, num_epoch)
+        for key, value in all_reduce_mean_dict(kwargs).items(): # mean over ranks, one collective per call
+            self._writer.add_scalar(category + '/' + key, value, num_epoch)
+
+    def _save_checkpoint(self, num_epoch, name, **resume_state):
+        if not is_main_process():
+            return
 
-    def _save_checkpoint(self, num_epoch, name):
-        # Delete prior best checkpoint
-        if 'best' in name:
-            [path.unlink() for path in self._path_to_run.iterdir() if 'best' in str(path)]
+        # Prior best checkpoint is deleted once the new one is written
+        replaces = 'model_best' if 'best' in name else None
 
-        torch.save({
+        self._checkpoint_writer.save({
             'epoch': num_epoch,
-            'metric_max_val': self._main_metric_max_val,
-            'model_state_dict': self._model.state_dict(),
+            'metric_max_val': float(self._main_metric_max_val),   # no numpy types, checkpoints load with weights_only
+            'model_state_dict': unwrap_model(self._model).state_dict(),
             'optimizer_state_dict': self._optimizer.state_dict(),
             'scheduler_state_dict': self._scheduler.state_dict(),
-        }, self._path_to_run / name)
+            'scaler_state_dict': self._scaler.state_dict(),
+            **resume_state
+        }, self._path_to_run / name, replaces=replaces)
+
+    def _save_step_checkpoint(self, num_epoch, step, epoch_rng_states, metric_buffers):
+        """Saves a checkpoint in the middle of an epoch to model_last.pt.
+
+        The epoch is stored as not yet finished, the sampler position, the random states of all
+        ranks and the metric buffers allow to continue the epoch with the given step.
+        """
+        resume_state = {
+            'step': step,
+            'epoch_rng_states': epoch_rng_states,
+            'rng_states': all_gather_object(get_rng_states()),
+            'metric_buffers': all_gather_object(metric_buffers),
+        }
+        self._save_checkpoint(num_epoch - 1, 'model_last.pt', **resume_state)
+
+    def _stop_preempted(self):
+        """Waits until the checkpoint is written, marks the run for resuming and stops training."""
+        self._checkpoint_writer.close()
+        mark_preempted(self._path_to_run)
+        raise TrainingPreempted()
+
+    def load_resume_state(self, checkpoint):
+        """Restores the state that is not part of model, optimizer and scheduler from a checkpoint."""
+        if 'scaler_state_dict' in checkpoint:
+            self._scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        if checkpoint.get('step', 0) > 0:
+            assert len(checkpoint['rng_states']) == get_world_size(), \
+                "Mid-epoch checkpoints have to be resumed with the same number of processes."
+            self._resume_state = checkpoint
 
 def get_gpu_memory(device):
     #torch.cuda.empty_cache()
+    if 'cuda' not in str(device):
+        return 0, 0
     memory_allocated = torch.cuda.memory_allocated(device)
     memory_cached = torch.cuda.memory_cached(device)
     return memory_allocated, memory_cached
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""Post-training INT8 quantization of the detectors for inference on CPUs."""
+
+import copy
+import io
+from fnmatch import fnmatchcase
+
+import torch
+import torch.ao.quantization as tq
+from torch import nn
+
+# Appended to the name of quantized checkpoints, e.g., model_last_int8.pt
+QUANTIZED_SUFFIX = '_int8'
+
+
+def quantize_model(model, calibration_data=None, linear=True, conv=True, exclude=(), engine=None):
+    """Returns an INT8 copy of model for inference on CPUs.
+
+    The nn.Linear layers, i.e., the projections and FFNs of the transformers and the heads, are
+    quantized dynamically: weights are stored in INT8 and activations are quantized on the fly.
+    The nn.Conv3d layers are quantized statically, each wrapped by a quantization of its input and
+    a dequantization of its output, with activation ranges observed on calibration_data. Without
+    calibration data only the structure is created, e.g., to load a quantized state dict.
+
+    Args:
+        model: A detector, e.g., OrganDetrNet or TransoarNet.
+        calibration_data: Iterable of input batches, e.g., a few preprocessed training cases.
+        linear: Quantize the linear layers dynamically.
+        conv: Quantize the 3D convolutions statically.
+        exclude: Patterns of names of modules that stay in float, e.g., ['*.sampling_offsets'].
+        engine: Quantized engine, defaults to the current engine of torch.
+
+    Returns:
+        The quantized model and its settings, which have to be stored with its state dict.
+    """
+    engine = engine or torch.backends.quantized.engine
+    assert engine in torch.backends.quantized.supported_engines, f'quantized engine {engine} not supported'
+    torch.backends.quantized.engine = engine
+    settings = {'linear': linear, 'conv': conv, 'exclude': list(exclude), 'engine': engine}
+
+    model = copy.deepcopy(model).cpu().eval()
+    if conv:
+        _wrap_convs(model, tq.get_default_qconfig(engine), exclude)
+        tq.prepare(model, inplace=True)
+        with torch.no_grad():
+            for data in calibration_data or []:
+                model(data.cpu())
+        tq.convert(model, inplace=True)
+
+    if linear:
+        qconfig_spec = {
+            name: tq.default_dynamic_qconfig for name, module in model.named_modules()
+            if type(module) is nn.Linear and not _excluded(name, exclude)
+        }
+        tq.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    return model, settings
+
+def load_quantized(model, checkpoint):
+    """Converts model to the quantized structure of checkpoint and loads its state dict."""
+    model, _ = quantize_model(model, **checkpoint['quantization'])
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.eval()
+
+def is_quantized(checkpoint):
+    return 'quantization' in checkpoint
+
+def state_dict_mb(model):
+    """Returns the size of the serialized state dict of model in MB."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def _wrap_convs(model, qconfig, exclude):
+    for name, module in list(model.named_modules()):
+        if type(module) is not nn.Conv3d or _excluded(name, exclude):
+            continue
+        parent_name, _, child_name = name.rpartition('.')
+        wrapper = tq.QuantWrapper(module)
+        wrapper.qconfig = qconfig
+        setattr(model.get_submodule(parent_name), child_name, wrapper)
+
+def _excluded(name, exclude):
+    return any(fnmatchcase(name, pattern) for pattern in exclude)
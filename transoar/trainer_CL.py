@@ -4,12 +4,21 @@ import copy
 import itertools
 import torch
 from torch.cuda.amp import GradScaler, autocast
-from torch.utils.tensorboard import SummaryWriter
 import PIL.Image
 from tqdm import tqdm
 import numpy as np
 from transoar.evaluator import DetectionEvaluator
 from transoar.inference import inference
+from transoar.utils.checkpoint import CheckpointWriter, get_rng_states, set_rng_states
+from transoar.utils.distributed import (
+    get_summary_writer, unwrap_model, is_main_process, get_rank, get_world_size, set_sampler_epoch,
+    set_grad_sync, all_reduce_mean_dict, all_gather_object
+)
+from transoar.utils.preemption import TrainingPreempted, preemption_requested, mark_preempted
+from transoar.utils.timing import StepTimer
+from transoar.utils.memory import MemoryProfiler
+from transoar.data.loader_tuning import LoaderMonitor
+from transoar.utils.cache import TENSOR_CACHE
 import matplotlib.pyplot as plt
 from torchvision.transforms import ToTensor
 import io
@@ -66,8 +75,21 @@ class Trainer_CL:
             self.log_grads_list_neg = []
             self.log_epoch_list = []
 
-        self._writer = SummaryWriter(log_dir=path_to_run)
+        self._writer = get_summary_writer(path_to_run)  # only rank 0 writes logs
         self._scaler = GradScaler()
+        self._grad_accumulation_steps = config.get('grad_accumulation_steps', 1)
+        self._checkpoint_writer = CheckpointWriter(  # writes in the background while training continues
+            asynchronous=config.get('async_checkpointing', True),
+            max_pending=config.get('checkpoint_queue_size', 2)
+        )
+        self._checkpoint_every_n_steps = config.get('checkpoint_every_n_steps', 0)
+        self._preemption_check_every_n_steps = config.get('preemption_check_every_n_steps', 10)  # blocking all-reduce under DDP
+        self._timer = StepTimer(device, enabled=config.get('log_step_times', False))
+        self._timer.attach_model(unwrap_model(model), criterion)
+        self._memory_profiler = MemoryProfiler(device, enabled=config.get('profile_memory', False))
+        self._memory_profiler.attach_model(unwrap_model(model), criterion)
+        self._loader_monitor = LoaderMonitor(config.get('loader_stall_threshold', 0.2))
+        self._resume_state = None
 
         self._evaluator_val = DetectionEvaluator(
             classes=list(config['labels'].values()),
@@ -107,42 +129,67 @@ class Trainer_CL:
         self._model.train()
         # self._criterion.train()
 
-        loss_agg = 0
-        loss_bbox_agg = 0
-        loss_giou_agg = 0
-        loss_cls_agg = 0
-        loss_seg_ce_agg = 0
-        loss_seg_dice_agg = 0
-        loss_dn_agg = {}
-        # Aux loss
-        loss_aux_agg = {}
-        loss_aux_agg_dn = {}
-        # Two stage
-        loss_enc_bbox_agg = 0
-        loss_enc_giou_agg = 0
-        loss_enc_cls_agg = 0
-        # log Hausdorff
-        hd95_agg = 0
-        # contrastive loss
-        loss_contrast_agg = 0
-        # hybrid matching
-        loss_bbox_one2many_agg = 0
-        loss_giou_one2many_agg = 0
-        loss_cls_one2many_agg = 0
-        loss_seg_ce_one2many_agg = 0
-        loss_seg_dice_one2many_agg = 0
-        
-        pos_query_grads_list = torch.Tensor([])
-        neg_query_grads_list = torch.Tensor([])
+        self._timer.reset()
+
+        # Continue an interrupted epoch from a mid-epoch checkpoint
+        resume_state, self._resume_state = self._resume_state or {}, None
+        start_step = resume_state.get('step', 0)
+        # Per-epoch accumulators, stored as they are in mid-epoch checkpoints
+        agg = {
+            'loss': 0,
+            'loss_bbox': 0,
+            'loss_giou': 0,
+            'loss_cls': 0,
+            'loss_seg_ce': 0,
+            'loss_seg_dice': 0,
+            'loss_dn': {},
+            # Aux loss
+            'loss_aux': {},
+            'loss_aux_dn': {},
+            # Two stage
+            'loss_enc_bbox': 0,
+            'loss_enc_giou': 0,
+            'loss_enc_cls': 0,
+            # log Hausdorff
+            'hd95': 0,
+            # contrastive loss
+            'loss_contrast': 0,
+            # hybrid matching
+            'loss_bbox_one2many': 0,
+            'loss_giou_one2many': 0,
+            'loss_cls_one2many': 0,
+            'loss_seg_ce_one2many': 0,
+            'loss_seg_dice_one2many': 0,
+            # log gradients of positive & negative queries
+            'pos_query_grads_list': torch.Tensor([]),
+            'neg_query_grads_list': torch.Tensor([]),
+        }
+        if start_step:
+            agg.update(resume_state['metric_buffers'][get_rank()])
 
         # self._replay_samples
         
 
-        progress_bar = tqdm(self._train_loader)
-
-        for data, _, bboxes, seg_targets in progress_bar:
-
-            data = data.to(device=self._device)
+        num_steps = len(self._train_loader)
+        if start_step:
+            set_rng_states(resume_state['epoch_rng_states'][get_rank()])
+            self._train_loader.sampler.set_start_index(start_step * self._train_loader.batch_size)
+        epoch_rng_states = all_gather_object(get_rng_states())
+
+        train_iter = iter(self._train_loader)  # draws the worker seeds of this epoch
+        if start_step:
+            set_rng_states(resume_state['rng_states'][get_rank()])
+        progress_bar = tqdm(self._loader_monitor.iterate(self._timer.time_iterator(train_iter)), total=num_steps, initial=start_step, disable=not is_main_process())
+        for step, (data, _, bboxes, seg_targets) in enumerate(progress_bar, start_step):
+            # Accumulate grads over several batches, they are only synced and applied on the last one
+            group_start = step - step % self._grad_accumulation_steps
+            group_size = min(self._grad_accumulation_steps, num_steps - group_start)
+            update_step = step + 1 == group_start + group_size
+            set_grad_sync(self._model, update_step)
+
+            with self._timer.stage('h2d'):
+
+                data = data.to(device=self._device)
             det_targets = []
 
             if self.flag_b2_ocl_re_mix:
@@ -189,7 +236,8 @@ class Trainer_CL:
                     
             else:
                 # Put data to gpu
-                seg_targets = seg_targets.to(device=self._device)
+                with self._timer.stage('h2d'):
+                    seg_targets = seg_targets.to(device=self._device)
 
                 det_targets = []
                 for item in bboxes:
@@ -202,6 +250,8 @@ class Trainer_CL:
                         target['labels'][target['labels'] > 5] = 0
                     det_targets.append(target)
         
+            if step == start_step:
+                self._memory_profiler.start()  # profiles the activation memory of the first step
             # Make prediction
             with autocast():   
                 # Main model loss
@@ -266,22 +316,28 @@ class Trainer_CL:
                     loss_abs += loss_val * self._config['loss_coefs'][loss_key.split('_')[0]]
                 for loss_key, loss_val in contrast_losses.items():
                     loss_abs += loss_val # already multiplied coefficient in transoarnet.py
-                    loss_contrast_agg += loss_val 
+                    agg['loss_contrast'] += loss_val 
                     
-            self._optimizer.zero_grad() # Zero gradients
-            self._scaler.scale(loss_abs).backward() # Backward pass
-            
-            # Clip grads to counter exploding grads
-            max_norm = self._config['clip_max_norm']
-            if max_norm > 0:
-                torch.nn.utils.clip_grad_norm_(self._model.parameters(), max_norm)
-
-            self._scaler.step(self._optimizer)
-            self._scaler.update()
+            if step == group_start:
+                self._optimizer.zero_grad() # Zero gradients
+            with self._timer.stage('backward'), self._memory_profiler.stage('backward'):
+                self._scaler.scale(loss_abs / group_size).backward() # Backward pass
+            self._memory_profiler.stop()
+
+            if update_step:
+                with self._timer.stage('optimizer'):
+                    # Clip grads to counter exploding grads, they have to be unscaled first
+                    max_norm = self._config['clip_max_norm']
+                    if max_norm > 0:
+                        self._scaler.unscale_(self._optimizer)
+                        torch.nn.utils.clip_grad_norm_(self._model.parameters(), max_norm)
+
+                    self._scaler.step(self._optimizer)
+                    self._scaler.update()
             
             # log gradients of positive & negative queries
             if self.log_grad:
-                for name, param in self._model.named_parameters():
+                for name, param in unwrap_model(self._model).named_parameters():
                     if name == 'query_embed.weight':
                         _, tgt_param_grad = torch.split(param.grad, param.size(1)//2, dim=1) # only fetch grads of tgt
                         #tgt_param_grad = param.grad
@@ -293,105 +349,124 @@ class Trainer_CL:
                         # remove nan
                         pos_query_grads[torch.isnan(pos_query_grads)] = torch.tensor(0.0)
                         neg_query_grads[torch.isnan(neg_query_grads)] = torch.tensor(0.0)
-                        pos_query_grads_list = torch.cat((pos_query_grads_list.cuda(), pos_query_grads), dim=0)
-                        neg_query_grads_list = torch.cat((neg_query_grads_list.cuda(), neg_query_grads), dim=0)
-
-            loss_agg += loss_abs.item()
-            loss_bbox_agg += loss_dict['bbox'].item()
-            loss_giou_agg += loss_dict['giou'].item()
-            loss_cls_agg += loss_dict['cls'].item()
-            loss_seg_ce_agg += loss_dict['segce'].item()
-            loss_seg_dice_agg += loss_dict['segdice'].item()
+                        agg['pos_query_grads_list'] = torch.cat((agg['pos_query_grads_list'].cuda(), pos_query_grads), dim=0)
+                        agg['neg_query_grads_list'] = torch.cat((agg['neg_query_grads_list'].cuda(), neg_query_grads), dim=0)
+
+            agg['loss'] += loss_abs.item()
+            agg['loss_bbox'] += loss_dict['bbox'].item()
+            agg['loss_giou'] += loss_dict['giou'].item()
+            agg['loss_cls'] += loss_dict['cls'].item()
+            agg['loss_seg_ce'] += loss_dict['segce'].item()
+            agg['loss_seg_dice'] += loss_dict['segdice'].item()
             loss_aux_model = loss_dict["aux_model"].item() if self._aux_model is not None else 0
             loss_old_model = loss_dict["old_model"].item() if self._old_model is not None else 0
             
             if self._hybrid: # hybrid matching
-                loss_bbox_one2many_agg += loss_dict['bbox_one2many'].item()
-                loss_giou_one2many_agg += loss_dict['giou_one2many'].item()
-                loss_cls_one2many_agg += loss_dict['cls_one2many'].item()
-                loss_seg_ce_one2many_agg += loss_dict['segce_one2many'].item()
-                loss_seg_dice_one2many_agg += loss_dict['segdice_one2many'].item()
+                agg['loss_bbox_one2many'] += loss_dict['bbox_one2many'].item()
+                agg['loss_giou_one2many'] += loss_dict['giou_one2many'].item()
+                agg['loss_cls_one2many'] += loss_dict['cls_one2many'].item()
+                agg['loss_seg_ce_one2many'] += loss_dict['segce_one2many'].item()
+                agg['loss_seg_dice_one2many'] += loss_dict['segdice_one2many'].item()
 
             if self._criterion._seg_proxy: # log Hausdorff
-                hd95_agg += hd95
+                agg['hd95'] += hd95
             
             if dn_meta is not None:
-                if len(loss_dn_agg) == 0: # initialize loss entries
-                    loss_dn_agg['bbox_dn'] = 0
-                    loss_dn_agg['giou_dn'] = 0
-                    loss_dn_agg['cls_dn'] = 0
+                if len(agg['loss_dn']) == 0: # initialize loss entries
+                    agg['loss_dn']['bbox_dn'] = 0
+                    agg['loss_dn']['giou_dn'] = 0
+                    agg['loss_dn']['cls_dn'] = 0
                 else:
-                    loss_dn_agg['bbox_dn'] += loss_dict[f'bbox_dn'].item()
-                    loss_dn_agg['giou_dn'] += loss_dict[f'giou_dn'].item()
-                    loss_dn_agg['cls_dn'] += loss_dict[f'cls_dn'].item()
+                    agg['loss_dn']['bbox_dn'] += loss_dict[f'bbox_dn'].item()
+                    agg['loss_dn']['giou_dn'] += loss_dict[f'giou_dn'].item()
+                    agg['loss_dn']['cls_dn'] += loss_dict[f'cls_dn'].item()
             if "aux_outputs" in out:
-                if len(loss_aux_agg) == 0: # initialize loss entries
+                if len(agg['loss_aux']) == 0: # initialize loss entries
                     for i in range(len(out["aux_outputs"])):
-                        loss_aux_agg[f'bbox_{i}'] = 0
-                        loss_aux_agg[f'giou_{i}'] = 0
-                        loss_aux_agg[f'cls_{i}'] = 0
+                        agg['loss_aux'][f'bbox_{i}'] = 0
+                        agg['loss_aux'][f'giou_{i}'] = 0
+                        agg['loss_aux'][f'cls_{i}'] = 0
                 for i in range(len(out["aux_outputs"])):
-                    loss_aux_agg[f'bbox_{i}'] += loss_dict[f'bbox_{i}'].item()
-                    loss_aux_agg[f'giou_{i}'] += loss_dict[f'giou_{i}'].item()
-                    loss_aux_agg[f'cls_{i}'] += loss_dict[f'cls_{i}'].item()
+                    agg['loss_aux'][f'bbox_{i}'] += loss_dict[f'bbox_{i}'].item()
+                    agg['loss_aux'][f'giou_{i}'] += loss_dict[f'giou_{i}'].item()
+                    agg['loss_aux'][f'cls_{i}'] += loss_dict[f'cls_{i}'].item()
                 
                 if dn_meta is not None:
-                    if len(loss_aux_agg_dn) == 0: # initialize loss entries
+                    if len(agg['loss_aux_dn']) == 0: # initialize loss entries
                         for i in range(len(out["aux_outputs"])):
-                            loss_aux_agg_dn[f'bbox_{i}_dn'] = 0
-                            loss_aux_agg_dn[f'giou_{i}_dn'] = 0
-                            loss_aux_agg_dn[f'cls_{i}_dn'] = 0
+                            agg['loss_aux_dn'][f'bbox_{i}_dn'] = 0
+                            agg['loss_aux_dn'][f'giou_{i}_dn'] = 0
+                            agg['loss_aux_dn'][f'cls_{i}_dn'] = 0
                     for i in range(len(out["aux_outputs"])):
-                        loss_aux_agg_dn[f'bbox_{i}_dn'] += loss_dict[f'bbox_{i}_dn'].item()
-                        loss_aux_agg_dn[f'giou_{i}_dn'] += loss_dict[f'giou_{i}_dn'].item()
-                        loss_aux_agg_dn[f'cls_{i}_dn'] += loss_dict[f'cls_{i}_dn'].item()
+                        agg['loss_aux_dn'][f'bbox_{i}_dn'] += loss_dict[f'bbox_{i}_dn'].item()
+                        agg['loss_aux_dn'][f'giou_{i}_dn'] += loss_dict[f'giou_{i}_dn'].item()
+                        agg['loss_aux_dn'][f'cls_{i}_dn'] += loss_dict[f'cls_{i}_dn'].item()
             if "enc_outputs" in out:
-                loss_enc_bbox_agg += loss_dict['bbox_enc'].item()
-                loss_enc_giou_agg += loss_dict['giou_enc'].item()
-                loss_enc_cls_agg += loss_dict['cls_enc'].item()
+                agg['loss_enc_bbox'] += loss_dict['bbox_enc'].item()
+                agg['loss_enc_giou'] += loss_dict['giou_enc'].item()
+                agg['loss_enc_cls'] += loss_dict['cls_enc'].item()
             memory_allocated, memory_cached = get_gpu_memory(self._device)
             progress_bar.set_postfix({'cached': "{:.2f}GB".format(memory_cached/(1024**3))})
+
+            # Mid-epoch checkpoint, training continues with the next step when resuming
+            preempted = update_step and preemption_requested(step // self._grad_accumulation_steps, self._preemption_check_every_n_steps)
+            if preempted or (self._checkpoint_every_n_steps and update_step and (step + 1) % self._checkpoint_every_n_steps == 0 and step + 1 < num_steps):
+                self._save_step_checkpoint(num_epoch, step + 1, epoch_rng_states, agg)
+            if preempted:
+                self._stop_preempted()
             
-        loss = loss_agg / len(self._train_loader)
+        loader_stats = self._loader_monitor.summary()
+        if self._loader_monitor.is_stalled(loader_stats) and is_main_process():
+            print(f"Waited for data during {loader_stats['stall_fraction']:.0%} of epoch {num_epoch}, consider tuning the loader with autotune_loader.")
+        self._write_to_logger(num_epoch, 'loader', **loader_stats)
+        self._write_to_logger(num_epoch, 'tensor_cache', **TENSOR_CACHE.stats())
+        TENSOR_CACHE.reset_stats()
+        self._write_to_logger(num_epoch, 'step_time_ms', **self._timer.summary())
+        if self._memory_profiler.enabled:
+            if is_main_process():
+                (self._path_to_run / 'memory_report.txt').write_text(self._memory_profiler.report())
+            self._write_to_logger(num_epoch, 'activation_memory_mb', **self._memory_profiler.summary())
+
+        loss = agg['loss'] / len(self._train_loader)
         #print(f'total train loss for epoch {num_epoch}: '+str(loss))
-        loss_bbox = loss_bbox_agg / len(self._train_loader)
-        loss_giou = loss_giou_agg / len(self._train_loader)
-        loss_cls = loss_cls_agg / len(self._train_loader)
-        loss_seg_ce = loss_seg_ce_agg / len(self._train_loader)
-        loss_seg_dice = loss_seg_dice_agg / len(self._train_loader)
+        loss_bbox = agg['loss_bbox'] / len(self._train_loader)
+        loss_giou = agg['loss_giou'] / len(self._train_loader)
+        loss_cls = agg['loss_cls'] / len(self._train_loader)
+        loss_seg_ce = agg['loss_seg_ce'] / len(self._train_loader)
+        loss_seg_dice = agg['loss_seg_dice'] / len(self._train_loader)
         loss_aux_model = loss_aux_model / len(self._train_loader) if self._aux_model is not None else 0
         loss_old_model = loss_old_model / len(self._train_loader) if self._old_model is not None else 0
 
         if self._hybrid: # hybrid matching
-            loss_bbox_one2many = loss_bbox_one2many_agg / len(self._train_loader)
-            loss_giou_one2many = loss_giou_one2many_agg / len(self._train_loader)
-            loss_cls_one2many = loss_cls_one2many_agg / len(self._train_loader)
-            loss_seg_ce_one2many = loss_seg_ce_one2many_agg / len(self._train_loader)
-            loss_seg_dice_one2many = loss_seg_dice_one2many_agg / len(self._train_loader)
+            loss_bbox_one2many = agg['loss_bbox_one2many'] / len(self._train_loader)
+            loss_giou_one2many = agg['loss_giou_one2many'] / len(self._train_loader)
+            loss_cls_one2many = agg['loss_cls_one2many'] / len(self._train_loader)
+            loss_seg_ce_one2many = agg['loss_seg_ce_one2many'] / len(self._train_loader)
+            loss_seg_dice_one2many = agg['loss_seg_dice_one2many'] / len(self._train_loader)
         
         if self._criterion._seg_proxy:  # log Hausdorff
-            seg_hd95 = hd95_agg / len(self._train_loader)
+            seg_hd95 = agg['hd95'] / len(self._train_loader)
         else:
             seg_hd95 = 0
 
-        loss_contrast = loss_contrast_agg / len(self._train_loader)
+        loss_contrast = agg['loss_contrast'] / len(self._train_loader)
         
-        if len(loss_dn_agg) != 0:
-            for key in loss_dn_agg:
-                value = loss_dn_agg[key] / len(self._train_loader)
+        if len(agg['loss_dn']) != 0:
+            for key in agg['loss_dn']:
+                value = agg['loss_dn'][key] / len(self._train_loader)
                 self._writer.add_scalar("dn/"+key, value, num_epoch)
-        if len(loss_aux_agg) != 0:
-            for key in loss_aux_agg:
-                value = loss_aux_agg[key] / len(self._train_loader)
+        if len(agg['loss_aux']) != 0:
+            for key in agg['loss_aux']:
+                value = agg['loss_aux'][key] / len(self._train_loader)
                 self._writer.add_scalar("train_aux/"+key, value, num_epoch)
-        if len(loss_aux_agg_dn) != 0:
-            for key in loss_aux_agg_dn:
-                value = loss_aux_agg_dn[key] / len(self._train_loader)
+        if len(agg['loss_aux_dn']) != 0:
+            for key in agg['loss_aux_dn']:
+                value = agg['loss_aux_dn'][key] / len(self._train_loader)
                 self._writer.add_scalar("dn/"+key, value, num_epoch)
-        if loss_enc_bbox_agg or loss_enc_giou_agg or loss_enc_cls_agg:
-            self._writer.add_scalar("train_enc/bbox_enc", loss_enc_bbox_agg/len(self._train_loader), num_epoch)
-            self._writer.add_scalar("train_enc/giou_enc", loss_enc_giou_agg/len(self._train_loader), num_epoch)
-            self._writer.add_scalar("train_enc/cls_enc", loss_enc_cls_agg/len(self._train_loader), num_epoch)
+        if agg['loss_enc_bbox'] or agg['loss_enc_giou'] or agg['loss_enc_cls']:
+            self._writer.add_scalar("train_enc/bbox_enc", agg['loss_enc_bbox']/len(self._train_loader), num_epoch)
+            self._writer.add_scalar("train_enc/giou_enc", agg['loss_enc_giou']/len(self._train_loader), num_epoch)
+            self._writer.add_scalar("train_enc/cls_enc", agg['loss_enc_cls']/len(self._train_loader), num_epoch)
 
         if self._hybrid: # log many2one just if hybrid matching is activated
             self._write_to_logger(
@@ -427,17 +502,17 @@ class Trainer_CL:
             )
             
             if self.log_grad and num_epoch % self.log_grad_every_epoch == 0:
-                self.log_grads_list_pos.append(torch.flatten(pos_query_grads_list, 0).cpu())
-                self.log_grads_list_neg.append(torch.flatten(neg_query_grads_list, 0).cpu())
+                self.log_grads_list_pos.append(torch.flatten(agg['pos_query_grads_list'], 0).cpu())
+                self.log_grads_list_neg.append(torch.flatten(agg['neg_query_grads_list'], 0).cpu())
                 self.log_epoch_list.append(num_epoch)
                 
-                avg_pos_queries_grad = torch.abs(pos_query_grads_list).mean()
-                avg_neg_queries_grad = torch.abs(neg_query_grads_list).mean()
+                avg_pos_queries_grad = torch.abs(agg['pos_query_grads_list']).mean()
+                avg_neg_queries_grad = torch.abs(agg['neg_query_grads_list']).mean()
                 self._writer.add_scalar("grads/avg_pos_queries_grad", avg_pos_queries_grad, num_epoch)
                 self._writer.add_scalar("grads/avg_neg_queries_grad", avg_neg_queries_grad, num_epoch)
                 
                 
-                for name, param in self._model.named_parameters():
+                for name, param in unwrap_model(self._model).named_parameters():
                     if param.requires_grad and param.grad is not None:
                         self._writer.add_histogram('grads/' + name, param.grad, int(num_epoch))
 
@@ -461,7 +536,7 @@ class Trainer_CL:
         loss_enc_bbox_agg = 0
         loss_enc_giou_agg = 0
         loss_enc_cls_agg = 0
-        progress_bar = tqdm(self._val_loader)
+        progress_bar = tqdm(self._val_loader, disable=not is_main_process())
         for idx, (data, _, bboxes, seg_targets) in enumerate(progress_bar):
             # Put data to gpu
             data, seg_targets = data.to(device=self._device), seg_targets.to(device=self._device)
@@ -481,7 +556,7 @@ class Trainer_CL:
 
             # Make prediction
             with autocast():
-                out = self._model(data)
+                out = unwrap_model(self._model)(data)
                 loss_dict, _ = self._criterion(out, det_targets, seg_targets, num_epoch=num_epoch)
 
                 if self._criterion._seg_proxy: # log Hausdorff
@@ -566,6 +641,7 @@ class Trainer_CL:
         else:
             seg_hd95 = 0
 
+        self._evaluator_val.gather(len(self._val_loader.dataset))  # results of all ranks
         metric_scores = self._evaluator_val.eval()
         self._evaluator_val.reset()
 
@@ -643,7 +719,7 @@ class Trainer_CL:
                     sparse_results=False
                 )
             
-            for data, _, bboxes, _, _ in tqdm(dataloader_test):
+            for data, _, bboxes, _, _ in tqdm(dataloader_test, disable=not is_main_process()):
                 # print labels of bboxes
                 # print(bboxes[0][1])
 
@@ -657,7 +733,7 @@ class Trainer_CL:
                     }
                     det_targets.append(target) # Append target to list
 
-                out = self._model(data) # Make prediction
+                out = unwrap_model(self._model)(data) # Make prediction
 
                 pred_boxes, pred_classes, pred_scores = inference(out) # Get predictions
                 
@@ -673,15 +749,18 @@ class Trainer_CL:
                     gt_classes=gt_classes
                 )
 
+            evaluator_test.gather(len(dataloader_test.dataset)) # Collect results of all ranks
             metric_scores = evaluator_test.eval() # Evaluate predictions
             evaluator_test.reset() # Reset evaluator
             del evaluator_test # Delete evaluator
             
+            mean_mAP_coco.append(metric_scores['mAP_coco'])
+            
+            if not is_main_process(): # results are gathered, only rank 0 writes them
+                continue
             os.makedirs(self._path_to_run / 'test_during_training', exist_ok=True)
             os.makedirs(self._path_to_run / 'test_during_training' / f"{num_epoch}_epoch", exist_ok=True)
 
-            mean_mAP_coco.append(metric_scores['mAP_coco'])
-            
             if 'ABDOMENCT-1K_WORD' in self._config['experiment_name']:
                 if idx == 0: 
                     write_json(metric_scores, self._path_to_run / 'test_during_training' / f"{num_epoch}_epoch" / 'WORD_dataset.json')
@@ -715,7 +794,7 @@ class Trainer_CL:
             self._save_checkpoint(num_epoch, f'model_best_test_{mean_mAP_coco:.3f}_in_ep{num_epoch}.pt')        
 
     def run(self):
-        if self._epoch_to_start == 0:   # For initial performance estimation
+        if self._epoch_to_start == 0 and self._resume_state is None:   # For initial performance estimation
             self._validate(0)
             if self._test_loader is not None:
                 self._test(0)
@@ -725,7 +804,9 @@ class Trainer_CL:
 
                 
         for epoch in range(self._epoch_to_start + 1, self._config['epochs'] + 1):
-            print("starting epoch ", epoch)
+            if is_main_process():
+                print("starting epoch ", epoch)
+            set_sampler_epoch(self._train_loader, epoch)
             self._train_one_epoch(epoch)
 
             # Log learning rates
@@ -762,6 +843,11 @@ class Trainer_CL:
             if epoch % 500 == 0:
                 self._save_checkpoint(epoch, f'model_epoch_{epoch}.pt')
 
+            if preemption_requested():  # signal during validation, model_last.pt is up to date
+                self._stop_preempted()
+
+        self._checkpoint_writer.close()
+
     @torch.no_grad()
     def _select_samples_for_replay(self):
         
@@ -808,7 +894,7 @@ class Trainer_CL:
         for param in old_model_samples_rep.parameters():
             param.requires_grad = False
 
-        for data, _, bboxes, _, path in tqdm(self._train_loader):
+        for data, _, bboxes, _, path in tqdm(self._train_loader, disable=not is_main_process()):
 
             data = data.to(device=self._device)
 
@@ -837,6 +923,9 @@ class Trainer_CL:
 
         evaluator_replay.reset() # Reset evaluator
 
+        # Each rank scored its share of the samples
+        replay_scores = {path: score for scores in all_gather_object(replay_scores) for path, score in scores.items()}
+
         # Sort the replay scores in ascending order
         replay_scores = dict(sorted(replay_scores.items(), key=lambda item: item[1]))
 
@@ -850,29 +939,60 @@ class Trainer_CL:
                                                                 selected_samples=replay_samples)
 
     def _write_to_logger(self, num_epoch, category, **kwargs):
-        for key, value in kwargs.items():
-            name = category + '/' + key
-            self._writer.add_scalar(name, value, num_epoch)
+        for key, value in all_reduce_mean_dict(kwargs).items(): # mean over ranks, one collective per call
+            self._writer.add_scalar(category + '/' + key, value, num_epoch)
 
-    def _save_checkpoint(self, num_epoch, name):
-        # Delete prior best checkpoint
-        if 'model_best_val' in name:
-            [path.unlink() for path in self._path_to_run.iterdir() if 'model_best_val' in str(path)]
+    def _save_checkpoint(self, num_epoch, name, **resume_state):
+        if not is_main_process():
+            return
 
-        if 'model_best_test' in name:
-            [path.unlink() for path in self._path_to_run.iterdir() if 'model_best_test' in str(path)]
+        # Prior best checkpoint is deleted once the new one is written
+        replaces = next((key for key in ['model_best_val', 'model_best_test'] if key in name), None)
 
-        torch.save({
+        self._checkpoint_writer.save({
             'epoch': num_epoch,
-            'metric_max_val': self._main_metric_max_val,
-            'metric_max_test': self.main_metric_max_test,
-            'model_state_dict': self._model.state_dict(),
+            'metric_max_val': float(self._main_metric_max_val),   # no numpy types, checkpoints load with weights_only
+            'metric_max_test': float(self.main_metric_max_test),
+            'model_state_dict': unwrap_model(self._model).state_dict(),
             'optimizer_state_dict': self._optimizer.state_dict(),
             'scheduler_state_dict': self._scheduler.state_dict(),
-        }, self._path_to_run / name)
+            'scaler_state_dict': self._scaler.state_dict(),
+            **resume_state
+        }, self._path_to_run / name, replaces=replaces)
+
+    def _save_step_checkpoint(self, num_epoch, step, epoch_rng_states, metric_buffers):
+        """Saves a checkpoint in the middle of an epoch to model_last.pt.
+
+        The epoch is stored as not yet finished, the sampler position, the random states of all
+        ranks and the metric buffers allow to continue the epoch with the given step.
+        """
+        resume_state = {
+            'step': step,
+            'epoch_rng_states': epoch_rng_states,
+            'rng_states': all_gather_object(get_rng_states()),
+            'metric_buffers': all_gather_object(metric_buffers),
+        }
+        self._save_checkpoint(num_epoch - 1, 'model_last.pt', **resume_state)
+
+    def _stop_preempted(self):
+        """Waits until the checkpoint is written, marks the run for resuming and stops training."""
+        self._checkpoint_writer.close()
+        mark_preempted(self._path_to_run)
+        raise TrainingPreempted()
+
+    def load_resume_state(self, checkpoint):
+        """Restores the state that is not part of model, optimizer and scheduler from a checkpoint."""
+        if 'scaler_state_dict' in checkpoint:
+            self._scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        if checkpoint.get('step', 0) > 0:
+            assert len(checkpoint['rng_states']) == get_world_size(), \
+                "Mid-epoch checkpoints have to be resumed with the same number of processes."
+            self._resume_state = checkpoint
 
 def get_gpu_memory(device):
     #torch.cuda.empty_cache()
+    if 'cuda' not in str(device):
+        return 0, 0
     memory_allocated = torch.cuda.memory_allocated(device)
     memory_cached = torch.cuda.memory_cached(device)
     return memory_allocated, memory_cached
@@ -210,128 +210,149 @@ def iou_3d_np(bboxes1, bboxes2, format_='cxcyczwhd'):
 
 
 def merge_patches(predictions, patch_positions, patch_size, image_size, mode, config=None):
-    assert mode in ["average", "center_dist", "score", "volume", "volume_similarity", "custom"]
-    # Initialize empty lists to store the highest scoring boxes
-    boxes_dict = {}
-    boxes_volume_dict = {}
-    classes_dict = {}
-    scores_dict = {}
-    highest_scores = {}
-    center_dist = {} # for center_dist mode
-    min_vol_diff = {}
-
-    if mode == "custom":
-        custom_mode = True # uses center_dist for M&L organs and average for S organs
-    else:
-        custom_mode = False
-        
-    labels_small = [int(i) for i in config['labels_small'].keys()]
-    labels_medium = [int(i) for i in config['labels_mid'].keys()]
-    labels_large = [int(i) for i in config['labels_large'].keys()]
-    
-    if mode == "volume_similarity":
-        median_volumes = get_median_volumes(config['bbox_properties'])
+    """Merges the predictions of all patches of a sliding window inference into one prediction per class.
+
+    Args:
+        predictions: A dict mapping patch ids to the output of inference() for this patch, i.e.,
+            'pred_boxes' [N, 6] in the normalized cxcyczwhd format of the patch, 'pred_classes' [N]
+            and 'pred_scores' [N].
+        patch_positions: A tensor of shape [num_patches, 3] containing the offsets of the patches.
+        patch_size: The spatial size of a patch.
+        image_size: The spatial size of the (padded) image.
+        mode: How to merge multiple predictions of the same class. 'score', 'volume', 'center_dist'
+            and 'volume_similarity' select one box per class, 'average' averages the boxes not touching
+            the patch border, 'custom' averages small organs and uses center_dist for the others and
+            'wbf' applies a score weighted box fusion.
+        config: The run config, providing the organ size groups and bbox properties.
 
+    Returns:
+        The merged boxes in normalized cxcyczwhd format of the image, the classes and the scores,
+        each wrapped in a list as required by the evaluator.
+    """
+    assert mode in ["average", "center_dist", "score", "volume", "volume_similarity", "custom", "wbf"]
     assert patch_positions.shape[0] == len(predictions.keys())
-    # Transform the normalized bounding boxes to global coordinates
-    for patch_id, prediction in predictions.items():
-        #print(f"processing patch {patch_id}")
-        position = patch_positions[patch_id]
-        boxes = prediction['pred_boxes']
-        classes = prediction['pred_classes']
-        scores = prediction['pred_scores']
-
-        for box, class_, score in zip(boxes, classes, scores):
-            if custom_mode:
-                if class_ in labels_small:
-                    mode = "average"
-                elif class_ in labels_medium or class_ in labels_large:
-                    mode = "center_dist"
-            if mode == "average":
-                skip = False
-                for cord in box_cxcyczwhd_to_xyzxyz(box):
-                    if cord > 0.95 or cord < 0.05:  # Skips bbox if corner point in 5% border
-                        skip = True
-                if skip:
-                    #print("skipped bbox")
-                    continue
 
-            norm_x, norm_y, norm_z, norm_w, norm_h, norm_d = box
-            local_x = norm_x * patch_size[0]
-            local_y = norm_y * patch_size[1]
-            local_z = norm_z * patch_size[2]
-            w = norm_w * patch_size[0]
-            h = norm_h * patch_size[1]
-            d = norm_d * patch_size[2]
-            global_x = local_x + position[0]
-            global_y = local_y + position[1]
-            global_z = local_z + position[2]
-
-            # Normalize the global coordinates to the size of the image
-            norm_global_box = [global_x / image_size[0], global_y / image_size[1], global_z / image_size[2], 
-                                w / image_size[0], h / image_size[1], d / image_size[2]]
-            
-            box_volume = norm_global_box[-3] * norm_global_box[-2] * norm_global_box[-1]
-            if class_ not in boxes_volume_dict.keys():
-                boxes_volume_dict[class_] = 0
-                highest_scores[class_] = 0
-                center_dist[class_] = 99
-                min_vol_diff[class_] = 99
-            # If this class has not been seen before or this box has a higher score than the previous box for this class
-            if mode == "volume" and box_volume > boxes_volume_dict[class_]:
-                # Update the highest scoring box for this class
-                #print(f"prediction for  {class_}")
-                boxes_dict[class_] = norm_global_box
-                classes_dict[class_]= class_
-                scores_dict[class_] = score
-            elif mode == "score" and score > highest_scores[class_]:
-                # Update the highest scoring box for this class
-                boxes_dict[class_] = norm_global_box
-                classes_dict[class_]= class_
-                scores_dict[class_] = score
-                highest_scores[class_] = score
-            elif mode == "average":
-                if class_ not in boxes_dict.keys():
-                    boxes_dict[class_] = []
-                    scores_dict[class_] = []    
-                boxes_dict[class_].append(norm_global_box)
-                scores_dict[class_].append(score)
-                classes_dict[class_]= class_
-
-            elif mode == "center_dist":
-                dist = np.linalg.norm((norm_x, norm_y, norm_z) - np.array([0.5, 0.5, 0.5]))
-                if dist < center_dist[class_]:
-                    boxes_dict[class_] = norm_global_box
-                    classes_dict[class_]= class_
-                    scores_dict[class_] = score
-                    center_dist[class_] = dist
-            elif mode == "volume_similarity" :
-                vol_diff = np.abs(median_volumes[class_] - box_volume)
-                if vol_diff < min_vol_diff[class_]:
-                    boxes_dict[class_] = norm_global_box
-                    classes_dict[class_]= class_
-                    scores_dict[class_] = score
-                    min_vol_diff[class_] = vol_diff
-                
-                
-    if mode == "average" and not custom_mode:   # Average all predictions
-        for class_ in boxes_dict.keys():
-            boxes_dict[class_] = np.mean(boxes_dict[class_], axis=0)
-            scores_dict[class_] = np.mean(scores_dict[class_])
-    elif custom_mode:   # Average only predictions for small organs
-        for class_ in labels_small:
-            if class_ not in boxes_dict.keys():
-                continue
-            boxes_dict[class_] = np.mean(boxes_dict[class_], axis=0)
-            scores_dict[class_] = np.mean(scores_dict[class_])
-
-
-    # Convert lists to numpy arrays
-    boxes_array = np.array(list(boxes_dict.values()))
-    classes_array = np.array(list(classes_dict.values()))
-    scores_array = np.array(list(scores_dict.values()))
-
-    return [boxes_array], [classes_array], [scores_array]
+    # Stack the predictions of all patches to [num_boxes, ...] arrays
+    patch_ids = list(predictions.keys())
+    boxes = np.concatenate(
+        [np.asarray(predictions[patch_id]['pred_boxes'], dtype=np.float64).reshape(-1, 6) for patch_id in patch_ids]
+    )
+    classes = np.concatenate(
+        [np.asarray(predictions[patch_id]['pred_classes']).reshape(-1) for patch_id in patch_ids]
+    ).astype(np.int64)
+    scores = np.concatenate(
+        [np.asarray(predictions[patch_id]['pred_scores'], dtype=np.float64).reshape(-1) for patch_id in patch_ids]
+    )
+    num_boxes = [len(np.asarray(predictions[patch_id]['pred_classes']).reshape(-1)) for patch_id in patch_ids]
+    positions = np.repeat(np.asarray(patch_positions, dtype=np.float64)[patch_ids].reshape(-1, 3), num_boxes, axis=0)
+
+    # Transform the normalized bounding boxes to normalized global coordinates
+    patch_size = np.asarray(patch_size, dtype=np.float64)
+    image_size = np.asarray(image_size, dtype=np.float64)
+    global_boxes = np.concatenate(
+        [(boxes[:, :3] * patch_size + positions) / image_size, boxes[:, 3:] * patch_size / image_size], axis=1
+    )
+
+    if mode == "custom":    # uses average for S organs and center_dist for M&L organs
+        labels_small = [int(i) for i in config['labels_small'].keys()]
+        average_mask = np.isin(classes, labels_small)
+    else:
+        average_mask = np.full(classes.shape, mode == "average")
+
+    merged_boxes, merged_classes, merged_scores = [], [], []
+    if average_mask.any():
+        # Skips bboxes with a corner point in the 5% border of the patch
+        corners = box_cxcyczwhd_to_xyzxyz(boxes)
+        valid = average_mask & ((corners <= 0.95) & (corners >= 0.05)).all(axis=1)
+        ids, inverse, counts = np.unique(classes[valid], return_inverse=True, return_counts=True)
+        box_sums = np.zeros((ids.shape[0], 6))
+        np.add.at(box_sums, inverse, global_boxes[valid])
+        merged_boxes.append(box_sums / counts[:, None])
+        merged_classes.append(ids)
+        merged_scores.append(np.bincount(inverse, weights=scores[valid], minlength=ids.shape[0]) / counts)
+
+    select_mask = ~average_mask
+    if select_mask.any():
+        if mode == "wbf":
+            fused_boxes, fused_classes, fused_scores = _fuse_per_class(
+                global_boxes[select_mask], classes[select_mask], scores[select_mask],
+                iou_thr=config.get('patch_merge_wbf_iou', 0.55) if config is not None else 0.55
+            )
+            merged_boxes.append(fused_boxes)
+            merged_classes.append(fused_classes)
+            merged_scores.append(fused_scores)
+        else:
+            if mode == "score":
+                criterion = -scores
+            elif mode == "volume":
+                criterion = -global_boxes[:, 3:].prod(axis=1)
+            elif mode == "volume_similarity":
+                median_volumes = get_median_volumes(config['bbox_properties'])
+                criterion = np.abs(
+                    np.array([median_volumes[class_] for class_ in classes]) - global_boxes[:, 3:].prod(axis=1)
+                )
+            else:   # center_dist, also used for M&L organs in custom mode
+                criterion = np.linalg.norm(boxes[:, :3] - 0.5, axis=1)
+
+            selected = np.flatnonzero(select_mask)[_argmin_per_class(classes[select_mask], criterion[select_mask])]
+            merged_boxes.append(global_boxes[selected])
+            merged_classes.append(classes[selected])
+            merged_scores.append(scores[selected])
+
+    if not merged_classes:
+        return [np.zeros((0, 6))], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+
+    # Sort merged predictions by class
+    boxes_array = np.concatenate(merged_boxes)
+    classes_array = np.concatenate(merged_classes)
+    scores_array = np.concatenate(merged_scores)
+    order = np.argsort(classes_array, kind='stable')
+
+    return [boxes_array[order]], [classes_array[order]], [scores_array[order]]
+
+def _argmin_per_class(classes, criterion):
+    """Returns the index of the box with the lowest criterion for each class, the first box wins ties."""
+    order = np.lexsort((criterion, classes))    # stable, sorted by class and then by criterion
+    _, first = np.unique(classes[order], return_index=True)
+    return order[first]
+
+def _fuse_per_class(boxes, classes, scores, iou_thr=0.55):
+    """Score weighted box fusion of the boxes of each class.
+
+    The boxes of a class are greedily clustered in descending score order, a box joins the first cluster
+    whose fused box it overlaps with an IoU of at least iou_thr. Corners of a cluster are averaged weighted
+    by the scores, the cluster with the highest summed score is kept as the prediction of the class.
+    """
+    corners = box_cxcyczwhd_to_xyzxyz(boxes)
+    fused_boxes, fused_classes, fused_scores = [], [], []
+    for class_ in np.unique(classes):
+        class_ids = np.flatnonzero(classes == class_)
+        class_ids = class_ids[np.argsort(-scores[class_ids], kind='stable')]
+        class_corners, class_scores = corners[class_ids], scores[class_ids]
+
+        cluster_ids = np.zeros(class_ids.shape[0], dtype=np.int64)
+        cluster_boxes = class_corners[:1].copy()
+        for idx in range(1, class_ids.shape[0]):
+            ious = iou_3d_np(class_corners[idx:idx + 1], cluster_boxes, format_='xyzxyz')[0]
+            best = ious.argmax()
+            if ious[best] >= iou_thr:
+                cluster_ids[idx] = best
+                members = cluster_ids[:idx + 1] == best
+                cluster_boxes[best] = np.average(class_corners[:idx + 1][members], axis=0, weights=class_scores[:idx + 1][members])
+            else:
+                cluster_ids[idx] = cluster_boxes.shape[0]
+                cluster_boxes = np.concatenate([cluster_boxes, class_corners[idx:idx + 1]])
+
+        score_sums = np.bincount(cluster_ids, weights=class_scores)
+        best = score_sums.argmax()
+        fused_boxes.append(_box_xyzxyz_to_cxcyczwhd(cluster_boxes[best]))
+        fused_classes.append(class_)
+        fused_scores.append(score_sums[best] / (cluster_ids == best).sum())
+
+    return np.stack(fused_boxes), np.array(fused_classes, dtype=np.int64), np.array(fused_scores)
+
+def _box_xyzxyz_to_cxcyczwhd(bboxes):
+    return np.concatenate([(bboxes[..., :3] + bboxes[..., 3:]) / 2, bboxes[..., 3:] - bboxes[..., :3]], axis=-1)
 
 def get_median_volumes(bbox_properties):
     median_volumes = {}
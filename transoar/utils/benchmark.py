@@ -0,0 +1,101 @@
+"""Helper functions to time code and compare benchmark results."""
+
+import platform
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+from transoar.utils.io import load_json, write_json
+
+
+def measure(fn, repeats=10, warmup=2):
+    """Times repeated calls of a function.
+
+    Args:
+        fn: A function without arguments.
+        repeats: Number of timed calls.
+        warmup: Number of calls before timing, e.g., to fill caches and allocators.
+
+    Returns:
+        A dict containing the median, min and mean time of a call in ms and the number of repeats.
+    """
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'median_ms': float(np.median(times)),
+        'min_ms': float(np.min(times)),
+        'mean_ms': float(np.mean(times)),
+        'repeats': repeats
+    }
+
+def get_environment():
+    """Returns information about the machine, which has to match for results to be comparable."""
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'num_threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None
+    }
+
+def save_results(results, path):
+    write_json({'environment': get_environment(), 'results': results}, path)
+
+def compare_results(path_to_baseline, path_to_results, threshold=0.1, key='median_ms'):
+    """Compares benchmark results against a baseline.
+
+    Args:
+        path_to_baseline: Path of the JSON file written by save_results for the baseline.
+        path_to_results: Path of the JSON file of the new results.
+        threshold: Relative slowdown above which a benchmark counts as regression.
+        key: Time to compare.
+
+    Returns:
+        A list of rows (name, baseline time, new time, ratio, status) and a list of the names
+        of all regressions.
+    """
+    baseline = load_json(path_to_baseline)['results']
+    results = load_json(path_to_results)['results']
+
+    rows, regressions = [], []
+    for name in sorted(set(baseline) | set(results)):
+        if name not in baseline or name not in results:
+            rows.append((name, baseline.get(name, {}).get(key), results.get(name, {}).get(key), None, 'missing'))
+            continue
+
+        ratio = results[name][key] / max(baseline[name][key], 1e-9)
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((name, baseline[name][key], results[name][key], ratio, status))
+
+    return rows, regressions
+
+def format_table(header, rows):
+    """Formats rows as a plain text table, floats are rounded to two decimals."""
+    cells = [[f'{value:.2f}' if isinstance(value, float) else str(value) for value in row] for row in rows]
+    widths = [max(len(str(column)), *(len(row[idx]) for row in cells)) for idx, column in enumerate(header)]
+    lines = ['  '.join(str(column).ljust(width) for column, width in zip(header, widths))]
+    lines.append('  '.join('-' * width for width in widths))
+    lines += ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in cells]
+    return '\n'.join(lines)
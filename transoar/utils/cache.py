@@ -0,0 +1,84 @@
+"""Bounded cache of tensors that only depend on shapes, devices and module parameters."""
+
+from collections import OrderedDict, defaultdict
+
+import torch
+
+
+class TensorCache:
+    """Least recently used cache of tensors, e.g., positional encodings or attention masks.
+
+    Entries are computed outside of inference mode, so that tensors cached during inference can
+    also be used in training steps. Cached tensors are shared by all callers and must not be
+    modified in place.
+    """
+    def __init__(self, max_entries=128, max_bytes=512 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+
+    def get(self, namespace, key, fn):
+        """Returns the cached result of fn for key or computes it.
+
+        Args:
+            namespace: Name of the cached function, used for the statistics.
+            key: A hashable key containing everything the result depends on, e.g., the shape,
+                dtype and device of the input and the parameters of the module.
+            fn: A function without arguments computing a tensor or a tuple of tensors.
+        """
+        if not self.enabled:
+            return fn()
+
+        key = (namespace, key)
+        if key in self._entries:
+            self._hits[namespace] += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self._misses[namespace] += 1
+        with torch.inference_mode(False):
+            value = fn()
+
+        num_bytes = _nbytes(value)
+        if num_bytes <= self.max_bytes:
+            self._entries[key] = value
+            self._num_bytes += num_bytes
+            while len(self._entries) > self.max_entries or self._num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= _nbytes(evicted)
+        return value
+
+    def stats(self):
+        """Returns the hits, misses and hit rate of every namespace and the size of the cache."""
+        stats = {'entries': len(self._entries), 'mb': self._num_bytes / 2**20}
+        for namespace in sorted(set(self._hits) | set(self._misses)):
+            hits, misses = self._hits[namespace], self._misses[namespace]
+            stats.update({
+                f'{namespace}_hits': hits,
+                f'{namespace}_misses': misses,
+                f'{namespace}_hit_rate': hits / max(hits + misses, 1)
+            })
+        return stats
+
+    def reset_stats(self):
+        self._hits.clear()
+        self._misses.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self._num_bytes = 0
+        self.reset_stats()
+
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum(_nbytes(item) for item in value)
+    return value.numel() * value.element_size()
+
+
+# Shared by all modules
+TENSOR_CACHE = TensorCache()
@@ -0,0 +1,187 @@
+"""Checkpoint writer that saves state dicts on a background thread and helpers to load checkpoints of a run."""
+
+import atexit
+import os
+import queue
+import random
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from transoar.quantization import load_quantized, is_quantized
+
+
+def to_host(obj):
+    """Copies all tensors in a (nested) state dict to host memory.
+
+    Args:
+        obj: A tensor, or a dict, list or tuple containing tensors, e.g., a state dict.
+
+    Returns:
+        The same structure with detached CPU copies of all tensors, which are not modified
+        by further training steps.
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            host = torch.empty_like(obj, device='cpu', pin_memory=True)
+            return host.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return type(obj)((key, to_host(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(value) for value in obj)
+    return obj
+
+
+def get_checkpoint(path_to_run, model_load):
+    """Returns the path of the checkpoint of a run selected by the --model_load argument of the scripts.
+
+    Args:
+        path_to_run: The directory of the run.
+        model_load: The path of a checkpoint, or last, best, best_val, best_test, an epoch or e.g. last_int8,
+            which selects the checkpoint with the shortest name containing it.
+
+    Returns:
+        The path of the selected checkpoint.
+    """
+    avail_checkpoints = sorted([path for path in path_to_run.iterdir() if 'model_' in str(path)], key=lambda x: len(str(x)))
+    for path in avail_checkpoints:
+        if model_load == str(path):
+            return path
+
+    path_to_ckpt = [path for path in avail_checkpoints if model_load in str(path)]
+    if len(path_to_ckpt) == 0:
+        raise ValueError('No checkpoint found for specified epoch.')
+    return path_to_ckpt[0]
+
+def load_model(model, checkpoint, device, strict=True):
+    """Loads a float or quantized checkpoint into model and sets it to eval mode.
+
+    Args:
+        model: The model built from the config of the run.
+        checkpoint: The loaded checkpoint, e.g., written by the trainer or quantize.py.
+        device: The device to run the model on. Quantized models only run on CPUs.
+        strict: If False, layers that can not be loaded are reported and skipped.
+
+    Returns:
+        The loaded model and the device it runs on.
+    """
+    if is_quantized(checkpoint): # INT8 models only run on CPUs
+        if device != 'cpu':
+            print('Quantized checkpoint, running on CPU.')
+            device = 'cpu'
+        model = load_quantized(model.cpu(), checkpoint)
+    elif strict:
+        model.load_state_dict(checkpoint['model_state_dict'], strict=True)
+    else:
+        try:
+            model.load_state_dict(checkpoint['model_state_dict'], strict=True)
+        except Exception as e:
+            print("These layers could not be loaded: ", e)
+            print("Loading pretrained model with strict=False ...")
+            model.load_state_dict(checkpoint['model_state_dict'], strict=False)
+    return model.to(device=device).eval(), device
+
+
+def get_rng_states():
+    """Returns the states of the python, NumPy, torch and CUDA random number generators.
+
+    MONAI transforms are not covered, they are seeded per sample by the datasets. The NumPy keys
+    are stored as a tensor, so that checkpoints can be loaded with weights_only.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+def set_rng_states(states):
+    """Restores random number generator states returned by get_rng_states()."""
+    random.setstate(states['python'])
+    name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states['torch'].cpu())
+    if states['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in states['cuda']])
+
+
+class CheckpointWriter:
+    """Writes checkpoints with torch.save, either synchronously or on a background thread.
+
+    The state is snapshotted to host memory before save() returns, so training can continue
+    right away. Files are written to a temporary file and renamed, so a checkpoint on disk
+    is always complete. At most max_pending checkpoints wait in the queue, further calls to
+    save() block until a write has finished.
+    """
+    def __init__(self, asynchronous=True, max_pending=2):
+        self._asynchronous = asynchronous
+        self._error = None
+
+        if asynchronous:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._thread = threading.Thread(target=self._worker, name='checkpoint_writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def save(self, state, path, replaces=None):
+        """Saves the state to path.
+
+        Args:
+            state: A dict containing tensors, state dicts and python objects.
+            path: Path of the checkpoint file.
+            replaces: If given, other checkpoints in the same folder whose name contains this
+                string are deleted once the new checkpoint has been written.
+        """
+        self._raise_error()
+        state = to_host(state)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()    # wait for the non-blocking copies
+
+        if self._asynchronous:
+            self._queue.put((state, Path(path), replaces))
+        else:
+            self._write(state, Path(path), replaces)
+
+    def flush(self):
+        """Blocks until all pending checkpoints are written."""
+        if self._asynchronous:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._asynchronous and self._thread.is_alive():
+            self._queue.join()
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as error:  # raised in the training thread on the next call
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, path, replaces):
+        tmp_path = path.with_name(path.name + '.tmp')
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+        if replaces is not None:
+            for other_path in path.parent.iterdir():
+                if replaces in other_path.name and other_path != path and not other_path.name.endswith('.tmp'):
+                    other_path.unlink()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Writing a checkpoint failed.') from error
@@ -0,0 +1,352 @@
+"""Static cost model of the detectors: FLOPs, parameters and activation memory without real weights or data."""
+
+import itertools
+import weakref
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+import torch
+import torch._subclasses.fake_tensor as fake_tensor
+from torch import nn
+from torch.overrides import TorchFunctionMode
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils.flop_counter import flop_registry
+
+from transoar.models.ops.modules.ms_deform_attn import MSDeformAttn
+from transoar.utils.cache import TENSOR_CACHE
+from transoar.utils.memory import MB, get_stage, iter_tensors
+
+aten = torch.ops.aten
+
+# Tensors created from python data up to this size, e.g., the spatial shapes of the feature maps,
+# keep their values on fake tensors, so that shapes can be derived from them
+CONSTANT_NUMEL_LIMIT = 1024
+GFLOP = 1e9
+
+
+def grid_sampler_flop(input, grid, *args, out_val=None, **kwargs):
+    """Every sampled value interpolates 2**dims neighbors with one multiply-add each, see F.grid_sample."""
+    return 2 * 2**grid.shape[-1] * out_val.numel()
+
+def grid_sampler_backward_flop(grad_output, input, grid, *args, out_val=None, **kwargs):
+    """The gradients of the input and of the grid each cost about one forward pass."""
+    return 2 * grid_sampler_flop(input, grid, out_val=grad_output)
+
+# Formulas of torch.utils.flop_counter for matmuls, convolutions and attention, extended by the
+# sampling of the deformable attention and the fused attention on CPUs
+FLOP_FORMULAS = {
+    **flop_registry,
+    aten.grid_sampler_2d: grid_sampler_flop,
+    aten.grid_sampler_3d: grid_sampler_flop,
+    aten.grid_sampler_2d_backward: grid_sampler_backward_flop,
+    aten.grid_sampler_3d_backward: grid_sampler_backward_flop,
+    aten._scaled_dot_product_flash_attention_for_cpu: flop_registry[aten._scaled_dot_product_flash_attention],
+    aten._scaled_dot_product_flash_attention_for_cpu_backward: flop_registry[aten._scaled_dot_product_flash_attention_backward],
+}
+
+
+class CostModel:
+    """Estimates the FLOPs, parameters and activation memory of a model without real weights or data.
+
+    The model is built with fake tensors, which only carry shapes, dtypes and devices, and is run
+    once for inference and once for a training step, i.e., the forward and backward pass of a loss
+    depending on all outputs. FLOPs of matmuls, convolutions, attention and grid sampling are
+    counted, elementwise ops are ignored. FLOPs and activations are attributed to the innermost
+    module running, FLOPs of the backward pass to the module whose forward pass created the
+    autograd node. Tensors count from their creation until they are freed, parameters excluded.
+    Scalars depending on data, e.g., whether the input is padded, are assumed to be 1.
+
+    Args:
+        build_model: Function returning the model, e.g., lambda: TransoarNet(config). Its
+            parameters and buffers are created as fake tensors.
+    """
+    def __init__(self, build_model):
+        self._fake_mode = fake_tensor.FakeTensorMode(allow_non_fake_inputs=True)
+        with empty_weights(self._fake_mode):
+            self.model = build_model()
+
+        # The CUDA kernels of the deformable attention can't run on fake tensors, sampling costs the same
+        for module in self.model.modules():
+            if isinstance(module, MSDeformAttn):
+                module.use_cuda = False
+
+        self._static_storages = {
+            tensor.untyped_storage()._cdata for tensor in itertools.chain(self.model.parameters(), self.model.buffers())
+        }
+        self._module_stack = []
+        self._num_runs = 0
+        self._reset()
+
+    def params(self):
+        """Returns the number of parameters of every module, excluding its submodules."""
+        params = defaultdict(int)
+        for name, param in self.model.named_parameters():
+            params[name.rpartition('.')[0]] += param.numel()
+        return dict(params)
+
+    def run(self, input_shape, training=False, targets=None):
+        """Runs the model on a fake input and returns its costs.
+
+        Args:
+            input_shape: Shape of the input batch, e.g., [batch_size, 1, *data_size].
+            training: Run a training step instead of inference.
+            targets: Targets passed to the model, e.g., required for denoising queries.
+
+        Returns:
+            A dict containing the FLOPs of the 'forward' and 'backward' pass, the bytes of the
+            tensors 'saved' for the backward pass and the 'peak' of all tensors alive while running
+            every module, and the overall 'peak_bytes'.
+        """
+        self._reset()
+        self.model.train(training)
+        with self._tracking(training), torch.set_grad_enabled(training):
+            x = torch.empty(input_shape)
+            with torch.autograd.graph.saved_tensors_hooks(self._pack_hook, lambda tensor: tensor):
+                outputs = self.model(x, targets) if targets is not None else self.model(x)
+            if training:
+                # Tensors saved in branches whose outputs were dropped are freed already
+                for owner, num_bytes in self._saved_storages.values():
+                    self._saved[owner] += num_bytes
+                loss = sum(tensor.float().sum() for tensor in iter_tensors(outputs) if tensor.requires_grad)
+                del outputs
+                self._backward = True
+                loss.backward()
+                del loss
+            else:
+                del outputs
+            del x
+
+        for param in self.model.parameters():
+            param.grad = None
+        return {
+            'forward': dict(self._flops['forward']),
+            'backward': dict(self._flops['backward']),
+            'saved': dict(self._saved),
+            'peak': dict(self._peaks),
+            'peak_bytes': self._peak
+        }
+
+    def report(self, inference_shape, train_shape, targets=None, depth=2, optimizer_states=2):
+        """Returns the costs of inference and a training step per module, per stage and in total.
+
+        Args:
+            inference_shape: Shape of the input batch of inference.
+            train_shape: Shape of the input batch of training.
+            targets: Targets of the training batch passed to the model.
+            depth: Modules are grouped by the first depth parts of their names.
+            optimizer_states: Number of states per parameter, e.g., 2 for AdamW.
+        """
+        params = self.params()
+        inference = self.run(inference_shape)
+        train = self.run(train_shape, training=True, targets=targets)
+
+        num_params = sum(params.values())
+        trainable_params = sum(param.numel() for param in self.model.parameters() if param.requires_grad)
+        bytes_per_param = next(self.model.parameters()).element_size()
+        weights_mb = num_params * bytes_per_param / MB
+        optimizer_mb = optimizer_states * trainable_params * bytes_per_param / MB
+
+        modules = self._group(params, inference, train, lambda name: _get_group(name, depth))
+        stages = self._group(params, inference, train, get_stage)
+        return {
+            'params': num_params,
+            'trainable_params': trainable_params,
+            'weights_mb': weights_mb,
+            'optimizer_mb': optimizer_mb,
+            'inference_gflops': sum(inference['forward'].values()) / GFLOP,
+            'inference_peak_mb': inference['peak_bytes'] / MB,
+            'train_forward_gflops': sum(train['forward'].values()) / GFLOP,
+            'train_backward_gflops': sum(train['backward'].values()) / GFLOP,
+            'train_gflops': (sum(train['forward'].values()) + sum(train['backward'].values())) / GFLOP,
+            'train_saved_mb': sum(train['saved'].values()) / MB,
+            'train_peak_mb': train['peak_bytes'] / MB,
+            'train_total_mb': weights_mb + optimizer_mb + train['peak_bytes'] / MB,    # activations and gradients at the peak
+            'modules': modules,
+            'stages': stages
+        }
+
+    def _group(self, params, inference, train, get_group):
+        """Sums the costs of modules by group, in the order of the modules in the model."""
+        groups = {}
+        for name, _ in self.model.named_modules():
+            groups.setdefault(get_group(name), {
+                'params': 0, 'inference_gflops': 0., 'inference_peak_mb': 0., 'train_gflops': 0., 'train_saved_mb': 0.
+            })
+
+        for name, value in params.items():
+            groups[get_group(name)]['params'] += value
+        for costs, key, scale in [
+            (inference['forward'], 'inference_gflops', GFLOP), (train['forward'], 'train_gflops', GFLOP),
+            (train['backward'], 'train_gflops', GFLOP), (train['saved'], 'train_saved_mb', MB)
+        ]:
+            for name, value in costs.items():
+                groups[get_group(name)][key] += value / scale
+        for name, value in inference['peak'].items():
+            group = groups[get_group(name)]
+            group['inference_peak_mb'] = max(group['inference_peak_mb'], value / MB)
+        return groups
+
+    def _reset(self):
+        self._num_runs += 1     # tensors of earlier runs may be freed later
+        self._flops = {'forward': defaultdict(int), 'backward': defaultdict(int)}
+        self._saved = defaultdict(int)      # bytes saved for backward per module
+        self._peaks = defaultdict(int)      # peak bytes alive while a module runs
+        self._saved_storages = {}           # owner and bytes of saved storages alive
+        self._storage_refs = defaultdict(int)
+        self._tracked = set()   # ids of tensors alive, autograd also creates views of outputs, e.g., saved tensors
+        self._live = 0
+        self._peak = 0
+        self._backward = False
+
+    @contextmanager
+    def _tracking(self, training):
+        with ExitStack() as stack:
+            handles = []
+            for name, module in self.model.named_modules():
+                handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+                handles.append(module.register_forward_hook(self._post_hook(name)))
+            stack.callback(lambda: [handle.remove() for handle in handles])
+
+            # Cached tensors would outlive the fake tensor mode and be missing in later runs
+            cache_enabled = TENSOR_CACHE.enabled
+            TENSOR_CACHE.enabled = False
+            stack.callback(setattr, TENSOR_CACHE, 'enabled', cache_enabled)
+            constant_numel_limit = fake_tensor.CONSTANT_NUMEL_LIMIT
+            fake_tensor.CONSTANT_NUMEL_LIMIT = CONSTANT_NUMEL_LIMIT
+            stack.callback(setattr, fake_tensor, 'CONSTANT_NUMEL_LIMIT', constant_numel_limit)
+
+            stack.enter_context(self._fake_mode)
+            stack.enter_context(_CostMode(self))
+            if training:
+                stack.enter_context(_NodeTagMode(self))
+            yield
+
+    def _owner(self):
+        """Returns the name of the module running, in the backward pass the one that created the autograd node."""
+        if self._module_stack:
+            return self._module_stack[-1]
+        node = torch._C._current_autograd_node()
+        return node.metadata.get('module', '') if node is not None else ''
+
+    def _track(self, tensor, owner):
+        """Counts the storage of tensor as alive until all tensors seen using it are freed."""
+        storage = tensor.untyped_storage()
+        key = storage._cdata
+        if key in self._static_storages or id(tensor) in self._tracked:
+            return
+        self._tracked.add(id(tensor))
+        if self._storage_refs[key] == 0:
+            self._live += storage.nbytes()
+            self._peak = max(self._peak, self._live)
+            self._peaks[owner] = max(self._peaks[owner], self._live)
+        self._storage_refs[key] += 1
+        weakref.finalize(tensor, self._release, self._num_runs, id(tensor), key, storage.nbytes())
+
+    def _release(self, run, tensor_id, key, num_bytes):
+        if run != self._num_runs:
+            return
+        self._tracked.discard(tensor_id)
+        self._storage_refs[key] -= 1
+        if self._storage_refs[key] == 0:
+            del self._storage_refs[key]
+            self._saved_storages.pop(key, None)
+            self._live -= num_bytes
+
+    def _pack_hook(self, tensor):
+        storage = tensor.untyped_storage()
+        key = storage._cdata
+        if key not in self._saved_storages and key not in self._static_storages:
+            self._saved_storages[key] = (self._owner(), storage.nbytes())
+        self._track(tensor, self._owner())
+        return tensor
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self._module_stack.append(name)
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, outputs):
+            if self._module_stack and self._module_stack[-1] == name:
+                self._module_stack.pop()
+        return hook
+
+
+class _CostMode(TorchDispatchMode):
+    """Counts the FLOPs and tracks the outputs of all ops on fake tensors."""
+    def __init__(self, cost_model):
+        super().__init__()
+        self._cost_model = cost_model
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is aten._local_scalar_dense.default and getattr(args[0], 'constant', 0) is None:
+            return True if args[0].dtype == torch.bool else 1
+
+        cost_model = self._cost_model
+        owner = cost_model._owner()
+        for tensor in itertools.chain(iter_tensors(args), iter_tensors(kwargs)):
+            cost_model._track(tensor, owner)
+
+        out = func(*args, **kwargs)
+        if func.overloadpacket in FLOP_FORMULAS:
+            stage = 'backward' if cost_model._backward else 'forward'
+            cost_model._flops[stage][owner] += FLOP_FORMULAS[func.overloadpacket](*args, **kwargs, out_val=out)
+        for tensor in iter_tensors(out):
+            cost_model._track(tensor, owner)
+        return out
+
+
+class _NodeTagMode(TorchFunctionMode):
+    """Tags the autograd nodes created in the forward pass with the name of the module running."""
+    def __init__(self, cost_model):
+        super().__init__()
+        self._cost_model = cost_model
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if self._cost_model._module_stack:
+            owner = self._cost_model._module_stack[-1]
+            for tensor in iter_tensors(out):
+                _tag_nodes(tensor.grad_fn, owner)
+        return out
+
+
+@contextmanager
+def empty_weights(fake_mode):
+    """Replaces the parameters and buffers registered by modules in this context by fake tensors.
+
+    The tensors passed to the constructors of the layers are uninitialized and freed right away,
+    the initialization of the weights runs on the fake tensors without computations.
+    """
+    register_parameter, register_buffer = nn.Module.register_parameter, nn.Module.register_buffer
+
+    def register_fake_parameter(module, name, param):
+        if param is not None and not isinstance(param, fake_tensor.FakeTensor):
+            param = nn.Parameter(fake_mode.from_tensor(param), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    def register_fake_buffer(module, name, tensor, persistent=True):
+        if tensor is not None and not isinstance(tensor, fake_tensor.FakeTensor):
+            tensor = fake_mode.from_tensor(tensor)
+        register_buffer(module, name, tensor, persistent)
+
+    nn.Module.register_parameter, nn.Module.register_buffer = register_fake_parameter, register_fake_buffer
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter, nn.Module.register_buffer = register_parameter, register_buffer
+
+
+def _tag_nodes(node, owner):
+    """Tags node and all untagged nodes it depends on, i.e., the ones created by the same op."""
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if node is None or 'module' in node.metadata:
+            continue
+        node.metadata['module'] = owner
+        nodes.extend(next_node for next_node, _ in node.next_functions)
+
+def _get_group(name, depth):
+    return '.'.join(name.split('.')[:depth]) if name else 'model'
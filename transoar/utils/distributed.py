@@ -0,0 +1,199 @@
+"""Helper functions for distributed data-parallel training.
+
+Runs are launched with torchrun, e.g. `torchrun --nproc_per_node=8 scripts/train.py --config ...`,
+which sets RANK, LOCAL_RANK and WORLD_SIZE. Without these variables everything falls back to a
+single process and all helpers are no-ops.
+"""
+
+import math
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
+from torch.utils.tensorboard import SummaryWriter
+
+
+def init_distributed(config):
+    """Initializes the process group if launched with multiple processes.
+
+    Args:
+        config: The run config. 'distributed_backend' selects the backend, default is nccl if
+            CUDA is available and gloo otherwise. A 'device' of 'cpu' runs on CPU.
+
+    Returns:
+        The device of this rank.
+    """
+    if config.get('device', 'cuda') == 'cpu':
+        use_cuda = False
+    elif int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        use_cuda = torch.cuda.is_available()
+    else: # single process, select the configured GPU before CUDA is initialized
+        os.environ["CUDA_VISIBLE_DEVICES"] = config['device'][-1]
+        return 'cuda'
+
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not is_distributed():
+        backend = config.get('distributed_backend', 'nccl' if use_cuda else 'gloo')
+        dist.init_process_group(backend=backend)
+
+    if not use_cuda:
+        return 'cpu'
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    torch.cuda.set_device(local_rank)
+    return f'cuda:{local_rank}'
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def wrap_model(model, device, config):
+    """Wraps the model in DistributedDataParallel, gradients are all-reduced in backward."""
+    if not is_distributed():
+        return model
+    return DistributedDataParallel(
+        model, device_ids=[torch.device(device).index] if 'cuda' in str(device) else None,
+        find_unused_parameters=config.get('ddp_find_unused_parameters', True)  # e.g. two stage or dn heads
+    )
+
+def unwrap_model(model):
+    """Returns the underlying model, e.g., to access attributes or the state dict."""
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+def set_grad_sync(model, sync):
+    """Enables or disables the gradient all-reduce of the next forward/backward pass.
+
+    Same as DistributedDataParallel.no_sync() but without a context manager, so that
+    gradients can be accumulated locally over several batches.
+    """
+    if isinstance(model, DistributedDataParallel):
+        model.require_backward_grad_sync = sync
+
+def get_sampler(dataset, shuffle, seed=0, sample_seeds=False, group_size=1):
+    """Returns a sampler that splits the dataset over all ranks and can be resumed mid-epoch."""
+    return ResumableSampler(dataset, shuffle=shuffle, seed=seed, sample_seeds=sample_seeds, group_size=group_size)
+
+def set_sampler_epoch(loader, epoch):
+    """Reshuffles the per-rank splits, has to be called at the start of each epoch."""
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+def all_reduce_mean(value):
+    """Averages a python scalar over all ranks."""
+    if not is_distributed():
+        return value
+    tensor = torch.tensor(float(value), dtype=torch.float64,
+                          device='cuda' if dist.get_backend() == 'nccl' else 'cpu')
+    dist.all_reduce(tensor)
+    return tensor.item() / get_world_size()
+
+def all_reduce_mean_dict(values):
+    """Averages a dict of python scalars over all ranks with a single collective.
+
+    Keys that are missing on some ranks are averaged over the ranks that have them.
+    """
+    values = {key: float(value) for key, value in values.items()}
+    if not is_distributed():
+        return values
+    gathered = all_gather_object(values)
+    keys = dict.fromkeys(key for rank_values in gathered for key in rank_values)
+    return {
+        key: sum(rank_values[key] for rank_values in gathered if key in rank_values) /
+             sum(key in rank_values for rank_values in gathered)
+        for key in keys
+    }
+
+def all_gather_object(obj):
+    """Returns a list with the object of every rank."""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+def broadcast_object(obj, src=0):
+    """Returns the object of rank src on all ranks."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+def get_summary_writer(log_dir):
+    """Returns a SummaryWriter on rank 0, a writer that discards everything on the other ranks."""
+    if is_main_process():
+        return SummaryWriter(log_dir=log_dir)
+    return _NullWriter()
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler that can skip the samples of this rank already seen in an epoch.
+
+    The order only depends on the seed and the epoch, so an interrupted epoch can be continued
+    exactly. Also used without distributed training, where it covers the whole dataset.
+
+    With sample_seeds, (idx, seed) tuples are yielded, where the augmentation seeds are derived from
+    a base seed drawn from the global RNG each epoch. Persistent workers keep their initial seed
+    over all epochs, so they need the seeds from the sampler to augment differently each epoch.
+
+    With a group_size > 1, groups of consecutive indices are shuffled and split over the ranks as a
+    whole, e.g., the interleaved pairs of two datasets that have to end up in the same batch.
+    """
+    def __init__(self, dataset, shuffle, seed=0, sample_seeds=False, group_size=1):
+        super().__init__(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed)
+        self._start_index = 0
+        self._sample_seeds = sample_seeds
+        self._group_size = group_size
+        if group_size > 1:
+            assert len(dataset) % group_size == 0, "dataset has to consist of complete groups"
+            self.num_samples = math.ceil(len(dataset) // group_size / self.num_replicas) * group_size
+            self.total_size = self.num_samples * self.num_replicas
+
+    def set_start_index(self, start_index):
+        """Skips the first start_index samples in the next iteration."""
+        self._start_index = start_index
+
+    def __iter__(self):
+        indices = list(super().__iter__() if self._group_size == 1 else self._iter_groups())[self._start_index:]
+        self._start_index = 0
+        if self._sample_seeds:
+            base_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            return iter([(idx, (base_seed + idx) % 2**32) for idx in indices])
+        return iter(indices)
+
+    def __len__(self):
+        return max(self.num_samples - self._start_index, 0)
+
+    def _iter_groups(self):
+        groups = list(range(len(self.dataset) // self._group_size))
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            groups = torch.randperm(len(groups), generator=generator).tolist()
+
+        # Pad with repeated groups, so that every rank gets the same number of groups
+        num_groups = self.total_size // self._group_size
+        groups = (groups * math.ceil(num_groups / len(groups)))[:num_groups]
+        for group in groups[self.rank::self.num_replicas]:
+            yield from range(group * self._group_size, (group + 1) * self._group_size)
+
+
+class _NullWriter:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
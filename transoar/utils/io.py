@@ -1,6 +1,7 @@
 """Helper functions for input/output."""
 
 import os
+import contextlib
 import json
 import logging
 import pickle
@@ -8,6 +9,7 @@ from pathlib import Path
 import sys
 import socket
 import subprocess
+import tempfile
 
 import numpy as np
 import torch
@@ -39,6 +41,23 @@ def get_config(config_name):
 
     return config
 
+@contextlib.contextmanager
+def temporary_data_dir():
+    """Sets $TRANSOAR_DATA to a temporary directory, e.g., for a dataset info written by a script.
+
+    Yields the path of the directory, which is removed and $TRANSOAR_DATA restored afterwards.
+    """
+    transoar_data = os.environ.get('TRANSOAR_DATA')
+    with tempfile.TemporaryDirectory() as path_to_data:
+        os.environ['TRANSOAR_DATA'] = path_to_data
+        try:
+            yield Path(path_to_data)
+        finally:
+            if transoar_data is None:
+                del os.environ['TRANSOAR_DATA']
+            else:
+                os.environ['TRANSOAR_DATA'] = transoar_data
+
 def load_nifti(path_to_file):
     """Reads a .nii.gz file and extracts relevant information.
     
@@ -111,6 +130,10 @@ def write_pkl(data, file_path):
     with open(file_path, 'wb') as file:
         pickle.dump(data, file)
 
+def load_pkl(file_path):
+    with open(file_path, 'rb') as file:
+        return pickle.load(file)
+
 def write_json(data, file_path):
     with open(file_path, 'w') as file:
         json.dump(data, file, indent=3)
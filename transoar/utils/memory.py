@@ -0,0 +1,202 @@
+"""Profiler of the activation memory of the modules of a training step."""
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from transoar.models.activation_checkpointing import is_recomputing
+from transoar.utils.timing import MODEL_STAGES
+
+MB = 2**20
+
+
+class MemoryProfiler:
+    """Attributes the activation memory of profiled training steps to the modules of the model.
+
+    Tensors saved for the backward pass are counted with saved tensor hooks and attributed to the
+    innermost module running when they are saved, gradients of module outputs with tensor hooks.
+    This tensor-size accounting works on every device. On CUDA devices, the peak allocation of each
+    stage is read from the allocator statistics, otherwise the peak of the retained activations
+    is reported. If disabled, all methods are no-ops.
+    """
+    def __init__(self, device, enabled=True):
+        self._enabled = enabled
+        self._use_cuda = 'cuda' in str(device) and torch.cuda.is_available()
+        self._active = False
+        self._module_stack = []
+        self._stage_owner = None    # outermost module of the running stage
+        self._param_storages = set()
+        self.reset()
+
+    def attach(self, module, prefix):
+        """Registers the hooks of module and all its submodules, named by prefix and their attribute path."""
+        if not self._enabled:
+            return
+        self._param_storages.update(param.untyped_storage().data_ptr() for param in module.parameters())
+        for name, submodule in module.named_modules(prefix=prefix):
+            submodule.register_forward_pre_hook(self._pre_hook(name))
+            submodule.register_forward_hook(self._post_hook(name))
+
+    def attach_model(self, model, criterion):
+        self.attach(model, '')
+        self.attach(criterion, 'criterion')
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def start(self):
+        """Starts profiling a step, which has to include the forward and backward pass."""
+        if not self._enabled:
+            return
+        self._active = True
+        self._saved_storages = set()
+        self._retained = 0
+        self._saved_tensors_hooks = torch.autograd.graph.saved_tensors_hooks(self._pack_hook, lambda tensor: tensor)
+        self._saved_tensors_hooks.__enter__()
+
+    def stop(self):
+        if not self._active:
+            return
+        self._saved_tensors_hooks.__exit__(None, None, None)
+        self._active = False
+        self._module_stack.clear()
+        self._stage_owner = None
+        self._num_steps += 1
+
+    @contextmanager
+    def profile(self):
+        """Profiles the forward and backward passes run in this context."""
+        self.start()
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def stage(self, name):
+        """Measures the peak allocation of a stage without modules, e.g., the backward pass."""
+        if not (self._enabled and self._active):
+            return nullcontext()
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name):
+        self._enter_stage(name)
+        try:
+            yield
+        finally:
+            self._exit_stage(name)
+
+    def reset(self):
+        self._saved = defaultdict(int)      # bytes saved for backward per module
+        self._outputs = defaultdict(int)    # bytes of module outputs per module
+        self._grads = defaultdict(int)      # bytes of gradients of module outputs per module
+        self._peaks = defaultdict(int)      # peak bytes per stage
+        self._saved_storages = set()
+        self._retained = 0
+        self._num_steps = 0
+
+    def report(self, top_k=25):
+        """Returns a table of the modules retaining the most activation memory per profiled step."""
+        num_steps = max(self._num_steps, 1)
+        lines = [f"{'module':<70} {'saved [MB]':>12} {'output [MB]':>12} {'grad [MB]':>12}"]
+        for name in sorted(self._saved, key=self._saved.get, reverse=True)[:top_k]:
+            lines.append(
+                f'{name or "model":<70} {self._saved[name] / MB / num_steps:>12.2f} '
+                f'{self._outputs[name] / MB / num_steps:>12.2f} {self._grads[name] / MB / num_steps:>12.2f}'
+            )
+
+        lines.append('')
+        lines.append(f"{'stage':<70} {'saved [MB]':>12} {'peak [MB]':>12}")
+        saved_per_stage = self._saved_per_stage()
+        for stage in sorted(set(saved_per_stage) | set(self._peaks), key=lambda stage: -self._peaks.get(stage, 0)):
+            lines.append(f'{stage:<70} {saved_per_stage.get(stage, 0) / MB / num_steps:>12.2f} {self._peaks.get(stage, 0) / MB:>12.2f}')
+        return '\n'.join(lines)
+
+    def summary(self):
+        """Returns the saved activations and peak memory in MB of every stage and resets the profiler."""
+        num_steps = max(self._num_steps, 1)
+        memory = {f'{stage}_saved': value / MB / num_steps for stage, value in self._saved_per_stage().items()}
+        memory.update({f'{stage}_peak': value / MB for stage, value in self._peaks.items()})
+        if self._saved:
+            memory['total_saved'] = sum(self._saved.values()) / MB / num_steps
+
+        self.reset()
+        return memory
+
+    def _saved_per_stage(self):
+        saved_per_stage = defaultdict(int)
+        for name, value in self._saved.items():
+            saved_per_stage[get_stage(name)] += value
+        return saved_per_stage
+
+    def _pack_hook(self, tensor):
+        storage = tensor.untyped_storage()
+        key = storage.data_ptr()
+        if key not in self._saved_storages and key not in self._param_storages:
+            self._saved_storages.add(key)
+            self._retained += storage.nbytes()
+            self._saved[self._module_stack[-1] if self._module_stack else ''] += storage.nbytes()
+        return tensor
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            if not self._active or is_recomputing():  # counted in the forward pass already
+                return
+            self._module_stack.append(name)
+            if name and self._stage_owner is None:  # the model itself spans all stages
+                self._stage_owner = name
+                self._enter_stage(get_stage(name))
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, outputs):
+            if not self._active or is_recomputing():
+                return
+            for tensor in iter_tensors(outputs):
+                self._outputs[name] += tensor.numel() * tensor.element_size()
+                if tensor.requires_grad:
+                    tensor.register_hook(self._grad_hook(name))
+            if self._module_stack and self._module_stack[-1] == name:
+                self._module_stack.pop()
+            if name == self._stage_owner:
+                self._stage_owner = None
+                self._exit_stage(get_stage(name))
+        return hook
+
+    def _grad_hook(self, name):
+        def hook(grad):
+            self._grads[name] += grad.numel() * grad.element_size()
+        return hook
+
+    def _enter_stage(self, stage):
+        if self._use_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+
+    def _exit_stage(self, stage):
+        peak = torch.cuda.max_memory_allocated() if self._use_cuda else self._retained
+        self._peaks[stage] = max(self._peaks[stage], peak)
+
+
+def get_stage(name):
+    """Returns the stage of MODEL_STAGES a module belongs to, given its name in the model or criterion."""
+    if name.startswith('criterion'):
+        return 'criterion'
+    attribute = name.split('.')[0]
+    for stage, attributes in MODEL_STAGES.items():
+        if attribute in attributes:
+            return stage
+    return 'other'
+
+def iter_tensors(outputs):
+    """Yields all tensors of nested module outputs."""
+    if isinstance(outputs, torch.Tensor):
+        yield outputs
+    elif isinstance(outputs, dict):
+        for value in outputs.values():
+            yield from iter_tensors(value)
+    elif isinstance(outputs, (list, tuple)):
+        for value in outputs:
+            yield from iter_tensors(value)
@@ -0,0 +1,73 @@
+"""Helper functions to stop training on preemption and resume it with the next job."""
+
+import signal
+import sys
+
+from transoar.utils.distributed import all_reduce_mean, cleanup_distributed, is_distributed, is_main_process
+
+# EX_TEMPFAIL, the job script should requeue the job when it sees this exit code
+REQUEUE_EXIT_CODE = 75
+PREEMPTED_MARKER = 'preempted'
+
+_stop_requested = False
+
+
+class TrainingPreempted(Exception):
+    """Raised by the trainers after the checkpoint of a preempted run has been written."""
+
+
+def install_preemption_handler(signal_names=('SIGTERM', 'SIGUSR1')):
+    """Installs a handler that asks the trainer to stop after the current step.
+
+    Args:
+        signal_names: Names of the signals to handle, e.g., SIGUSR1 for `sbatch --signal=USR1@300`.
+    """
+    def handler(signum, frame):
+        global _stop_requested
+        if not _stop_requested and is_main_process():
+            print(f'Received {signal.Signals(signum).name}, stopping after the current step.')
+        _stop_requested = True
+
+        # Ignore repeated signals, the default handlers are restored while the interpreter exits
+        for name in signal_names:
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+
+    for name in signal_names:
+        signal.signal(getattr(signal, name), handler)
+
+def preemption_requested(step=None, every_n_steps=1):
+    """Returns True if any rank received a preemption signal, the same on all ranks.
+
+    Under DDP the flag is all-reduced, which blocks until every rank arrives. With the optimizer
+    step given, this is only done every every_n_steps steps and False is returned in between.
+    """
+    if not is_distributed():
+        return _stop_requested
+    if step is not None and (step + 1) % every_n_steps != 0:
+        return False
+    return all_reduce_mean(float(_stop_requested)) > 0
+
+def run_training(trainer, config):
+    """Runs the trainer and shuts down the process group afterwards.
+
+    On preemption, the checkpoint is already written and the process exits with
+    'requeue_exit_code', so that the job script can requeue the job.
+    """
+    try:
+        trainer.run()
+    except TrainingPreempted:
+        cleanup_distributed()
+        sys.exit(config.get('requeue_exit_code', REQUEUE_EXIT_CODE))
+    cleanup_distributed()
+
+def mark_preempted(path_to_run):
+    """Marks the run as preempted, so that the next start resumes from model_last.pt."""
+    if is_main_process():
+        (path_to_run / PREEMPTED_MARKER).touch()
+
+def was_preempted(path_to_run):
+    return (path_to_run / PREEMPTED_MARKER).exists()
+
+def clear_preempted(path_to_run):
+    if is_main_process() and was_preempted(path_to_run):
+        (path_to_run / PREEMPTED_MARKER).unlink()
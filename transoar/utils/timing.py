@@ -0,0 +1,125 @@
+"""Timers for the stages of a training step."""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+from torch import nn
+
+from transoar.models.activation_checkpointing import is_recomputing
+
+# Attributes of TransoarNet/OrganDetrNet and the criterion that are timed with forward hooks
+MODEL_STAGES = {
+    'backbone': ['_backbone'],
+    'msa_encoder': ['MSAEncoder'],
+    'transformer': ['_neck'],
+    'heads': ['_cls_head', '_bbox_reg_head', '_seg_head'],
+}
+
+
+class StepTimer:
+    """Accumulates the time spent in named stages of the training steps of an epoch.
+
+    On CUDA devices stages are timed with CUDA events, which are only synchronized when the
+    times are read, otherwise with wall clocks. Waiting for data is always timed with wall
+    clocks, since it happens on the host. If disabled, all methods are no-ops.
+    """
+    def __init__(self, device, enabled=True):
+        self._enabled = enabled
+        self._use_cuda = 'cuda' in str(device) and torch.cuda.is_available()
+        self._started = {}
+        self._records = defaultdict(list)   # CUDA event pairs or durations in seconds
+        self._num_steps = 0
+
+    @contextmanager
+    def stage(self, name):
+        if not self._enabled:
+            yield
+            return
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def start(self, name, wall_clock=False):
+        if self._use_cuda and not wall_clock:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self._started[name] = event
+        else:
+            self._started[name] = time.perf_counter()
+
+    def stop(self, name):
+        start = self._started.pop(name)
+        if isinstance(start, float):
+            self._records[name].append(time.perf_counter() - start)
+        else:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self._records[name].append((start, end))
+
+    def time_iterator(self, iterable, name='data_wait'):
+        """Yields the items of iterable and times how long each step waits for them."""
+        if not self._enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            self.start(name, wall_clock=True)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._started.pop(name)
+                return
+            self.stop(name)
+            self._num_steps += 1
+            yield item
+
+    def attach(self, module, name):
+        """Times every forward call of module as the stage name."""
+        if not self._enabled or module is None:
+            return
+        if isinstance(module, nn.ModuleList):   # e.g., heads cloned per decoder layer
+            for child in module:
+                self.attach(child, name)
+            return
+        # Forwards recomputed by activation checkpointing are part of the backward stage
+        module.register_forward_pre_hook(lambda *args: None if is_recomputing() else self.start(name))
+        module.register_forward_hook(lambda *args: None if is_recomputing() else self.stop(name))
+
+    def attach_model(self, model, criterion):
+        """Attaches the timers of the model stages, the matcher and the criterion.
+
+        The criterion time includes the matcher time.
+        """
+        for name, attributes in MODEL_STAGES.items():
+            for attribute in attributes:
+                self.attach(getattr(model, attribute, None), name)
+        self.attach(getattr(criterion, 'matcher', None), 'matcher')
+        self.attach(criterion, 'criterion')
+
+    def reset(self):
+        """Discards all times, e.g., of the forward passes during validation."""
+        self._started.clear()
+        self._records.clear()
+        self._num_steps = 0
+
+    def summary(self):
+        """Returns the mean time per step in ms of every stage and resets the timers."""
+        if self._use_cuda and self._records:
+            torch.cuda.synchronize()
+
+        num_steps = max(self._num_steps, 1)
+        times = {}
+        for name, records in self._records.items():
+            total = sum(
+                record * 1000 if isinstance(record, float) else record[0].elapsed_time(record[1])
+                for record in records
+            )
+            times[name] = total / num_steps
+
+        self.reset()
+        return times